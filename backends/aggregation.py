@@ -0,0 +1,101 @@
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Type
+
+if TYPE_CHECKING:
+    from schemas import TimeSeries
+
+AGGREGATION_FUNCS = ("min", "max", "avg", "count", "sum")
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def validate_funcs(funcs: List[str]) -> None:
+    for func in funcs:
+        if func not in AGGREGATION_FUNCS:
+            raise ValueError(
+                f"Unknown aggregation {func}; use one of {', '.join(AGGREGATION_FUNCS)}"
+            )
+
+
+def numeric_fields(cls: Type["TimeSeries"]) -> List[str]:
+    """Returns the fields which can be aggregated, that is all the numeric fields
+    other than the dimensions"""
+    return [
+        name
+        for name, model_field in cls.__fields__.items()
+        if name != "timestamp"
+        and name not in cls.Meta.dimensions
+        and isinstance(model_field.type_, type)
+        and issubclass(model_field.type_, (int, float, Decimal))
+    ]
+
+
+def bucket_start(timestamp: datetime, bucket: timedelta) -> datetime:
+    """Aligns the timestamp to the bucket. The buckets are aligned to the epoch,
+    just like redis does by default"""
+    return EPOCH + ((timestamp - EPOCH) // bucket) * bucket
+
+
+class BucketAggregator:
+    """Accumulates the values of a single time bucket"""
+
+    def __init__(self, fields: List[str], funcs: List[str]):
+        self.fields = fields
+        self.funcs = funcs
+        self.count: Dict[str, int] = {field: 0 for field in fields}
+        self.sum: Dict[str, Any] = {field: 0 for field in fields}
+        self.min: Dict[str, Any] = {}
+        self.max: Dict[str, Any] = {}
+
+    def add(self, row: Dict[str, Any]) -> None:
+        for field in self.fields:
+            value = row.get(field)
+            if value is None:
+                continue
+            self.count[field] += 1
+            self.sum[field] += value
+            if field not in self.min or value < self.min[field]:
+                self.min[field] = value
+            if field not in self.max or value > self.max[field]:
+                self.max[field] = value
+
+    def result(self) -> Dict[str, Any]:
+        result: Dict[str, Any] = {}
+        for field in self.fields:
+            count = self.count[field]
+            for func in self.funcs:
+                if func == "count":
+                    value = count
+                elif func == "sum":
+                    value = self.sum[field]
+                elif func == "avg":
+                    value = self.sum[field] / count if count else None
+                else:
+                    value = getattr(self, func).get(field)
+                result[f"{field}_{func}"] = value
+        return result
+
+
+def aggregate_rows(
+    rows: Iterable[Dict[str, Any]],
+    bucket: timedelta,
+    fields: List[str],
+    funcs: List[str],
+) -> Iterable[Dict[str, Any]]:
+    """Reduces the rows (ordered by the timestamp) into time buckets in a single
+    pass. Only the current bucket is kept in memory."""
+    current_bucket: Optional[datetime] = None
+    aggregator: Optional[BucketAggregator] = None
+
+    for row in rows:
+        row_bucket = bucket_start(row["timestamp"], bucket)
+        if row_bucket != current_bucket:
+            if aggregator is not None:
+                yield {"timestamp": current_bucket, **aggregator.result()}
+            current_bucket = row_bucket
+            aggregator = BucketAggregator(fields, funcs)
+        aggregator.add(row)
+
+    if aggregator is not None:
+        yield {"timestamp": current_bucket, **aggregator.result()}
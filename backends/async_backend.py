@@ -0,0 +1,118 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import islice
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Type,
+    Union,
+)
+
+if TYPE_CHECKING:
+    from schemas import TimeSeries
+
+    from .backend import Backend
+
+# how many points are pulled from the blocking query per executor call
+QUERY_CHUNK_SIZE = 1024
+QUERY_WORKERS_DEFAULT = 4
+
+
+class AsyncBackend:
+    """Counterpart of the Backend for the asyncio code. Backends with a native
+    asyncio client implement it directly, the rest is wrapped by the
+    ExecutorBackend."""
+
+    async def prepare_type(self, data_type: Type["TimeSeries"]) -> None:
+        pass
+
+    async def persist(self, point: "TimeSeries") -> None:
+        raise NotImplementedError(
+            f"Please implement persist() method on {self.__class__.__name__}"
+        )
+
+    def query(
+        self,
+        cls: Type["TimeSeries"],
+        dimensions: Dict[str, Any],
+        start_time: datetime,
+        end_time: Optional[datetime] = None,
+        fields: Optional[List[str]] = None,
+    ) -> AsyncIterator[Union["TimeSeries", Dict[str, Any]]]:
+        """Same as Backend.query(), except that it's an async generator"""
+        raise NotImplementedError(
+            f"Please implement query() method on {self.__class__.__name__}"
+        )
+
+    async def commit(self) -> None:
+        pass
+
+
+class ExecutorBackend(AsyncBackend):
+    """Runs the blocking backend in threads, so that it does not block the event
+    loop.
+
+    The backends are not meant to be written to from multiple threads at once,
+    therefore all the writes (and the commit) go through a single thread, in the
+    order they were issued. The queries run on a separate pool and pull the points
+    in chunks, so that there's a single hop to the thread per chunk rather than
+    per point."""
+
+    def __init__(self, backend: "Backend", query_workers: int = QUERY_WORKERS_DEFAULT):
+        self.backend = backend
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.readers = ThreadPoolExecutor(max_workers=query_workers)
+
+    async def run(self, executor: ThreadPoolExecutor, function, *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(
+            executor, function, *args
+        )
+
+    async def prepare_type(self, data_type: Type["TimeSeries"]) -> None:
+        await self.run(self.writer, self.backend.prepare_type, data_type)
+
+    async def persist(self, point: "TimeSeries") -> None:
+        await self.run(self.writer, self.backend.persist, point)
+
+    async def query(
+        self,
+        cls: Type["TimeSeries"],
+        dimensions: Dict[str, Any],
+        start_time: datetime,
+        end_time: Optional[datetime] = None,
+        fields: Optional[List[str]] = None,
+    ) -> AsyncIterator[Union["TimeSeries", Dict[str, Any]]]:
+        def start() -> Iterator:
+            return iter(
+                self.backend.query(cls, dimensions, start_time, end_time, fields)
+                or []
+            )
+
+        def next_chunk(iterator: Iterator) -> List[Any]:
+            return list(islice(iterator, QUERY_CHUNK_SIZE))
+
+        iterator = await self.run(self.readers, start)
+        try:
+            while True:
+                chunk = await self.run(self.readers, next_chunk, iterator)
+                if not chunk:
+                    break
+                for point in chunk:
+                    yield point
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                await self.run(self.readers, close)
+
+    async def commit(self) -> None:
+        try:
+            await self.run(self.writer, self.backend.commit)
+        finally:
+            self.writer.shutdown(wait=False)
+            self.readers.shutdown(wait=False)
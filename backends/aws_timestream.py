@@ -1,6 +1,22 @@
-from datetime import datetime
+import os
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from decimal import Decimal
-from typing import TYPE_CHECKING, Any, Dict, Iterable, Optional, Type
+from enum import Enum
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    Union,
+)
 
 import boto3
 from botocore.config import Config
@@ -8,73 +24,226 @@ from botocore.config import Config
 if TYPE_CHECKING:
     from schemas import TimeSeries
 
-from .backend import Backend
+from .backend import Backend, dimension_filter
+
+DATABASE_DEFAULT = "toudi-test"
+# the limit of the WriteRecords API
+MAX_RECORDS_PER_BATCH = 100
+# how many batches are sent at once
+WRITERS_DEFAULT = 8
+# how many records can be buffered in total, across all the series
+MAX_PENDING_RECORDS_DEFAULT = 10_000
+# how many times the rejected records are retried
+MAX_ATTEMPTS_DEFAULT = 3
+RETRY_BACKOFF = 0.1
+# the name of the multi-measure records, which hold all the attributes of a point
+MULTI_MEASURE_NAME = "measures"
 
 
 def TimeStreamType(value_type: Type) -> str:
     mapping = {
         Decimal: "DOUBLE",
+        float: "DOUBLE",
         int: "BIGINT",
         str: "VARCHAR",
         bool: "BOOLEAN",
         datetime: "TIMESTAMP",
     }
 
+    if issubclass(value_type, Enum):
+        # enums are stored by their values
+        return "BIGINT"
     if value_type not in mapping:
         raise ValueError(f"Unknown mapping for {value_type}")
 
     return mapping[value_type]
 
 
+def TimeStreamValue(value: Any) -> str:
+    if isinstance(value, Enum):
+        value = value.value
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, datetime):
+        return str(int(value.timestamp() * 1000))
+    return str(value)
+
+
 class TimeStreamBackend(Backend):
+    """Writes the points as multi-measure records (one per point, with all the
+    attributes as the measures).
+
+    The records are buffered per series, so that the dimensions of the batch can
+    be sent once as CommonAttributes. Full batches (of 100 records, which is the
+    API limit) are sent right away on a pool of TIME_SERIES_TIMESTREAM_WRITERS
+    threads, the rest on commit().
+
+    The queries are sent to the timestream-query API as SQL and the result is
+    read page by page (following the NextToken), so only a single page is held
+    in memory at a time. Aggregations run on the server with bin()."""
+
     session: boto3.Session
 
-    def __init__(self):
+    def __init__(self, writer: Optional[Any] = None, querier: Optional[Any] = None):
         self.session = boto3.Session()
-        self.writer = self.session.client(
-            "timestream-write",
-            config=Config(
-                read_timeout=20, max_pool_connections=5000, retries={"max_attempts": 10}
-            ),
+        if writer is None:
+            writer = self.session.client(
+                "timestream-write",
+                config=Config(
+                    read_timeout=20,
+                    max_pool_connections=5000,
+                    retries={"max_attempts": 10},
+                ),
+            )
+        self.writer = writer
+        # the query client is only created once the first query runs
+        self._querier = querier
+        self.database = os.environ.get(
+            "TIME_SERIES_TIMESTREAM_DATABASE", DATABASE_DEFAULT
         )
+        self.writers = int(
+            os.environ.get("TIME_SERIES_TIMESTREAM_WRITERS", WRITERS_DEFAULT)
+        )
+        self.max_attempts = int(
+            os.environ.get("TIME_SERIES_TIMESTREAM_MAX_ATTEMPTS", MAX_ATTEMPTS_DEFAULT)
+        )
+        self.max_pending_records = int(
+            os.environ.get(
+                "TIME_SERIES_TIMESTREAM_MAX_PENDING_RECORDS",
+                MAX_PENDING_RECORDS_DEFAULT,
+            )
+        )
+        self.executor = ThreadPoolExecutor(max_workers=self.writers)
+        # batches being sent; there are at most twice as many as the writers, so
+        # that the buffered records do not pile up if the writes are slow
+        self.in_flight: Deque[Future] = deque()
+        # records by the table and the dimensions of the series
+        self.buffer: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], List[Dict]] = {}
+        self.pending_records = 0
+        # errors of the batches which failed, raised by commit()
+        self.errors: List[Exception] = []
 
     def persist(self, point: "TimeSeries") -> None:
-        print("Writing records")
-        data = point.data
+        self.persist_many([point])
 
-        dimensions = [
-            {"Name": dimension_name, "Value": str(dimension_value)}
-            for dimension_name, dimension_value in data.dimensions.items()
-        ]
+    def persist_many(self, points: List["TimeSeries"]) -> None:
+        table = points[0].Meta.table
+        dimension_names = points[0].Meta.dimensions
+        for point in points:
+            series = (
+                table,
+                tuple(
+                    (dimension_name, str(getattr(point, dimension_name)))
+                    for dimension_name in dimension_names
+                ),
+            )
+            records = self.buffer.setdefault(series, [])
+            records.append(self.record(point))
+            self.pending_records += 1
+            if len(records) == MAX_RECORDS_PER_BATCH:
+                del self.buffer[series]
+                self.submit(series, records)
+            elif self.pending_records > self.max_pending_records:
+                self.flush_largest()
 
-        records = []
+    def flush_largest(self) -> None:
+        """Sends the largest buffers until half of the limit of the pending records
+        is left, so that a lot of series with a few records each don't pile up
+        until the commit"""
+        for series, records in sorted(
+            self.buffer.items(), key=lambda item: len(item[1]), reverse=True
+        ):
+            if self.pending_records <= self.max_pending_records // 2:
+                break
+            del self.buffer[series]
+            self.submit(series, records)
 
-        for attribute_name, attribute_value in data.attributes.items():
-            records.append(
+    def record(self, point: "TimeSeries") -> Dict[str, Any]:
+        return {
+            "Time": str(int(point.timestamp.timestamp() * 1000)),
+            "MeasureValues": [
                 {
-                    "Dimensions": dimensions,
-                    "Time": str(int(point.timestamp.timestamp()) * 1000),
-                    "MeasureName": attribute_name,
-                    "MeasureValue": str(attribute_value),
-                    "MeasureValueType": TimeStreamType(type(attribute_value)),
+                    "Name": field_name,
+                    "Value": TimeStreamValue(value),
+                    "Type": TimeStreamType(type(value)),
                 }
-            )
+                for field_name, value in point
+                if field_name != "timestamp"
+                and field_name not in point.Meta.dimensions
+                and value is not None
+            ],
+        }
+
+    def submit(
+        self, series: Tuple[str, Tuple[Tuple[str, str], ...]], records: List[Dict]
+    ) -> None:
+        self.pending_records -= len(records)
+        while len(self.in_flight) >= 2 * self.writers:
+            self.wait(self.in_flight.popleft())
+
+        table, dimensions = series
+        common_attributes = {
+            "Dimensions": [
+                {"Name": dimension_name, "Value": dimension_value}
+                for dimension_name, dimension_value in dimensions
+            ],
+            "MeasureName": MULTI_MEASURE_NAME,
+            "MeasureValueType": "MULTI",
+            "TimeUnit": "MILLISECONDS",
+        }
+        self.in_flight.append(
+            self.executor.submit(self.write_records, table, records, common_attributes)
+        )
 
+    def write_records(
+        self, table: str, records: List[Dict], common_attributes: Dict
+    ) -> None:
+        """Writes the batch. The records which were rejected are retried with a
+        backoff, the rest of the batch is written already by then. Any other error
+        (or the records rejected by the last attempt) fails the batch."""
+        for attempt in range(self.max_attempts):
+            try:
+                self.writer.write_records(
+                    DatabaseName=self.database,
+                    TableName=table,
+                    Records=records,
+                    CommonAttributes=common_attributes,
+                )
+                return
+            except self.writer.exceptions.RejectedRecordsException as err:
+                rejected = err.response.get("RejectedRecords", [])
+                self._print_rejected_records_exceptions(err)
+                # the records with a newer version in the table won't ever pass
+                records = [
+                    records[rejected_record["RecordIndex"]]
+                    for rejected_record in rejected
+                    if "ExistingVersion" not in rejected_record
+                ]
+                if rejected and not records:
+                    return
+                if attempt == self.max_attempts - 1 or not rejected:
+                    raise
+                time.sleep(RETRY_BACKOFF * 2**attempt)
+
+    def wait(self, future: Future) -> None:
         try:
-            result = self.writer.write_records(
-                DatabaseName="toudi-test",
-                TableName=point.Meta.table,
-                Records=records,
-                CommonAttributes={},
-            )
-            print(
-                "WriteRecords Status: [%s]"
-                % result["ResponseMetadata"]["HTTPStatusCode"]
-            )
-        except self.writer.exceptions.RejectedRecordsException as err:
-            self._print_rejected_records_exceptions(err)
+            future.result()
         except Exception as err:
             print("Error:", err)
+            self.errors.append(err)
+
+    def commit(self) -> None:
+        """Sends the buffered records and waits for all the batches. Raises the
+        error of the first batch which failed"""
+        buffer, self.buffer = self.buffer, {}
+        for series, records in buffer.items():
+            self.submit(series, records)
+        while self.in_flight:
+            self.wait(self.in_flight.popleft())
+        if self.errors:
+            errors, self.errors = self.errors, []
+            print(f"{len(errors)} batches failed")
+            raise errors[0]
 
     @staticmethod
     def _print_rejected_records_exceptions(err):
@@ -84,11 +253,156 @@ class TimeStreamBackend(Backend):
             if "ExistingVersion" in rr:
                 print("Rejected record existing version: ", rr["ExistingVersion"])
 
+    @property
+    def querier(self) -> Any:
+        if self._querier is None:
+            self._querier = self.session.client("timestream-query")
+        return self._querier
+
+    def where_clause(
+        self,
+        cls: Type["TimeSeries"],
+        dimensions: Dict[str, Any],
+        start_time: datetime,
+        end_time: Optional[datetime],
+    ) -> str:
+        whereClause = [f"measure_name = {quote(MULTI_MEASURE_NAME)}"]
+        for dimension, values in dimension_filter(cls, dimensions).items():
+            if values is None:
+                continue
+            if len(values) == 1:
+                whereClause.append(f"{dimension} = {quote(next(iter(values)))}")
+            else:
+                whereClause.append(
+                    f"{dimension} IN ({', '.join(map(quote, sorted(values)))})"
+                )
+        whereClause.append(f"time >= {timestamp_literal(start_time)}")
+        if end_time:
+            whereClause.append(f"time <= {timestamp_literal(end_time)}")
+        return " AND ".join(whereClause)
+
+    def run_query(self, query_string: str) -> Iterable[Dict[str, Any]]:
+        """Yields the rows of the result as dicts, page by page"""
+        print(query_string)
+        next_token = None
+        while True:
+            arguments = {"QueryString": query_string}
+            if next_token is not None:
+                arguments["NextToken"] = next_token
+            page = self.querier.query(**arguments)
+
+            columns = [
+                (column["Name"], column["Type"].get("ScalarType"))
+                for column in page["ColumnInfo"]
+            ]
+            for row in page["Rows"]:
+                yield {
+                    name: scalar_value(scalar_type, datum)
+                    for (name, scalar_type), datum in zip(columns, row["Data"])
+                }
+
+            next_token = page.get("NextToken")
+            if next_token is None:
+                break
+
     def query(
         self,
         cls: Type["TimeSeries"],
         dimensions: Dict[str, Any],
         start_time: datetime,
         end_time: Optional[datetime] = None,
-    ) -> Iterable:
-        pass
+        fields: Optional[List[str]] = None,
+    ) -> Iterable[Union["TimeSeries", Dict[str, Any]]]:
+        attributes = [
+            name
+            for name in cls.__fields__
+            if name != "timestamp" and name not in cls.Meta.dimensions
+        ]
+        columns = list(cls.Meta.dimensions) + attributes
+        if fields is not None:
+            columns = [field for field in fields if field != "timestamp"]
+
+        query_string = (
+            f"SELECT time, {', '.join(columns)} "
+            f"FROM {self.table_name(cls)} "
+            f"WHERE {self.where_clause(cls, dimensions, start_time, end_time)} "
+            "ORDER BY time"
+        )
+        for row in self.run_query(query_string):
+            timestamp = row.pop("time")
+            values = {
+                name: field_value(cls, name, value) for name, value in row.items()
+            }
+            if fields is not None:
+                yield {"timestamp": timestamp, **values}
+            else:
+                yield cls(timestamp=timestamp, **values)
+
+    def aggregate(
+        self,
+        cls: Type["TimeSeries"],
+        dimensions: Dict[str, Any],
+        start_time: datetime,
+        end_time: Optional[datetime],
+        bucket: timedelta,
+        funcs: List[str],
+        fields: List[str],
+    ) -> Iterable[Dict[str, Any]]:
+        # timestream aligns the bins to the epoch, just like the other backends
+        interval = f"{int(bucket.total_seconds())}s"
+        columns = [f"bin(time, {interval}) AS binned_time"]
+        for field in fields:
+            for func in funcs:
+                columns.append(f"{func.upper()}({field}) AS {field}_{func}")
+
+        query_string = (
+            f"SELECT {', '.join(columns)} "
+            f"FROM {self.table_name(cls)} "
+            f"WHERE {self.where_clause(cls, dimensions, start_time, end_time)} "
+            f"GROUP BY bin(time, {interval}) "
+            "ORDER BY binned_time"
+        )
+        for row in self.run_query(query_string):
+            yield {"timestamp": row.pop("binned_time"), **row}
+
+    def table_name(self, cls: Type["TimeSeries"]) -> str:
+        return f'"{self.database}"."{cls.Meta.table}"'
+
+
+def quote(value: str) -> str:
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def timestamp_literal(timestamp: datetime) -> str:
+    return f"from_milliseconds({int(timestamp.timestamp() * 1000)})"
+
+
+def scalar_value(scalar_type: Optional[str], datum: Dict[str, Any]) -> Any:
+    if datum.get("NullValue"):
+        return None
+    value = datum.get("ScalarValue")
+    if scalar_type == "BIGINT":
+        return int(value)
+    if scalar_type == "DOUBLE":
+        return float(value)
+    if scalar_type == "BOOLEAN":
+        return value == "true"
+    if scalar_type == "TIMESTAMP":
+        # i.e. 2024-01-01 00:00:00.000000000; python only handles microseconds
+        return datetime.strptime(value[:26], "%Y-%m-%d %H:%M:%S.%f").replace(
+            tzinfo=timezone.utc
+        )
+    return value
+
+
+def field_value(cls: Type["TimeSeries"], field: str, value: Any) -> Any:
+    """Converts the value back to the type of the field"""
+    if value is None or field not in cls.__fields__:
+        return value
+    field_type = cls.__fields__[field].type_
+    if isinstance(field_type, type):
+        if issubclass(field_type, Enum):
+            return field_type(value)
+        if issubclass(field_type, Decimal):
+            return Decimal(str(value))
+    return value
@@ -1,10 +1,62 @@
-from datetime import datetime
-from typing import TYPE_CHECKING, Any, Dict, Iterable, Optional, Type
+from datetime import datetime, timedelta
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Type,
+    Union,
+)
+
+from .aggregation import aggregate_rows
 
 if TYPE_CHECKING:
     from schemas import TimeSeries
 
 
+class AllValues:
+    """Dimension predicate which matches all the values of the dimension"""
+
+    def __repr__(self) -> str:
+        return "ALL"
+
+
+ALL = AllValues()
+
+
+def dimension_filter(
+    cls: Type["TimeSeries"], dimensions: Dict[str, Any]
+) -> Dict[str, Optional[Set[str]]]:
+    """Normalizes the dimension predicates of the query. Each dimension can be
+    given a single value, a list (or a set / tuple) of values or ALL. Dimensions
+    which are not specified match all the values as well.
+
+    Returns the set of the allowed values (as strings) per dimension, or None if
+    all the values are allowed."""
+    normalized: Dict[str, Optional[Set[str]]] = {}
+    for dimension_name in cls.Meta.dimensions:
+        value = dimensions.get(dimension_name, ALL)
+        if value is ALL:
+            normalized[dimension_name] = None
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            normalized[dimension_name] = {str(item) for item in value}
+        else:
+            normalized[dimension_name] = {str(value)}
+    return normalized
+
+
+def matches_dimensions(
+    dimensions: Dict[str, str], predicates: Dict[str, Optional[Set[str]]]
+) -> bool:
+    return all(
+        allowed is None or dimensions.get(dimension_name) in allowed
+        for dimension_name, allowed in predicates.items()
+    )
+
+
 class Backend:
     def prepare_type(self, data_type: Type["TimeSeries"]) -> None:
         """In this method, the backend may inspect the data type and prepare
@@ -16,16 +68,84 @@ class Backend:
             f"Please implement persist() method on {self.__class__.__name__}"
         )
 
+    def persist_many(self, points: List["TimeSeries"]) -> None:
+        """Persists a batch of points of the same type. Backends which can encode
+        and write the points of a series in one go should override it"""
+        for point in points:
+            self.persist(point)
+
     def query(
         self,
         cls: Type["TimeSeries"],
         dimensions: Dict[str, Any],
         start_time: datetime,
         end_time: Optional[datetime] = None,
-    ) -> Iterable["TimeSeries"]:
+        fields: Optional[List[str]] = None,
+    ) -> Iterable[Union["TimeSeries", Dict[str, Any]]]:
+        """Yields the points of the series within the time range. If the fields are
+        specified, the backend should only fetch these and yield dicts with the
+        timestamp and the requested fields instead of the TimeSeries objects."""
         raise NotImplementedError(
             f"Please implement query() method on {self.__class__.__name__}"
         )
 
+    def query_raw(
+        self,
+        cls: Type["TimeSeries"],
+        dimensions: Dict[str, Any],
+        start_time: datetime,
+        end_time: Optional[datetime] = None,
+        fields: Optional[List[str]] = None,
+    ) -> Iterable[Union["TimeSeries", Dict[str, Any]]]:
+        """Same as query(), except that the points always come from the raw data,
+        even if the backend would answer the range from the downsampled one"""
+        return self.query(cls, dimensions, start_time, end_time, fields)
+
+    def downsamples(
+        self,
+        cls: Type["TimeSeries"],
+        start_time: datetime,
+        end_time: Optional[datetime],
+        fields: Optional[List[str]] = None,
+    ) -> bool:
+        """Tells whether query() answers the range from the downsampled data rather
+        than yielding the raw points"""
+        return False
+
+    def compact(self, cls: Type["TimeSeries"]) -> None:
+        """Merges the small partitions of the series into larger ones. It's up to
+        the backend, most of them do not need it"""
+        pass
+
+    def query_array(
+        self,
+        cls: Type["TimeSeries"],
+        dimensions: Dict[str, Any],
+        start_time: datetime,
+        end_time: Optional[datetime] = None,
+    ) -> Dict[str, Any]:
+        raise NotImplementedError(
+            f"Please implement query_array() method on {self.__class__.__name__}"
+        )
+
+    def aggregate(
+        self,
+        cls: Type["TimeSeries"],
+        dimensions: Dict[str, Any],
+        start_time: datetime,
+        end_time: Optional[datetime],
+        bucket: timedelta,
+        funcs: List[str],
+        fields: List[str],
+    ) -> Iterable[Dict[str, Any]]:
+        """Reduces the points into time buckets. Yields a dict per bucket, with the
+        bucket's start as the timestamp and a <field>_<func> key per aggregate.
+
+        The default implementation streams the requested fields from query() and
+        reduces them in a single pass. Backends which can aggregate on the server
+        side should override it."""
+        rows = self.query(cls, dimensions, start_time, end_time, fields)
+        yield from aggregate_rows(rows, bucket, fields, funcs)
+
     def commit(self) -> None:
         pass
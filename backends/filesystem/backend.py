@@ -1,17 +1,46 @@
+import heapq
 import os
 import struct
-from datetime import datetime, timedelta
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import date, datetime, time
 from decimal import Decimal
 from enum import Enum
+from operator import attrgetter, itemgetter
 from pathlib import Path
-from typing import TYPE_CHECKING, Any, Dict, Iterable, Optional, Tuple, Type
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+    Union,
+)
 
 import pytz
 from pydantic import ConstrainedDecimal, ConstrainedStr
 
-from ..backend import Backend
+from ..backend import Backend, dimension_filter, matches_dimensions
 from .binary_struct import BinaryStruct
-from .timestream_file import TimeStreamFile
+from .catalog import Catalog, Partition
+from .compaction import (
+    COMPACTION_TIERS_DEFAULT,
+    SEGMENTS_DIRECTORY,
+    Compactor,
+    parse_segment_path,
+    parse_tiers,
+    period_end,
+)
+from .compressed_file import BLOCK_ENTRIES_DEFAULT, CompressedTimeStreamFile
+from .timestream_file import COMMIT_STRATEGY_DEFAULT, TimeStreamFile
+from .wal import FoldLog, LogDirectory, WriteAheadLog
 
 if TYPE_CHECKING:
     from schema import TimeSeries
@@ -19,16 +48,77 @@ if TYPE_CHECKING:
 
 FILESYSTEM_FILEPATH_FORMAT_DEFAULT = "{table}/{dimensions}/{year}/{month:02d}/{day:02d}"
 
+# fixed-width rows, as encoded by the BinaryStruct
+FILE_FORMAT_BINARY = "binary"
+# blocks of delta / XOR encoded columns
+FILE_FORMAT_COMPRESSED = "compressed"
+
+WAL_DIRECTORY = ".wal"
+WAL_GROUP_COMMIT_INTERVAL_MS_DEFAULT = 10
+WAL_GROUP_COMMIT_SIZE_DEFAULT = 1024 * 1024
+WAL_CHECKPOINT_INTERVAL_DEFAULT = 60
+
+# how many partition files can be opened at once
+MAX_OPEN_FILES_DEFAULT = 256
+# how many points can wait for the commit in the opened files, in total
+MAX_PENDING_ENTRIES_DEFAULT = 1_000_000
+
+# how many partitions are read at once by a query
+QUERY_PARALLELISM_DEFAULT = 4
+# how many partitions of each series are read ahead of the merge
+QUERY_READAHEAD_DEFAULT = 2
+
+
+@dataclass
+class PendingPartition:
+    """Points of a partition which are in the write-ahead log, but were not folded
+    into the partition file yet"""
+
+    table: str
+    fmt: str
+    partition: "Partition"
+    entries: List[bytes] = field(default_factory=list)
+
+
+@dataclass
+class PartitionSnapshot:
+    """Partition file to be read by a query, as it was when the query started"""
+
+    filename: str
+    # the entries appended past the size came after the query started
+    size: int
+    inode: int
+
 
 class FileSystemBackend(Backend):
     root: Path
     endianess: str = "<"
-    opened_files: Dict[str, "TimeStreamFile"]
+    # the opened files, least recently used first
+    opened_files: "OrderedDict[str, TimeStreamFile]"
+    # table and catalog entry of the opened files, which are updated on commit
+    opened_partitions: Dict[str, Tuple[str, "Partition"]]
+    # number of points waiting for the commit in the opened files
+    pending_entries: int
+    catalogs: Dict[str, "Catalog"]
+    # catalogs which were updated by evicting the opened files, but not saved yet
+    updated_catalogs: Dict[str, "Catalog"]
     structs: Dict[Type["TimeSeries"], "BinaryStruct"]
+    wal: Optional["WriteAheadLog"] = None
+    # the directory of the log segments of this backend, locked while it's in use
+    log_directory: Optional["LogDirectory"] = None
+    fold_log: Optional["FoldLog"] = None
+    # points which are only in the write-ahead log, by the partition filename
+    memtable: Dict[str, "PendingPartition"]
+    # memtables of the sealed log segments, which are being checkpointed
+    sealed_memtables: List[Dict[str, "PendingPartition"]]
+    # number of the running queries which are going to read the partition file
+    readers: Dict[str, int]
 
     def prepare_type(self, data_type: Type["TimeSeries"]) -> None:
         if data_type not in self.structs:
-            self.structs[data_type] = BinaryStruct(data_type, self.endianess)
+            self.structs[data_type] = BinaryStruct(
+                data_type, self.endianess, trusted=self.trusted_decode
+            )
 
     def __init__(self):
         root = os.environ.get("TIME_SERIES_FS_ROOT", None)
@@ -37,22 +127,299 @@ class FileSystemBackend(Backend):
         self.filepath_format = os.environ.get(
             "TIME_SERIES_FS_FILEPATH_FORMAT", FILESYSTEM_FILEPATH_FORMAT_DEFAULT
         )
+        self.commit_strategy = os.environ.get(
+            "TIME_SERIES_FS_COMMIT_STRATEGY", COMMIT_STRATEGY_DEFAULT
+        )
+        self.file_format = os.environ.get("TIME_SERIES_FS_FORMAT", FILE_FORMAT_BINARY)
+        if self.file_format not in (FILE_FORMAT_BINARY, FILE_FORMAT_COMPRESSED):
+            raise ValueError(f"Unknown file format: {self.file_format}")
+        # the points are built without the validation when reading them back
+        self.trusted_decode = (
+            os.environ.get("TIME_SERIES_FS_TRUSTED_DECODE", "0") == "1"
+        )
+        self.block_entries = int(
+            os.environ.get("TIME_SERIES_FS_BLOCK_ENTRIES", BLOCK_ENTRIES_DEFAULT)
+        )
+        self.max_open_files = int(
+            os.environ.get("TIME_SERIES_FS_MAX_OPEN_FILES", MAX_OPEN_FILES_DEFAULT)
+        )
+        self.max_pending_entries = int(
+            os.environ.get(
+                "TIME_SERIES_FS_MAX_PENDING_ENTRIES", MAX_PENDING_ENTRIES_DEFAULT
+            )
+        )
+
+        self.query_parallelism = max(
+            1,
+            int(
+                os.environ.get(
+                    "TIME_SERIES_FS_QUERY_PARALLELISM", QUERY_PARALLELISM_DEFAULT
+                )
+            ),
+        )
+        self.query_readahead = max(
+            1,
+            int(
+                os.environ.get(
+                    "TIME_SERIES_FS_QUERY_READAHEAD", QUERY_READAHEAD_DEFAULT
+                )
+            ),
+        )
 
         self.root = root
         if not os.path.exists(root):
             os.makedirs(root)
 
-        self.opened_files = {}
+        self.compactor = Compactor(
+            self,
+            parse_tiers(
+                os.environ.get(
+                    "TIME_SERIES_FS_COMPACTION_TIERS", COMPACTION_TIERS_DEFAULT
+                )
+            ),
+        )
+        self.compaction_lock = threading.Lock()
+
+        self.opened_files = OrderedDict()
+        self.opened_partitions = {}
+        self.pending_entries = 0
+        self.catalogs = {}
+        self.updated_catalogs = {}
         self.structs = {}
 
+        # the lock guards the partition files, the catalogs and the memtables
+        # against the background checkpointer
+        self.lock = threading.RLock()
+        self.memtable = {}
+        self.sealed_memtables = []
+        self.readers = {}
+        self.wal_enabled = os.environ.get("TIME_SERIES_FS_WAL", "0") == "1"
+        self.wal_synchronous = (
+            os.environ.get("TIME_SERIES_FS_WAL_SYNCHRONOUS", "0") == "1"
+        )
+        self.wal_directory = os.path.join(self.root, WAL_DIRECTORY)
+        if self.wal_enabled:
+            self.recover()
+
+    def partition(self, point: "TimeSeries", filename: str) -> "Partition":
+        return Partition(
+            path=os.path.relpath(filename, self.root),
+            dimensions={
+                dimension_name: str(getattr(point, dimension_name))
+                for dimension_name in point.Meta.dimensions
+            },
+            date=point.timestamp.date().isoformat(),
+        )
+
     def persist(self, point: "TimeSeries") -> None:
         print(f"persisting {point.timestamp}")
 
         binary_struct = self.structs[type(point)]
-        filename = self.filename(point)
+        self.write_entries(
+            point,
+            str(self.filename(point)),
+            binary_struct.fmt,
+            [binary_struct.encode_point(point)],
+        )
+
+    def persist_many(self, points: List["TimeSeries"]) -> None:
+        """Groups the points by the partition, so that the path is formatted and the
+        file is looked up once per partition rather than once per point"""
+        binary_struct = self.structs[type(points[0])]
+        dimension_names = points[0].Meta.dimensions
+
+        partitions: Dict[Tuple[Any, ...], List["TimeSeries"]] = {}
+        for point in points:
+            key = (point.timestamp.date(),) + tuple(
+                getattr(point, dimension_name) for dimension_name in dimension_names
+            )
+            partitions.setdefault(key, []).append(point)
+
+        for partition_points in partitions.values():
+            filename = str(self.filename(partition_points[0]))
+            print(f"persisting {len(partition_points)} points into {filename}")
+            self.write_entries(
+                partition_points[0],
+                filename,
+                binary_struct.fmt,
+                binary_struct.encode_many(partition_points),
+            )
+
+    def write_entries(
+        self, point: "TimeSeries", filename: str, struct_fmt: str, entries: List[bytes]
+    ) -> None:
+        """Appends the encoded points to the partition of the given point"""
+        if self.wal_enabled:
+            self.persist_wal(point, filename, struct_fmt, entries)
+            return
 
-        timestream_file = self.timestream_file(filename, binary_struct.fmt)
-        timestream_file.append(binary_struct.encode_point(point))
+        if filename not in self.opened_partitions:
+            # the compaction must not pick the file while it's being opened
+            with self.lock:
+                self.opened_partitions[filename] = (
+                    point.Meta.table,
+                    self.partition(point, filename),
+                )
+                timestream_file = self.timestream_file(filename, struct_fmt)
+        else:
+            timestream_file = self.timestream_file(filename, struct_fmt)
+        timestream_file.extend(entries)
+
+        self.pending_entries += len(entries)
+        while self.pending_entries > self.max_pending_entries:
+            self.evict()
+
+    def persist_wal(
+        self, point: "TimeSeries", filename: str, struct_fmt: str, entries: List[bytes]
+    ) -> None:
+        with self.lock:
+            if self.wal is None:
+                self.start_wal()
+
+            pending = self.memtable.get(filename)
+            if pending is None:
+                pending = PendingPartition(
+                    table=point.Meta.table,
+                    fmt=struct_fmt,
+                    partition=self.partition(point, filename),
+                )
+                self.memtable[filename] = pending
+
+            wal_partition = {
+                "path": pending.partition.path,
+                "table": pending.table,
+                "fmt": pending.fmt,
+                "dimensions": pending.partition.dimensions,
+                "date": pending.partition.date,
+            }
+            for data in entries:
+                lsn = self.wal.append(wal_partition, data)
+            pending.entries.extend(entries)
+
+        if self.wal_synchronous:
+            self.wal.sync(lsn)
+
+    def start_wal(self) -> None:
+        self.log_directory = LogDirectory.create(self.wal_directory)
+        self.fold_log = FoldLog(self.log_directory.path)
+        self.wal = WriteAheadLog(
+            self.log_directory.path,
+            group_commit_interval=int(
+                os.environ.get(
+                    "TIME_SERIES_FS_WAL_GROUP_COMMIT_INTERVAL_MS",
+                    WAL_GROUP_COMMIT_INTERVAL_MS_DEFAULT,
+                )
+            )
+            / 1000,
+            group_commit_size=int(
+                os.environ.get(
+                    "TIME_SERIES_FS_WAL_GROUP_COMMIT_SIZE",
+                    WAL_GROUP_COMMIT_SIZE_DEFAULT,
+                )
+            ),
+        )
+        self.checkpoint_interval = float(
+            os.environ.get(
+                "TIME_SERIES_FS_WAL_CHECKPOINT_INTERVAL",
+                WAL_CHECKPOINT_INTERVAL_DEFAULT,
+            )
+        )
+        self.checkpoint_lock = threading.Lock()
+        self.checkpointer_stopped = threading.Event()
+        self.checkpointer = threading.Thread(target=self.run_checkpointer, daemon=True)
+        self.checkpointer.start()
+
+    def run_checkpointer(self) -> None:
+        while not self.checkpointer_stopped.wait(self.checkpoint_interval):
+            self.checkpoint()
+
+    def checkpoint(self) -> None:
+        """Seals the current log segment and folds its points into the partition
+        files. The points stay visible to queries via the sealed memtable until
+        their partition file is committed."""
+        with self.checkpoint_lock:
+            with self.lock:
+                if not self.memtable:
+                    return
+                sealed_segment = self.wal.rotate()
+                sealed_memtable = self.memtable
+                self.memtable = {}
+                self.sealed_memtables.append(sealed_memtable)
+
+            print(f"checkpointing {sealed_segment}")
+            self.fold(sealed_memtable, os.path.basename(sealed_segment), self.fold_log)
+
+            with self.lock:
+                self.sealed_memtables.remove(sealed_memtable)
+            os.remove(sealed_segment)
+            self.fold_log.reset()
+
+    def fold(
+        self,
+        memtable: Dict[str, "PendingPartition"],
+        segment: str,
+        fold_log: "FoldLog",
+        folded: Optional[Dict[str, int]] = None,
+    ) -> None:
+        """Appends the points of the segment to the partition files. The partitions
+        which were folded before a crash (see FoldLog) only get their catalog entry
+        updated"""
+        updated_catalogs: Dict[str, "Catalog"] = {}
+
+        for filename, pending in list(memtable.items()):
+            timestream_file = self.open_file(filename, pending.fmt)
+            entries = (folded or {}).get(pending.partition.path)
+            if entries is None or len(timestream_file) < entries:
+                fold_log.mark(
+                    segment,
+                    pending.partition.path,
+                    len(timestream_file) + len(pending.entries),
+                )
+                timestream_file.extend(pending.entries)
+
+            # the partition file and the memtable have to change at once, otherwise
+            # a query could see the points twice (or not at all)
+            with self.lock:
+                self.commit_file(
+                    pending.table, pending.partition, timestream_file, updated_catalogs
+                )
+                del memtable[filename]
+
+        with self.lock:
+            for catalog in updated_catalogs.values():
+                catalog.save()
+
+    def recover(self) -> None:
+        """Folds the log segments left behind by the crashed backends into the
+        partition files. The logs of the backends which are still running are left
+        alone"""
+        for log_directory in LogDirectory.orphans(self.wal_directory):
+            fold_log = FoldLog(log_directory.path)
+            for segment_filename in log_directory.segments():
+                self.recover_segment(segment_filename, fold_log)
+            # the log may hold the records of any of the segments, until all are gone
+            log_directory.release()
+
+    def recover_segment(self, segment_filename: str, fold_log: "FoldLog") -> None:
+        segment = os.path.basename(segment_filename)
+        print(f"recovering {segment_filename}")
+        memtable: Dict[str, PendingPartition] = {}
+        for entry in WriteAheadLog.replay(segment_filename):
+            filename = os.path.join(self.root, entry.partition["path"])
+            if filename not in memtable:
+                memtable[filename] = PendingPartition(
+                    table=entry.partition["table"],
+                    fmt=entry.partition["fmt"],
+                    partition=Partition(
+                        path=entry.partition["path"],
+                        dimensions=entry.partition["dimensions"],
+                        date=entry.partition["date"],
+                    ),
+                )
+            memtable[filename].entries.append(entry.data)
+
+        self.fold(memtable, segment, fold_log, fold_log.folded(segment))
+        os.remove(segment_filename)
 
     def query(
         self,
@@ -60,32 +427,284 @@ class FileSystemBackend(Backend):
         dimensions: Dict[str, Any],
         start_time: datetime,
         end_time: Optional[datetime] = None,
-    ) -> Iterable["TimeSeries"]:
-        lookup = TimeStreamFileLookup(cls, dimensions, start_time, end_time)
+        fields: Optional[List[str]] = None,
+    ) -> Iterable[Union["TimeSeries", Dict[str, Any]]]:
+        """Yields the points of all the series matching the dimensions, ordered by
+        the timestamp.
+
+        The partitions are read and decoded by a pool of threads, a few partitions
+        of each series ahead of the consumer, and the sorted streams of the series
+        are merged lazily, so that only the partitions being read are in memory
+        (and opened)."""
+        binary_struct = self.structs[cls]
+        series_clusters, pending_records = self.query_sources(
+            cls, dimensions, start_time, end_time
+        )
+
+        def decode(records: Iterable[Tuple[Any, ...]]) -> List[Any]:
+            if fields is not None:
+                return list(binary_struct.decode_fields(records, fields))
+            return list(binary_struct.decode_many(records))
+
+        def read_cluster(cluster: List["PartitionSnapshot"]) -> List[Any]:
+            files = self.open_snapshots(cluster, binary_struct.fmt)
+            try:
+                return decode(
+                    heapq.merge(
+                        *(
+                            timestream_file.records(start_time, end_time)
+                            for timestream_file in files
+                        ),
+                        key=itemgetter(0),
+                    )
+                )
+            finally:
+                for timestream_file in files:
+                    timestream_file.close()
+
+        executor = ThreadPoolExecutor(max_workers=self.query_parallelism)
+        # the read-ahead is shared by all the series, so that a query over many
+        # series does not read (and open) a few partitions of each one at once
+        read_ahead_limit = self.query_parallelism * self.query_readahead
+        reads_ahead = 0
+
+        def series_stream(clusters: List[List["PartitionSnapshot"]]) -> Iterable[Any]:
+            nonlocal reads_ahead
+            clusters_queue = deque(clusters)
+            futures: Deque[Future] = deque()
+            while clusters_queue or futures:
+                # the next cluster of the series is read in any case, as the merge
+                # can't go on without it
+                while clusters_queue and (
+                    not futures
+                    or len(futures) < self.query_readahead
+                    and reads_ahead < read_ahead_limit
+                ):
+                    futures.append(
+                        executor.submit(read_cluster, clusters_queue.popleft())
+                    )
+                    reads_ahead += 1
+                future = futures.popleft()
+                reads_ahead -= 1
+                yield from future.result()
+
+        try:
+            streams = [series_stream(clusters) for clusters in series_clusters]
+            if pending_records:
+                streams.append(decode(pending_records))
+            timestamp_getter = (
+                itemgetter("timestamp")
+                if fields is not None
+                else attrgetter("timestamp")
+            )
+            yield from heapq.merge(*streams, key=timestamp_getter)
+        finally:
+            # the consumer may stop early, in which case the read-ahead is dropped
+            executor.shutdown(wait=True, cancel_futures=True)
+            self.release_snapshots(series_clusters)
+
+    def query_sources(
+        self,
+        cls: Type["TimeSeries"],
+        dimensions: Dict[str, Any],
+        start_time: datetime,
+        end_time: Optional[datetime] = None,
+    ) -> Tuple[List[List[List["PartitionSnapshot"]]], List[Tuple[Any, ...]]]:
+        """Returns the partition files to read, grouped by the series, as well as
+        the (sorted) points which are not in the files yet. The files of a series
+        are split into clusters of files with overlapping time ranges, the clusters
+        themselves are in the time order.
 
+        Only the sizes of the files are taken here, under the lock, the files are
+        opened once they're read (see open_snapshots()), so that a query over any
+        number of partitions keeps just a few of them opened. The points appended
+        to the files meanwhile (i.e. by a checkpoint, which moves them from the
+        memtable) are therefore not read twice. The compaction leaves the files
+        alone until release_snapshots() is called."""
         binary_struct = self.structs[cls]
+        predicates = dimension_filter(cls, dimensions)
+        start_timestamp = start_time.timestamp()
+        end_timestamp = end_time.timestamp() if end_time is not None else None
+
+        with self.lock:
+            series: Dict[Tuple[Optional[str], ...], List[List[PartitionSnapshot]]] = {}
+            clusters_end: Dict[Tuple[Optional[str], ...], Optional[int]] = {}
+            for partition in self.files_queue(cls, predicates, start_time, end_time):
+                filename = os.path.join(self.root, partition.path)
+                print("traversing", filename)
+                try:
+                    stat = os.stat(filename)
+                except FileNotFoundError:
+                    # compacted by another process since the catalog was read
+                    print(f"skipping {filename}, it's gone")
+                    continue
+                snapshot = PartitionSnapshot(
+                    filename=filename, size=stat.st_size, inode=stat.st_ino
+                )
+                self.readers[filename] = self.readers.get(filename, 0) + 1
+
+                series_key = tuple(
+                    partition.dimensions.get(dimension_name)
+                    for dimension_name in cls.Meta.dimensions
+                )
+                clusters = series.setdefault(series_key, [])
+                cluster_end = clusters_end.get(series_key)
+                if (
+                    clusters
+                    and cluster_end is not None
+                    and partition.min_timestamp is not None
+                    and partition.min_timestamp <= cluster_end
+                ):
+                    clusters[-1].append(snapshot)
+                else:
+                    clusters.append([snapshot])
+                    cluster_end = None
+                if partition.max_timestamp is not None:
+                    clusters_end[series_key] = max(
+                        cluster_end or partition.max_timestamp, partition.max_timestamp
+                    )
+                else:
+                    clusters_end[series_key] = None
+
+            pending_records = []
+            for memtable in self.sealed_memtables + [self.memtable]:
+                for pending in memtable.values():
+                    if pending.table != cls.Meta.table or not matches_dimensions(
+                        pending.partition.dimensions, predicates
+                    ):
+                        continue
+                    for data in pending.entries:
+                        values = binary_struct.struct.unpack(data)
+                        if values[0] < start_timestamp or (
+                            end_timestamp is not None and values[0] > end_timestamp
+                        ):
+                            continue
+                        pending_records.append(values)
+
+        pending_records.sort(key=itemgetter(0))
+        return list(series.values()), pending_records
+
+    def open_snapshots(
+        self, snapshots: List["PartitionSnapshot"], struct_fmt: str
+    ) -> List["TimeStreamFile"]:
+        """Opens the files for reading, limited to the size they had when the query
+        started. A file which was replaced since then (by a commit which rewrote it
+        or by the compaction) is read whole and one which was compacted away is
+        skipped, i.e. a query which overlaps a backfill or a compaction of the same
+        partition may miss or repeat some of its points, just like a query over
+        a file which is being merged in-place."""
+        files = []
+        for snapshot in snapshots:
+            try:
+                timestream_file = self.open_file(
+                    snapshot.filename, struct_fmt, read_only=True
+                )
+            except FileNotFoundError:
+                print(f"skipping {snapshot.filename}, it's gone")
+                continue
+            if os.fstat(timestream_file.file.fileno()).st_ino == snapshot.inode:
+                timestream_file.size_limit = snapshot.size
+            files.append(timestream_file)
+        return files
+
+    def release_snapshots(
+        self, series_clusters: List[List[List["PartitionSnapshot"]]]
+    ) -> None:
+        with self.lock:
+            for clusters in series_clusters:
+                for cluster in clusters:
+                    for snapshot in cluster:
+                        self.readers[snapshot.filename] -= 1
+                        if self.readers[snapshot.filename] == 0:
+                            del self.readers[snapshot.filename]
+
+    def query_array(
+        self,
+        cls: Type["TimeSeries"],
+        dimensions: Dict[str, Any],
+        start_time: datetime,
+        end_time: Optional[datetime] = None,
+    ) -> Dict[str, Any]:
+        import numpy as np
+
+        binary_struct = self.structs[cls]
+        dtype = binary_struct.dtype()
+        series_clusters, pending_records = self.query_sources(
+            cls, dimensions, start_time, end_time
+        )
+        snapshots = [
+            snapshot
+            for clusters in series_clusters
+            for cluster in clusters
+            for snapshot in cluster
+        ]
+        arrays = [np.empty(0, dtype=dtype)]
+
+        def read_array(snapshot: "PartitionSnapshot") -> "np.ndarray":
+            array = np.empty(0, dtype=dtype)
+            for timestream_file in self.open_snapshots([snapshot], binary_struct.fmt):
+                try:
+                    array = timestream_file.array(dtype, start_time, end_time)
+                finally:
+                    timestream_file.close()
+            return array
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.query_parallelism) as executor:
+                arrays.extend(executor.map(read_array, snapshots))
+        finally:
+            self.release_snapshots(series_clusters)
+        if pending_records:
+            arrays.append(np.array(pending_records, dtype=dtype))
+
+        array = np.concatenate(arrays)
+        if len(series_clusters) > 1 or pending_records or any(
+            len(cluster) > 1 for clusters in series_clusters for cluster in clusters
+        ):
+            array = array[np.argsort(array["timestamp"], kind="stable")]
+
+        return binary_struct.decode_array(array)
+
+    def files_queue(
+        self,
+        cls: Type["TimeSeries"],
+        predicates: Dict[str, Optional[Set[str]]],
+        start_time: datetime,
+        end_time: Optional[datetime] = None,
+    ) -> List["Partition"]:
+        catalog = self.catalog(cls.Meta.table)
+        if catalog.exists() or catalog.dirty:
+            return catalog.lookup(
+                predicates,
+                start_time.timestamp(),
+                end_time.timestamp() if end_time is not None else None,
+            )
+
+        # there's no catalog (yet) therefore we have to look for the files
+        lookup = TimeStreamFileLookup(cls, predicates, start_time, end_time)
         files_queue = []
 
-        for root, _, files in os.walk(self.root + "/" + cls.Meta.table):
-            for file in files:
-                filename = root + "/" + file
-                if lookup.should_visit_file(filename):
-                    files_queue.append(filename)
-
-        files_queue.sort()
-        for filename in files_queue:
-            print("traversing", filename)
-            timestream_file = TimeStreamFile(filename, binary_struct.fmt)
-            for binary_entry in timestream_file.entries(end_time):
-                yield binary_struct.decode_point(binary_entry)
-        return []
+        for directory in (
+            os.path.join(self.root, cls.Meta.table),
+            os.path.join(self.root, SEGMENTS_DIRECTORY, cls.Meta.table),
+        ):
+            for root, _, files in os.walk(directory):
+                for file in files:
+                    partition = lookup.partition(
+                        os.path.relpath(os.path.join(root, file), self.root)
+                    )
+                    if partition is not None:
+                        files_queue.append(partition)
+
+        files_queue.sort(key=lambda partition: (partition.date, partition.path))
+        return files_queue
 
     def filename(self, point: "TimeSeries") -> Path:
         dimensions = []
         if "dimensions" in self.filepath_format:
             for dimension_name in point.Meta.dimensions:
                 dimensions.append(dimension_name)
-                dimensions.append(str(point.data.dimensions[dimension_name]))
+                dimensions.append(str(getattr(point, dimension_name)))
 
         file_dir = Path(
             self.filepath_format.format(
@@ -99,44 +718,216 @@ class FileSystemBackend(Backend):
         return self.root / file_dir
 
     def timestream_file(self, path: str, struct_fmt: str) -> "TimeStreamFile":
-        if path not in self.opened_files:
-            self.opened_files[path] = TimeStreamFile(path, struct_fmt)
+        if path in self.opened_files:
+            self.opened_files.move_to_end(path)
+        else:
+            while len(self.opened_files) >= self.max_open_files:
+                self.evict()
+            self.opened_files[path] = self.open_file(path, struct_fmt)
 
         return self.opened_files[path]
 
+    def evict(self) -> None:
+        """Commits the least recently used file, which flushes its pending points
+        and closes the handle. The catalog is updated in memory and gets saved on
+        the next commit()"""
+        with self.lock:
+            path, file_obj = self.opened_files.popitem(last=False)
+            table, partition = self.opened_partitions.pop(path)
+            print(f"evicting {path}")
+
+            self.pending_entries -= len(file_obj.new_entries)
+            self.commit_file(table, partition, file_obj, self.updated_catalogs)
+
+    def open_file(
+        self, path: str, struct_fmt: str, read_only: bool = False
+    ) -> "TimeStreamFile":
+        """Opens the partition file. Unless it's read only, the file is created if
+        it does not exist and it's locked against the compaction until closed"""
+        if self.file_format == FILE_FORMAT_COMPRESSED:
+            return CompressedTimeStreamFile(
+                path,
+                struct_fmt,
+                block_entries=self.block_entries,
+                read_only=read_only,
+            )
+        return TimeStreamFile(
+            path, struct_fmt, self.commit_strategy, read_only=read_only
+        )
+
+    def is_busy(self, filename: str) -> bool:
+        """Tells whether the partition file has points which were not committed yet
+        or whether a query is going to read it. Has to be called with the lock
+        held"""
+        if filename in self.opened_partitions or filename in self.readers:
+            return True
+        return any(
+            filename in memtable for memtable in self.sealed_memtables + [self.memtable]
+        )
+
+    def compact(self, cls: Type["TimeSeries"]) -> None:
+        with self.compaction_lock:
+            compacted = self.compactor.run(cls)
+        print(f"compacted {compacted} segments of {cls.Meta.table}")
+
+    def catalog(self, table: str) -> "Catalog":
+        if table not in self.catalogs:
+            self.catalogs[table] = Catalog(self.root, table)
+
+        return self.catalogs[table]
+
+    def bootstrap_catalog(self, table: str, struct_fmt: str) -> None:
+        """Populates the catalog from the files that were written before the catalog
+        existed. The dimensions can only be recovered from the path when the default
+        path format is used."""
+        catalog = self.catalog(table)
+        table_root = os.path.join(self.root, table)
+        if catalog.exists() or not os.path.exists(table_root):
+            return
+
+        if self.filepath_format != FILESYSTEM_FILEPATH_FORMAT_DEFAULT:
+            print(f"cannot bootstrap the catalog of {table} with a custom path format")
+            return
+
+        for root, _, files in os.walk(table_root):
+            for file in files:
+                filename = os.path.join(root, file)
+                path = os.path.relpath(filename, self.root)
+                path_parts = path.split(os.sep)
+                try:
+                    year, month, day = map(int, path_parts[-3:])
+                except ValueError:
+                    continue
+
+                dimension_parts = path_parts[1:-3]
+                timestream_file = self.open_file(filename, struct_fmt, read_only=True)
+                summary = timestream_file.summary()
+                timestream_file.file.close()
+                catalog.update(
+                    Partition(
+                        path=path,
+                        dimensions=dict(
+                            zip(dimension_parts[::2], dimension_parts[1::2])
+                        ),
+                        date=f"{year:04d}-{month:02d}-{day:02d}",
+                        entries=summary.entries,
+                        min_timestamp=summary.min_timestamp,
+                        max_timestamp=summary.max_timestamp,
+                    )
+                )
+
+        # the compacted segments, in case the catalog was lost
+        segments_root = os.path.join(self.root, SEGMENTS_DIRECTORY, table)
+        for root, _, files in os.walk(segments_root):
+            for file in files:
+                filename = os.path.join(root, file)
+                partition = parse_segment_path(os.path.relpath(filename, self.root))
+                if partition is None:
+                    continue
+                timestream_file = self.open_file(filename, struct_fmt, read_only=True)
+                summary = timestream_file.summary()
+                timestream_file.file.close()
+                partition.entries = summary.entries
+                partition.min_timestamp = summary.min_timestamp
+                partition.max_timestamp = summary.max_timestamp
+                catalog.update(partition)
+
+    def commit_file(
+        self,
+        table: str,
+        partition: "Partition",
+        timestream_file: "TimeStreamFile",
+        updated_catalogs: Dict[str, "Catalog"],
+    ) -> None:
+        """Commits the file and updates its catalog entry. The catalog itself is not
+        saved, that's up to the caller"""
+        if table not in updated_catalogs:
+            self.bootstrap_catalog(table, timestream_file.fmt)
+            updated_catalogs[table] = self.catalog(table)
+
+        summary = timestream_file.commit()
+        partition.entries = summary.entries
+        partition.min_timestamp = summary.min_timestamp
+        partition.max_timestamp = summary.max_timestamp
+        updated_catalogs[table].update(partition)
+
     def commit(self):
-        for _, file_obj in self.opened_files.items():
-            file_obj.commit()
+        if self.wal is not None:
+            # fold everything that's left in the log and stop the background threads
+            self.checkpointer_stopped.set()
+            self.checkpointer.join()
+            self.checkpoint()
+            self.wal.close()
+            self.wal = None
+            self.log_directory.release()
+            self.log_directory = None
+
+        with self.lock:
+            for path, file_obj in self.opened_files.items():
+                table, partition = self.opened_partitions[path]
+                self.commit_file(table, partition, file_obj, self.updated_catalogs)
+
+            for catalog in self.updated_catalogs.values():
+                catalog.save()
+
+        self.opened_files = OrderedDict()
+        self.opened_partitions = {}
+        self.pending_entries = 0
+        self.updated_catalogs = {}
 
 
 class TimeStreamFileLookup:
+    """Finds the partition files by their path, when there's no catalog. The
+    dimension values are parsed from the name / value pairs of the path, which
+    works with any path format that includes {dimensions}."""
+
     def __init__(
         self,
         cls: Type["TimeSeries"],
-        dimensions: Dict[str, Any],
+        predicates: Dict[str, Optional[Set[str]]],
         start_time: datetime,
         end_time: Optional[datetime] = None,
     ):
-        dimensions_path = []
-        for dimension_name in cls.Meta.dimensions:
-            dimensions_path.append(dimension_name)
-            dimensions_path.append(str(dimensions[dimension_name]))
-
-        self.dimensions_path_str = "/".join(dimensions_path)
+        self.dimension_names = list(cls.Meta.dimensions)
+        self.predicates = predicates
         self.start_time = start_time
         self.end_time = end_time
 
-    def should_visit_file(self, filename: str) -> bool:
-        filename_parts = filename.split("/")
-        date_parts = list(map(int, filename_parts[-3:]))
-        # print(date_parts)
-        file_date = datetime(*date_parts).replace(tzinfo=pytz.utc)
-        should_visit = (
-            self.dimensions_path_str in filename and file_date >= self.start_time
-        )
-        if self.end_time is not None:
-            should_visit = should_visit and file_date < self.end_time + timedelta(
-                days=1
-            )
+    def partition(self, path: str) -> Optional["Partition"]:
+        partition = parse_segment_path(path)
+        if partition is None:
+            partition = self.daily_partition(path)
+        if partition is None:
+            return None
+
+        # the file holds the points of a whole day (or month / year, if it was
+        # compacted), therefore it has to be visited if the period ends after
+        # the start_time.
+        start = date.fromisoformat(partition.date)
+        period_start = datetime.combine(start, time(), pytz.utc)
+        period_stop = datetime.combine(
+            period_end(partition.level, start), time(), pytz.utc
+        )
+        if period_stop <= self.start_time:
+            return None
+        if self.end_time is not None and period_start > self.end_time:
+            return None
+
+        if not matches_dimensions(partition.dimensions, self.predicates):
+            return None
+        return partition
+
+    def daily_partition(self, path: str) -> Optional["Partition"]:
+        path_parts = path.split(os.sep)
+        try:
+            file_date = date(*map(int, path_parts[-3:]))
+        except (TypeError, ValueError):
+            # not a partition file (i.e. a leftover temporary segment)
+            return None
+
+        dimensions = {}
+        for index, part in enumerate(path_parts[:-4]):
+            if part in self.dimension_names and part not in dimensions:
+                dimensions[part] = path_parts[index + 1]
 
-        return should_visit
+        return Partition(path=path, dimensions=dimensions, date=file_date.isoformat())
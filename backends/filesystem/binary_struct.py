@@ -1,23 +1,44 @@
 import struct
 from enum import Enum
-from typing import TYPE_CHECKING, Any, Dict, List, Type
+from operator import attrgetter
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, List, Tuple, Type
 
 from pydantic import ConstrainedDecimal, ConstrainedStr
 
-from .codecs import Codec, DecimalCodec, EnumCodec, FloatCodec, IntCodec, StringCodec
+from .codecs import (
+    Codec,
+    DecimalCodec,
+    EnumCodec,
+    FloatCodec,
+    IntCodec,
+    StringCodec,
+    TimestampCodec,
+)
 
 if TYPE_CHECKING:
+    import numpy as np
     from schema import TimeSeries
 
 
 class BinaryStruct:
     fmt: str
+    struct: struct.Struct
     codec_by_field: Dict[str, Codec]
     codec_by_index: List[Codec]
     data_type: Type["TimeSeries"]
-
-    def __init__(self, data_type: Type["TimeSeries"], endianess: str) -> None:
+    # whether the decoded points can skip pydantic's validation, because the
+    # binary data was written by us in the first place
+    trusted: bool
+    # per-field functions, which return the value to pack from the point
+    encoders: List[Callable[["TimeSeries"], Any]]
+    decoders: List[Callable[[Any], Any]]
+    field_names: List[str]
+
+    def __init__(
+        self, data_type: Type["TimeSeries"], endianess: str, trusted: bool = False
+    ) -> None:
         self.data_type = data_type
+        self.trusted = trusted
         self.codec_by_field = {}
         self.codec_by_index = []
         # timestamp field, which always comes first
@@ -29,7 +50,7 @@ class BinaryStruct:
             field_info = model_field.field_info
 
             if model_field.name == "timestamp":
-                codec_class = IntCodec
+                codec_class = TimestampCodec
             elif issubclass(model_field.type_, ConstrainedStr):
                 codec_class = StringCodec
             elif issubclass(model_field.type_, ConstrainedDecimal):
@@ -52,31 +73,113 @@ class BinaryStruct:
 
             self.fmt += codec.fmt
 
-    def decode_point(self, data: bytes) -> Dict[str, Any]:
+        self.struct = struct.Struct(self.fmt)
+
+        self.field_names = [codec.model_field.name for codec in self.codec_by_index]
+        self.decoders = [codec.decode for codec in self.codec_by_index]
+        self.encoders = [
+            self.field_encoder(name, codec)
+            for name, codec in zip(self.field_names, self.codec_by_index)
+        ]
+
+    @staticmethod
+    def field_encoder(name: str, codec: Codec) -> Callable[["TimeSeries"], Any]:
+        get_value = attrgetter(name)
+        if type(codec).encode is Codec.encode:
+            # the value does not have to be converted
+            return get_value
+
+        encode = codec.encode
+
+        def encoder(point: "TimeSeries") -> Any:
+            return encode(get_value(point))
+
+        return encoder
+
+    def decode_point(self, data: bytes) -> "TimeSeries":
         """This method first decodes the whole binary payload according to the structore's
         fmt. However this is not the end as we're serializing some high-level python
         data types as more primitive. Therefore we need to pass these values by codecs
         and only then can we return the appropriate type"""
-        _raw_data = struct.unpack(self.fmt, data)
-        _dict = {}
-        for index, codec in enumerate(self.codec_by_index):
-            _dict[codec.model_field.name] = codec.decode(_raw_data[index])
+        return self.decode_values(self.struct.unpack(data))
+
+    def decode_values(self, _raw_data: Tuple[Any, ...]) -> "TimeSeries":
+        """Same as decode_point(), but for the values that were already unpacked"""
+        _dict = {
+            name: decode(value)
+            for name, decode, value in zip(self.field_names, self.decoders, _raw_data)
+        }
 
+        if self.trusted:
+            return self.data_type.construct(**_dict)
         return self.data_type(**_dict)
 
+    def decode_many(self, rows: Iterable[Tuple[Any, ...]]) -> Iterable["TimeSeries"]:
+        """Decodes the unpacked values of many points"""
+        field_names = self.field_names
+        decoders = self.decoders
+        if self.trusted:
+            create = self.data_type.construct
+        else:
+            create = self.data_type
+
+        for row in rows:
+            yield create(
+                **{
+                    name: decode(value)
+                    for name, decode, value in zip(field_names, decoders, row)
+                }
+            )
+
+    def decode_fields(
+        self, rows: Iterable[Tuple[Any, ...]], fields: List[str]
+    ) -> Iterable[Dict[str, Any]]:
+        """Decodes just the timestamp and the requested fields of the unpacked values
+        into dicts. The codecs of the remaining fields are not called at all."""
+        projection = [(0, "timestamp", self.decoders[0])]
+        for field in fields:
+            if field not in self.codec_by_field:
+                raise ValueError(f"Unknown field {field} of {self.data_type.__name__}")
+            if field == "timestamp":
+                continue
+            index = self.field_names.index(field)
+            projection.append((index, field, self.decoders[index]))
+
+        for row in rows:
+            yield {name: decode(row[index]) for index, name, decode in projection}
+
+    def dtype(self) -> "np.dtype":
+        """Returns the numpy structured type which corresponds to the fmt, so that
+        the files can be loaded with numpy directly"""
+        import numpy as np
+
+        endianess = self.fmt[0]
+        return np.dtype(
+            [
+                (codec.model_field.name, codec.dtype(endianess))
+                for codec in self.codec_by_index
+            ]
+        )
+
+    def decode_array(self, array: "np.ndarray") -> Dict[str, "np.ndarray"]:
+        """Vectorized counterpart of decode_values(). Returns a dict of columns, each
+        of which was passed by the codec's decode_array()"""
+        columns = {}
+        for codec in self.codec_by_index:
+            values = array[codec.model_field.name]
+            columns[codec.model_field.name] = codec.decode_array(values)
+
+        return columns
+
     def encode_point(self, point: "TimeSeries") -> bytes:
         """This method encodes the point as specified by the struct fmt.
 
         It passes each field by the codec to convert the internal python type into
         one of the base types used for binary representation"""
-        raw_data = [int(point.timestamp.timestamp())]
-
-        data = point.dict()
-        data.pop("timestamp")
-
-        for field, value in data.items():
-            raw_data.append(self.codec_by_field[field].encode(value))
-
-        print(f"fmt={self.fmt}; raw_data={raw_data}")
+        return self.struct.pack(*[encode(point) for encode in self.encoders])
 
-        return struct.pack(self.fmt, *raw_data)
+    def encode_many(self, points: Iterable["TimeSeries"]) -> List[bytes]:
+        """Encodes many points at once"""
+        pack = self.struct.pack
+        encoders = self.encoders
+        return [pack(*[encode(point) for encode in encoders]) for point in points]
@@ -1,63 +1,141 @@
 import os
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import BinaryIO, Dict
+from typing import BinaryIO, Dict, List, Optional
+
+# approximate size of a single page. The actual size is rounded down to the
+# whole number of entries so that an entry never spans two pages.
+PAGE_SIZE_DEFAULT = 16 * 1024
+# how much memory can be occupied by the cached pages
+MEMORY_BUDGET_DEFAULT = 16 * 1024 * 1024
 
 
 @dataclass
-class CacheEntry:
-    # file data at index
-    data: bytes
-    # this indicates whether the data was meant to be written
-    # or just read
+class Page:
+    # file data of the page. The last page of the file may be shorter
+    data: bytearray
+    # this indicates whether the page was modified and has to be written back
     modified: bool = False
 
 
 class Cache:
-    def __init__(self, file: BinaryIO, struct_size: int):
-        self.entries: Dict[int, CacheEntry] = {}
+    """Page cache of the file.
+
+    The file is read in pages of multiple entries, so that walking the file
+    (which is what the merge does) costs a single read per page rather than per
+    entry. The pages are evicted in the least recently used order once the memory
+    budget is exceeded; modified pages are written back upon eviction or sync(),
+    which coalesces adjacent pages into a single write."""
+
+    def __init__(
+        self,
+        file: BinaryIO,
+        struct_size: int,
+        page_size: int = PAGE_SIZE_DEFAULT,
+        memory_budget: int = MEMORY_BUDGET_DEFAULT,
+    ):
         self.file = file
         self.struct_size = struct_size
+        self.entries_per_page = max(1, page_size // struct_size)
+        self.page_size = self.entries_per_page * struct_size
+        self.max_pages = max(1, memory_budget // self.page_size)
+        self.pages: "OrderedDict[int, Page]" = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writes = 0
+
+    def page(self, page_number: int) -> Page:
+        page = self.pages.get(page_number)
+        if page is not None:
+            self.hits += 1
+            self.pages.move_to_end(page_number)
+            return page
+
+        self.misses += 1
+        self.file.seek(page_number * self.page_size, os.SEEK_SET)
+        page = Page(data=bytearray(self.file.read(self.page_size)))
+        self.pages[page_number] = page
+
+        while len(self.pages) > self.max_pages:
+            self.evict()
+
+        return page
+
+    def evict(self) -> None:
+        page_number, page = self.pages.popitem(last=False)
+        self.evictions += 1
+        if page.modified:
+            self.write(page_number, [page])
 
     def __getitem__(self, index: int) -> bytes:
-        print(f"get at index {index}")
-        if index not in self.entries:
-            self.file.seek(index * self.struct_size, os.SEEK_SET)
-            self.entries[index] = CacheEntry(
-                modified=False, data=self.file.read(self.struct_size)
-            )
-        return self.entries[index].data
+        page = self.page(index // self.entries_per_page)
+        offset = (index % self.entries_per_page) * self.struct_size
+        return bytes(page.data[offset : offset + self.struct_size])
 
     def __setitem__(self, index: int, content: bytes) -> None:
-        print(f"set {index} => {content}")
-        if index not in self.entries:
-            self.entries[index] = CacheEntry(modified=True, data=content)
-        else:
-            self.entries[index].modified = True
-            self.entries[index].data = content
+        page = self.page(index // self.entries_per_page)
+        offset = (index % self.entries_per_page) * self.struct_size
+        if len(page.data) < offset:
+            # the entry is past the end of the file
+            page.data.extend(bytes(offset - len(page.data)))
+        page.data[offset : offset + self.struct_size] = content
+        page.modified = True
 
     def swap(self, i: int, j: int) -> None:
         # swaps i'th position with j's position
         # please note that the algorithm merely gives us the index number, but
         # because we're sorting a file that has contents we need to read it
         # back by ourselves.
-        print(f"swap {i} with {j}")
         if i == j:
             return
 
         self[i], self[j] = self[j], self[i]
 
-    def sync(self, last_swap_index: int) -> None:
-        # because this is a last known swap index, we can remove all entries from cache
-        # that are based earlier than the last_swap_index as they won't be required
-        # anymore
-        # let's commit all the changes
-        print(f"sync called with last_swap_index={last_swap_index}")
-        for index, entry in self.entries.items():
-            if entry.modified:
-                self.file.seek(index * self.struct_size, os.SEEK_SET)
-                print(f"write {entry.data} at {index*self.struct_size}")
-                self.file.write(entry.data)
-                entry.modified = False
-
-        for index in range(last_swap_index):
-            self.entries.pop(index, None)
+    def write(self, first_page_number: int, pages: List[Page]) -> None:
+        self.file.seek(first_page_number * self.page_size, os.SEEK_SET)
+        self.file.write(b"".join(page.data for page in pages))
+        self.writes += 1
+        for page in pages:
+            page.modified = False
+
+    def sync(self, last_swap_index: Optional[int] = None) -> None:
+        """Writes the modified pages back to the file. Adjacent pages are written
+        with a single write, in the file order.
+
+        Pages which end before the last_swap_index won't be required anymore,
+        therefore they're dropped from the cache."""
+        modified_pages = sorted(
+            page_number for page_number, page in self.pages.items() if page.modified
+        )
+
+        run: List[Page] = []
+        run_start = 0
+        for page_number in modified_pages:
+            page = self.pages[page_number]
+            if run and (
+                page_number != run_start + len(run)
+                or len(run[-1].data) < self.page_size
+            ):
+                self.write(run_start, run)
+                run = []
+            if not run:
+                run_start = page_number
+            run.append(page)
+        if run:
+            self.write(run_start, run)
+
+        if last_swap_index is not None:
+            for page_number in list(self.pages):
+                if (page_number + 1) * self.entries_per_page <= last_swap_index:
+                    del self.pages[page_number]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "writes": self.writes,
+            "pages": len(self.pages),
+        }
@@ -0,0 +1,322 @@
+import fcntl
+import json
+import os
+import threading
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from itertools import product
+from typing import Dict, Iterable, Iterator, List, Optional, Set
+from urllib.parse import quote, unquote
+
+CATALOG_DIRECTORY = ".catalog"
+CATALOG_SUFFIX = ".json"
+LOCK_SUFFIX = ".lock"
+# the name of the catalog of a table without dimensions
+NO_DIMENSIONS = "_"
+
+# what period of time the partition covers. The daily partitions are written by
+# the backend, the coarser ones by the compaction
+LEVEL_DAY = "day"
+LEVEL_MONTH = "month"
+LEVEL_YEAR = "year"
+LEVELS = (LEVEL_DAY, LEVEL_MONTH, LEVEL_YEAR)
+
+
+@dataclass
+class Partition:
+    # path of the partition file, relative to the backend's root
+    path: str
+    # dimension values of the series stored in the file (as used in the path)
+    dimensions: Dict[str, str] = field(default_factory=dict)
+    # first day of the partition, in iso format
+    date: str = ""
+    entries: int = 0
+    min_timestamp: Optional[int] = None
+    max_timestamp: Optional[int] = None
+    level: str = LEVEL_DAY
+
+    def overlaps(self, start_timestamp: float, end_timestamp: Optional[float]) -> bool:
+        if self.entries == 0:
+            return False
+        if self.max_timestamp < start_timestamp:
+            return False
+        return end_timestamp is None or self.min_timestamp <= end_timestamp
+
+
+def series_name(dimensions: Dict[str, str]) -> str:
+    """Name of the catalog file of the series, i.e. city=Prague"""
+    return (
+        "&".join(
+            f"{quote(name, safe='')}={quote(value, safe='')}"
+            for name, value in sorted(dimensions.items())
+        )
+        or NO_DIMENSIONS
+    )
+
+
+def parse_series_name(name: str) -> Dict[str, str]:
+    if name == NO_DIMENSIONS:
+        return {}
+    dimensions = {}
+    for pair in name.split("&"):
+        dimension_name, _, value = pair.partition("=")
+        dimensions[unquote(dimension_name)] = unquote(value)
+    return dimensions
+
+
+class SeriesCatalog:
+    """Partitions of a single series, kept in their own json file.
+
+    Several backends (even in different processes) may share the file, therefore
+    only the changes made by this instance are saved, merged into the file under
+    its lock."""
+
+    def __init__(self, filename: str, dimensions: Dict[str, str]):
+        self.filename = filename
+        self.dimensions = dimensions
+        self.partitions: Dict[str, Partition] = {}
+        self.loaded_mtime: Optional[int] = None
+        # changes which were not saved yet
+        self.updated: Dict[str, Partition] = {}
+        self.removed: Set[str] = set()
+        # the partitions with some entries ordered by the min timestamp, along
+        # with the running max of their max timestamps, see lookup()
+        self.ordered: Optional[List[Partition]] = None
+        self.min_timestamps: List[int] = []
+        self.max_timestamps: List[int] = []
+        # the file lock is held by one thread at a time, see locked()
+        self.thread_lock = threading.RLock()
+        self.lock_file = None
+        self.lock_depth = 0
+        self.load()
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self.updated or self.removed)
+
+    def load(self) -> None:
+        """Reads the catalog from the disk, the unsaved changes are kept on top"""
+        self.partitions = {}
+        self.loaded_mtime = None
+        self.ordered = None
+        if os.path.exists(self.filename):
+            with open(self.filename, "r") as catalog_file:
+                self.loaded_mtime = os.fstat(catalog_file.fileno()).st_mtime_ns
+                content = json.load(catalog_file)
+
+            for partition in content["partitions"]:
+                self.partitions[partition["path"]] = Partition(**partition)
+
+        for path in self.removed:
+            self.partitions.pop(path, None)
+        self.partitions.update(self.updated)
+
+    def refresh(self) -> None:
+        """Reloads the catalog if it was modified by someone else in the meantime"""
+        try:
+            mtime = os.stat(self.filename).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime != self.loaded_mtime:
+            self.load()
+
+    @contextmanager
+    def locked(self) -> Iterator[None]:
+        """Holds the exclusive lock of the catalog, which is shared with the other
+        processes. The lock is reentrant within the process"""
+        with self.thread_lock:
+            if self.lock_depth == 0:
+                os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+                self.lock_file = open(self.filename + LOCK_SUFFIX, "a")
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            self.lock_depth += 1
+            try:
+                yield
+            finally:
+                self.lock_depth -= 1
+                if self.lock_depth == 0:
+                    fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+                    self.lock_file.close()
+                    self.lock_file = None
+
+    def save(self, root: str) -> None:
+        """Merges the changes into the catalog on the disk. The partitions whose
+        files are gone in the meantime (compacted by another process) are not
+        brought back."""
+        with self.locked():
+            for path in list(self.updated):
+                if not os.path.exists(os.path.join(root, path)):
+                    del self.updated[path]
+            self.load()
+            self.write()
+            self.updated = {}
+            self.removed = set()
+
+    def write(self) -> None:
+        content = {
+            "dimensions": self.dimensions,
+            "partitions": [
+                asdict(self.partitions[path]) for path in sorted(self.partitions)
+            ],
+        }
+        # write the catalog aside and swap it in, so that the readers never see
+        # a partially written file
+        temporary_filename = self.filename + ".tmp"
+        with open(temporary_filename, "w") as catalog_file:
+            json.dump(content, catalog_file)
+        os.replace(temporary_filename, self.filename)
+        self.loaded_mtime = os.stat(self.filename).st_mtime_ns
+
+    def update(self, partition: Partition) -> None:
+        self.partitions[partition.path] = partition
+        self.updated[partition.path] = partition
+        self.removed.discard(partition.path)
+        self.ordered = None
+
+    def remove(self, path: str) -> None:
+        self.partitions.pop(path, None)
+        self.updated.pop(path, None)
+        self.removed.add(path)
+        self.ordered = None
+
+    def lookup(
+        self, start_timestamp: float, end_timestamp: Optional[float] = None
+    ) -> List[Partition]:
+        """Returns the partitions which hold points from the given range, ordered by
+        time. The partitions before the first one whose running max timestamp
+        reaches the start can't overlap the range, neither can those starting
+        after the end, so only the ones in between are checked."""
+        if self.ordered is None:
+            self.ordered = sorted(
+                (
+                    partition
+                    for partition in self.partitions.values()
+                    if partition.entries > 0
+                ),
+                key=lambda partition: (partition.min_timestamp, partition.path),
+            )
+            self.min_timestamps = [
+                partition.min_timestamp for partition in self.ordered
+            ]
+            self.max_timestamps = []
+            max_timestamp = None
+            for partition in self.ordered:
+                if max_timestamp is None or partition.max_timestamp > max_timestamp:
+                    max_timestamp = partition.max_timestamp
+                self.max_timestamps.append(max_timestamp)
+
+        first = bisect_left(self.max_timestamps, start_timestamp)
+        last = len(self.ordered)
+        if end_timestamp is not None:
+            last = bisect_right(self.min_timestamps, end_timestamp)
+        return [
+            partition
+            for partition in self.ordered[first:last]
+            if partition.overlaps(start_timestamp, end_timestamp)
+        ]
+
+
+class Catalog:
+    """Persistent list of the partitions of a single table.
+
+    Because the catalog knows the dimension values and the time range of every
+    partition file, the query can go straight to the relevant files instead of
+    walking the whole directory tree of the table and it does not depend on the
+    path format either.
+
+    The catalog is split by the series: each one has its own json file under the
+    root's .catalog/<table> directory (see SeriesCatalog), which is updated each
+    time the backend commits the data of the series. Therefore both a commit and
+    a query only read and write the files of the series they touch, no matter how
+    many series the table has."""
+
+    def __init__(self, root: str, table: str):
+        self.root = root
+        self.table = table
+        self.directory = os.path.join(root, CATALOG_DIRECTORY, table)
+        self.series: Dict[str, SeriesCatalog] = {}
+
+    @property
+    def dirty(self) -> bool:
+        return any(series.dirty for series in self.series.values())
+
+    def exists(self) -> bool:
+        return os.path.exists(self.directory)
+
+    def series_catalog(self, dimensions: Dict[str, str]) -> SeriesCatalog:
+        return self.named_series_catalog(series_name(dimensions))
+
+    def named_series_catalog(self, name: str) -> SeriesCatalog:
+        series = self.series.get(name)
+        if series is None:
+            series = SeriesCatalog(
+                os.path.join(self.directory, name + CATALOG_SUFFIX),
+                parse_series_name(name),
+            )
+            self.series[name] = series
+        return series
+
+    def list_series(self) -> Set[str]:
+        """Returns the names of all the series, including the ones which were not
+        saved yet"""
+        names = set(self.series)
+        if self.exists():
+            names.update(
+                filename[: -len(CATALOG_SUFFIX)]
+                for filename in os.listdir(self.directory)
+                if filename.endswith(CATALOG_SUFFIX)
+            )
+        return names
+
+    def partitions(self) -> Iterable[Partition]:
+        """Yields the partitions of all the series"""
+        for name in sorted(self.list_series()):
+            series = self.named_series_catalog(name)
+            series.refresh()
+            yield from series.partitions.values()
+
+    def save(self) -> None:
+        """Saves the series which were changed"""
+        for series in list(self.series.values()):
+            if series.dirty:
+                series.save(self.root)
+
+    def update(self, partition: Partition) -> None:
+        self.series_catalog(partition.dimensions).update(partition)
+
+    def lookup(
+        self,
+        dimensions: Dict[str, Optional[Set[str]]],
+        start_timestamp: float,
+        end_timestamp: Optional[float] = None,
+    ) -> List[Partition]:
+        """Returns partitions of the series (whose dimension values are among the
+        allowed ones, None allowing any value) which hold points from the given
+        range, ordered by time"""
+        if all(allowed is not None for allowed in dimensions.values()):
+            # the series are known, there's no need to list them
+            names = {
+                series_name(dict(zip(dimensions, values)))
+                for values in product(*dimensions.values())
+            }
+        else:
+            names = self.list_series()
+
+        partitions = []
+        for name in names:
+            series_dimensions = parse_series_name(name)
+            if not all(
+                allowed is None or series_dimensions.get(dimension_name) in allowed
+                for dimension_name, allowed in dimensions.items()
+            ):
+                continue
+            series = self.named_series_catalog(name)
+            series.refresh()
+            partitions.extend(series.lookup(start_timestamp, end_timestamp))
+
+        partitions.sort(key=lambda partition: (partition.min_timestamp, partition.path))
+        return partitions
+
+    def absolute_path(self, partition: Partition) -> str:
+        return os.path.join(self.root, partition.path)
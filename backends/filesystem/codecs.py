@@ -1,10 +1,26 @@
+from datetime import datetime, timezone
 from decimal import Decimal
 from enum import Enum
 from typing import TYPE_CHECKING, Any, Type
 
 if TYPE_CHECKING:
+    import numpy as np
     from pydantic.fields import FieldInfo, ModelField
 
+# numpy counterparts of the struct format characters used by the codecs
+NUMPY_TYPES = {
+    "b": "i1",
+    "B": "u1",
+    "h": "i2",
+    "H": "u2",
+    "i": "i4",
+    "I": "u4",
+    "q": "i8",
+    "Q": "u8",
+    "f": "f4",
+    "d": "f8",
+}
+
 
 class Codec:
     """The codec struct is used for encoding raw python values into more
@@ -45,6 +61,15 @@ class Codec:
         """The default implementation does not touch the value"""
         return value
 
+    def dtype(self, endianess: str) -> str:
+        """Returns the numpy type which corresponds to the codec's fmt"""
+        return endianess + NUMPY_TYPES[self.fmt]
+
+    def decode_array(self, values: "np.ndarray") -> "np.ndarray":
+        """Vectorized counterpart of decode(), which operates on the whole column.
+        The default implementation does not touch the values"""
+        return values
+
 
 class StringCodec(Codec):
     def init(self) -> str:
@@ -56,6 +81,15 @@ class StringCodec(Codec):
     def decode(self, value: bytes) -> str:
         return value.replace(b"\x00", b"").decode("utf-8")
 
+    def dtype(self, endianess: str) -> str:
+        return f"S{self.field_info.max_length}"
+
+    def decode_array(self, values: "np.ndarray") -> "np.ndarray":
+        import numpy as np
+
+        # numpy already strips the trailing null bytes of the "S" type
+        return np.char.decode(values, "utf-8")
+
 
 class DecimalCodec(Codec):
     def init(self):
@@ -74,6 +108,11 @@ class DecimalCodec(Codec):
     def decode(self, value: int) -> Decimal:
         return Decimal(str(value / 10**self.field_info.decimal_places))
 
+    def decode_array(self, values: "np.ndarray") -> "np.ndarray":
+        # constructing a Decimal per value is exactly what we want to avoid here,
+        # therefore the column is scaled into floats.
+        return values / 10**self.field_info.decimal_places
+
 
 class EnumCodec(Codec):
     fmt = "H"
@@ -81,10 +120,36 @@ class EnumCodec(Codec):
     def encode(self, value: Enum) -> int:
         return value.value
 
+    def decode(self, value: int) -> Enum:
+        return self.model_field.type_(value)
+
+    def decode_array(self, values: "np.ndarray") -> "np.ndarray":
+        import numpy as np
+
+        members = list(self.model_field.type_)
+        lookup = np.empty(max(member.value for member in members) + 1, dtype=object)
+        for member in members:
+            lookup[member.value] = member
+
+        return lookup[values]
+
 
 class IntCodec(Codec):
     fmt = "I"
 
 
+class TimestampCodec(IntCodec):
+    """The timestamp is stored as the number of seconds since the epoch"""
+
+    def encode(self, value: datetime) -> int:
+        return int(value.timestamp())
+
+    def decode(self, value: int) -> datetime:
+        return datetime.fromtimestamp(value, timezone.utc)
+
+    def decode_array(self, values: "np.ndarray") -> "np.ndarray":
+        return values.astype("datetime64[s]")
+
+
 class FloatCodec(Codec):
     fmt = "f"
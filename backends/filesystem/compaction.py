@@ -0,0 +1,338 @@
+import fcntl
+import heapq
+import os
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta, timezone
+from operator import itemgetter
+from typing import (
+    TYPE_CHECKING,
+    BinaryIO,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Type,
+)
+
+from .catalog import LEVEL_MONTH, LEVEL_YEAR, LEVELS, LOCK_SUFFIX, Partition
+
+if TYPE_CHECKING:
+    from schema import TimeSeries
+
+    from .backend import FileSystemBackend
+
+# the compacted segments are kept aside of the daily partitions, so that the
+# path format of the partitions does not matter
+SEGMENTS_DIRECTORY = ".segments"
+COMPACTION_SUFFIX = ".compact"
+
+# day partitions which ended more than 2 days ago are merged into monthly segments
+COMPACTION_TIERS_DEFAULT = "month:2"
+
+
+class CompactionTier(NamedTuple):
+    # level of the segments this tier produces
+    level: str
+    # partitions are compacted once their period ended at least this long ago
+    min_age: timedelta
+
+
+def parse_tiers(tiers: str) -> List[CompactionTier]:
+    """Parses the tiering policy, i.e. "month:2,year:60" merges the days into
+    months two days after the day ends and then the months into years 60 days
+    after the month ends"""
+    result = []
+    for tier in tiers.split(","):
+        level, _, min_age_days = tier.strip().partition(":")
+        if level not in (LEVEL_MONTH, LEVEL_YEAR):
+            raise ValueError(f"Unknown compaction level: {level}")
+        min_age = timedelta(days=float(min_age_days or 0))
+        result.append(CompactionTier(level=level, min_age=min_age))
+    return sorted(result, key=lambda tier: LEVELS.index(tier.level))
+
+
+def period_start(level: str, day: date) -> date:
+    if level == LEVEL_YEAR:
+        return day.replace(month=1, day=1)
+    if level == LEVEL_MONTH:
+        return day.replace(day=1)
+    return day
+
+
+def period_end(level: str, start: date) -> date:
+    if level == LEVEL_YEAR:
+        return start.replace(year=start.year + 1)
+    if level == LEVEL_MONTH:
+        if start.month == 12:
+            return start.replace(year=start.year + 1, month=1)
+        return start.replace(month=start.month + 1)
+    return start + timedelta(days=1)
+
+
+def segment_path(
+    table: str, dimensions: Dict[str, str], level: str, start: date
+) -> str:
+    # months and years are kept apart, as the months are subdirectories of the year
+    parts = [SEGMENTS_DIRECTORY, table, level]
+    for dimension_name, dimension_value in dimensions.items():
+        parts.extend([dimension_name, dimension_value])
+    parts.append(str(start.year))
+    if level == LEVEL_MONTH:
+        parts.append(f"{start.month:02d}")
+    return os.path.join(*parts)
+
+
+def parse_segment_path(path: str) -> Optional[Partition]:
+    """Recovers the partition from the path of the segment (relative to the root)"""
+    parts = path.split(os.sep)
+    if len(parts) < 4 or parts[0] != SEGMENTS_DIRECTORY:
+        return None
+    level = parts[2]
+    if level not in (LEVEL_MONTH, LEVEL_YEAR):
+        return None
+    # the dimensions come in name / value pairs, followed by the year (and month)
+    parts = parts[3:]
+    period_parts = parts[-1:] if level == LEVEL_YEAR else parts[-2:]
+    try:
+        start = date(*map(int, period_parts), *([1] * (3 - len(period_parts))))
+    except ValueError:
+        # not a segment (i.e. a leftover of an interrupted compaction)
+        return None
+    dimension_parts = parts[: -len(period_parts)]
+    return Partition(
+        path=path,
+        dimensions=dict(zip(dimension_parts[::2], dimension_parts[1::2])),
+        date=start.isoformat(),
+        level=level,
+    )
+
+
+@dataclass
+class CompactionTask:
+    table: str
+    level: str
+    # the segment the partitions are merged into (which may exist already)
+    target: Partition
+    sources: List[Partition] = field(default_factory=list)
+
+
+class Compactor:
+    """Merges the sealed daily partitions of a series into monthly (or yearly)
+    segments, so that long-range queries open a handful of files instead of one
+    per day.
+
+    The segment is written aside and swapped in together with the catalog
+    update, under the backend's lock, and the merged partitions are removed right
+    after. Queries pick their files under the same lock, therefore they see
+    either the partitions or the segment, never both. Partitions which have
+    points waiting for the commit (or in the write-ahead log), or which a running
+    query is going to read, are left alone until the next run.
+
+    The other processes writing to the root are coordinated via file locks: the
+    writers hold a shared lock of the partition files they have opened, the swap
+    happens under the lock of the series' catalog and only one process compacts
+    a table at a time."""
+
+    def __init__(self, backend: "FileSystemBackend", tiers: List[CompactionTier]):
+        self.backend = backend
+        self.tiers = tiers
+
+    def plan(self, table: str, now: datetime) -> List[CompactionTask]:
+        """Assigns each partition to the coarsest tier it's old enough for and
+        groups the partitions by the series and the segment they belong to"""
+        catalog = self.backend.catalog(table)
+        tasks: Dict[str, CompactionTask] = {}
+
+        for partition in sorted(catalog.partitions(), key=lambda p: p.path):
+            if partition.entries == 0:
+                continue
+            start = date.fromisoformat(partition.date)
+            end = period_end(partition.level, start)
+            sealed_at = datetime(end.year, end.month, end.day, tzinfo=timezone.utc)
+
+            tier = None
+            for candidate in reversed(self.tiers):
+                if LEVELS.index(candidate.level) <= LEVELS.index(partition.level):
+                    break
+                if sealed_at + candidate.min_age <= now:
+                    tier = candidate
+                    break
+            if tier is None:
+                continue
+
+            target_start = period_start(tier.level, start)
+            path = segment_path(table, partition.dimensions, tier.level, target_start)
+            if path == partition.path:
+                continue
+            task = tasks.get(path)
+            if task is None:
+                series = catalog.series_catalog(partition.dimensions)
+                task = CompactionTask(
+                    table=table,
+                    level=tier.level,
+                    target=series.partitions.get(path)
+                    or Partition(
+                        path=path,
+                        dimensions=dict(partition.dimensions),
+                        date=target_start.isoformat(),
+                        level=tier.level,
+                    ),
+                )
+                tasks[path] = task
+            task.sources.append(partition)
+
+        return list(tasks.values())
+
+    def run(self, cls: Type["TimeSeries"], now: Optional[datetime] = None) -> int:
+        """Compacts the partitions of the table. Returns the number of segments
+        written"""
+        if now is None:
+            now = datetime.now(timezone.utc)
+        table = cls.Meta.table
+        fmt = self.backend.structs[cls].fmt
+
+        lock_filename = os.path.join(
+            self.backend.root, SEGMENTS_DIRECTORY, table + LOCK_SUFFIX
+        )
+        os.makedirs(os.path.dirname(lock_filename), exist_ok=True)
+        with open(lock_filename, "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                print(f"{table} is being compacted by another process")
+                return 0
+            return self.run_tasks(table, fmt, now)
+
+    def run_tasks(self, table: str, fmt: str, now: datetime) -> int:
+        with self.backend.lock:
+            self.backend.bootstrap_catalog(table, fmt)
+            tasks = self.plan(table, now)
+            catalog = self.backend.catalog(table)
+            if catalog.dirty:
+                catalog.save()
+
+        compacted = 0
+        for task in tasks:
+            try:
+                if self.compact(task, fmt):
+                    compacted += 1
+            except FileNotFoundError as error:
+                # the partition went away since the plan was made (i.e. another
+                # compaction got to it first); it will be planned again next time
+                print(f"skipping compaction of {task.target.path}: {error}")
+        return compacted
+
+    def compact(self, task: CompactionTask, fmt: str) -> bool:
+        backend = self.backend
+        # the segment and its sources belong to the same series
+        catalog = backend.catalog(task.table).series_catalog(task.target.dimensions)
+        target_filename = os.path.join(backend.root, task.target.path)
+
+        with backend.lock:
+            # partitions which are being written to are left for the next run
+            task.sources = [
+                partition
+                for partition in task.sources
+                if not backend.is_busy(os.path.join(backend.root, partition.path))
+                and not self.is_locked(partition)
+            ]
+            if not task.sources:
+                return False
+            sources = list(task.sources)
+            if task.target.path in catalog.partitions:
+                sources.append(catalog.partitions[task.target.path])
+
+            # the sources must not change until they're swapped for the segment
+            versions = {
+                partition.path: self.version(partition) for partition in sources
+            }
+            files = []
+            try:
+                for partition in sources:
+                    timestream_file = backend.open_file(
+                        os.path.join(backend.root, partition.path), fmt, read_only=True
+                    )
+                    files.append(timestream_file)
+                    timestream_file.snapshot()
+            except FileNotFoundError:
+                for timestream_file in files:
+                    timestream_file.close()
+                raise
+
+        print(f"compacting {len(task.sources)} partitions into {task.target.path}")
+        compaction_filename = target_filename + COMPACTION_SUFFIX
+        if os.path.exists(compaction_filename):
+            os.remove(compaction_filename)
+        segment = backend.open_file(compaction_filename, fmt)
+        try:
+            segment.write_rows(
+                segment.file,
+                heapq.merge(
+                    *(timestream_file.records() for timestream_file in files),
+                    key=itemgetter(0),
+                ),
+            )
+            segment.file.flush()
+            os.fsync(segment.file.fileno())
+            summary = segment.summary()
+        finally:
+            segment.close()
+            for timestream_file in files:
+                timestream_file.close()
+
+        locks: List[BinaryIO] = []
+        try:
+            with backend.lock, catalog.locked():
+                catalog.refresh()
+                if any(
+                    partition.path not in catalog.partitions
+                    or backend.is_busy(os.path.join(backend.root, partition.path))
+                    or not self.lock_source(partition, locks)
+                    or self.version(partition) != versions[partition.path]
+                    for partition in sources
+                ):
+                    print(f"sources of {task.target.path} changed, compaction aborted")
+                    os.remove(compaction_filename)
+                    return False
+
+                os.replace(compaction_filename, target_filename)
+                task.target.entries = summary.entries
+                task.target.min_timestamp = summary.min_timestamp
+                task.target.max_timestamp = summary.max_timestamp
+                catalog.update(task.target)
+                for partition in task.sources:
+                    catalog.remove(partition.path)
+                catalog.save(backend.root)
+                for partition in task.sources:
+                    os.remove(os.path.join(backend.root, partition.path))
+        finally:
+            # closing the files releases their locks
+            for lock_file in locks:
+                lock_file.close()
+
+        return True
+
+    def is_locked(self, partition: Partition) -> bool:
+        """Tells whether a writer in another process has the partition file opened"""
+        locks: List[BinaryIO] = []
+        try:
+            return not self.lock_source(partition, locks)
+        finally:
+            for lock_file in locks:
+                lock_file.close()
+
+    def lock_source(self, partition: Partition, locks: List[BinaryIO]) -> bool:
+        """Takes the exclusive lock of the partition file, which fails as long as
+        a writer (in any process) has the file opened"""
+        lock_file = open(os.path.join(self.backend.root, partition.path), "rb")
+        locks.append(lock_file)
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+    def version(self, partition: Partition) -> Tuple[int, int]:
+        stat = os.stat(os.path.join(self.backend.root, partition.path))
+        return stat.st_size, stat.st_mtime_ns
@@ -0,0 +1,357 @@
+import heapq
+import os
+import re
+import struct
+from datetime import datetime
+from operator import itemgetter
+from typing import TYPE_CHECKING, Any, Iterable, List, NamedTuple, Optional, Tuple
+
+from .timestream_file import COMMIT_STRATEGY_REWRITE, FileSummary, TimeStreamFile
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# how many points are stored in a single block
+BLOCK_ENTRIES_DEFAULT = 1024
+# payload size, number of entries, min timestamp, max timestamp
+BLOCK_HEADER = struct.Struct("<IHII")
+
+COLUMN_STRING = "s"
+COLUMN_FLOAT = ("e", "f", "d")
+
+timestamp_getter = itemgetter(0)
+
+
+class BlockHeader(NamedTuple):
+    # offset of the header within the file
+    offset: int
+    payload_size: int
+    entries: int
+    min_timestamp: int
+    max_timestamp: int
+
+    @property
+    def end(self) -> int:
+        return self.offset + BLOCK_HEADER.size + self.payload_size
+
+
+def struct_columns(fmt: str) -> List[str]:
+    """Splits the struct fmt into the format characters of the individual values"""
+    columns = []
+    for count, format_char in re.findall(r"(\d*)([a-zA-Z?])", fmt):
+        if format_char == COLUMN_STRING:
+            columns.append(COLUMN_STRING)
+        else:
+            columns.extend([format_char] * int(count or 1))
+    return columns
+
+
+def zigzag(value: int) -> int:
+    return value << 1 if value >= 0 else ((-value) << 1) - 1
+
+
+def unzigzag(value: int) -> int:
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+def encode_varint(value: int, output: bytearray) -> None:
+    while value > 0x7F:
+        output.append((value & 0x7F) | 0x80)
+        value >>= 7
+    output.append(value)
+
+
+def decode_varint(buffer: Any, offset: int) -> Tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        byte = buffer[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+class CompressedTimeStreamFile(TimeStreamFile):
+    """Alternative on-disk format of the partition, where the points are stored in
+    blocks of (up to) block_entries points rather than as fixed-width rows.
+
+    Each block starts with a small header (payload size, number of points and the
+    min / max timestamp), followed by the columns of the block:
+
+    - timestamps are stored as varint-encoded delta-of-deltas
+    - integer values (ints, Decimals, Enums) as zigzag varint deltas
+    - float values are XOR-ed with the previous value (like in Gorilla), with
+      the trailing zero bits stripped
+    - strings are stored once and then only when they change
+
+    Since the points are regularly spaced and the dimensions do not change within
+    the partition, most of the values shrink to a single byte.
+
+    The blocks cannot be swapped record by record, therefore the file is always
+    committed by rewriting the blocks that follow the oldest new point."""
+
+    def __init__(
+        self,
+        file: str,
+        fmt: str,
+        commit_strategy: str = COMMIT_STRATEGY_REWRITE,
+        block_entries: int = BLOCK_ENTRIES_DEFAULT,
+        read_only: bool = False,
+    ):
+        super().__init__(file, fmt, COMMIT_STRATEGY_REWRITE, read_only=read_only)
+        self.endianess = fmt[0]
+        self.columns = struct_columns(fmt[1:])
+        self.block_entries = min(block_entries, 0xFFFF)
+        self.blocks_index: Optional[List[BlockHeader]] = None
+
+    def __len__(self) -> int:
+        if self.file_entries is None:
+            self.file_entries = sum(block.entries for block in self.blocks())
+        return self.file_entries
+
+    def blocks(self) -> List[BlockHeader]:
+        """Reads the headers of all the blocks"""
+        if self.blocks_index is None:
+            self.blocks_index = []
+            self.file.seek(0, os.SEEK_END)
+            eof = self.file.tell()
+            if self.size_limit is not None:
+                eof = min(eof, self.size_limit)
+            offset = 0
+            while offset + BLOCK_HEADER.size <= eof:
+                self.file.seek(offset, os.SEEK_SET)
+                block = BlockHeader(
+                    offset, *BLOCK_HEADER.unpack(self.file.read(BLOCK_HEADER.size))
+                )
+                if block.end > eof:
+                    # being appended past the size limit
+                    break
+                self.blocks_index.append(block)
+                offset = block.end
+
+        return self.blocks_index
+
+    def encode_block(self, rows: List[Tuple[Any, ...]]) -> bytes:
+        payload = bytearray()
+
+        previous = rows[0][0]
+        previous_delta = 0
+        encode_varint(previous, payload)
+        for row in rows[1:]:
+            delta = row[0] - previous
+            encode_varint(zigzag(delta - previous_delta), payload)
+            previous = row[0]
+            previous_delta = delta
+
+        for column, format_char in enumerate(self.columns[1:], start=1):
+            if format_char == COLUMN_STRING:
+                previous_string = None
+                for row in rows:
+                    value = row[column].rstrip(b"\x00")
+                    if value == previous_string:
+                        encode_varint(0, payload)
+                    else:
+                        encode_varint(len(value) + 1, payload)
+                        payload += value
+                    previous_string = value
+            elif format_char in COLUMN_FLOAT:
+                float_struct = struct.Struct(self.endianess + format_char)
+                previous_bits = 0
+                for row in rows:
+                    bits = int.from_bytes(float_struct.pack(row[column]), "little")
+                    xor = bits ^ previous_bits
+                    if xor == 0:
+                        encode_varint(0, payload)
+                    else:
+                        trailing_zeros = (xor & -xor).bit_length() - 1
+                        encode_varint(
+                            ((xor >> trailing_zeros) << 6) | trailing_zeros, payload
+                        )
+                    previous_bits = bits
+            else:
+                previous = 0
+                for row in rows:
+                    encode_varint(zigzag(row[column] - previous), payload)
+                    previous = row[column]
+
+        header = BLOCK_HEADER.pack(len(payload), len(rows), rows[0][0], rows[-1][0])
+        return header + payload
+
+    def decode_block(self, buffer: Any, block: BlockHeader) -> List[Tuple[Any, ...]]:
+        offset = block.offset + BLOCK_HEADER.size
+        columns = []
+
+        timestamp, offset = decode_varint(buffer, offset)
+        timestamps = [timestamp]
+        delta = 0
+        for _ in range(block.entries - 1):
+            delta_of_delta, offset = decode_varint(buffer, offset)
+            delta += unzigzag(delta_of_delta)
+            timestamp += delta
+            timestamps.append(timestamp)
+        columns.append(timestamps)
+
+        for format_char in self.columns[1:]:
+            values: List[Any] = []
+            if format_char == COLUMN_STRING:
+                string = b""
+                for _ in range(block.entries):
+                    length, offset = decode_varint(buffer, offset)
+                    if length > 0:
+                        string = bytes(buffer[offset : offset + length - 1])
+                        offset += length - 1
+                    values.append(string)
+            elif format_char in COLUMN_FLOAT:
+                float_struct = struct.Struct(self.endianess + format_char)
+                bits = 0
+                for _ in range(block.entries):
+                    encoded, offset = decode_varint(buffer, offset)
+                    if encoded:
+                        bits ^= (encoded >> 6) << (encoded & 0x3F)
+                    values.append(
+                        float_struct.unpack(bits.to_bytes(float_struct.size, "little"))[
+                            0
+                        ]
+                    )
+            else:
+                value = 0
+                for _ in range(block.entries):
+                    delta, offset = decode_varint(buffer, offset)
+                    value += unzigzag(delta)
+                    values.append(value)
+            columns.append(values)
+
+        return list(zip(*columns))
+
+    def commit(self) -> FileSummary:
+        print("commit")
+        rows = sorted(
+            (self.struct.unpack(data) for data in self.new_entries),
+            key=timestamp_getter,
+        )
+        if rows:
+            self.commit_rows(rows)
+        summary = self.summary()
+        self.file.close()
+        print("commit end")
+        return summary
+
+    def commit_rows(self, rows: List[Tuple[Any, ...]]) -> None:
+        """Appends the rows or rewrites the blocks from the first one they overlap,
+        the same way as TimeStreamFile.commit_rewrite (including the copy of the
+        untouched blocks into the new file)"""
+        blocks = self.blocks()
+        split_index = len(blocks)
+        for index, block in enumerate(blocks):
+            if block.max_timestamp > rows[0][0]:
+                split_index = index
+                break
+
+        if split_index == len(blocks):
+            # all the points are newer than the file, so we can simply append them
+            self.file.seek(0, os.SEEK_END)
+            self.write_blocks(self.file, rows)
+        else:
+            print(f"rewriting {len(blocks) - split_index} blocks")
+            segment_filename = self.filename + ".merge"
+            with open(segment_filename, "wb") as segment:
+                self._copy_prefix(segment, blocks[split_index].offset)
+                self.write_blocks(
+                    segment,
+                    heapq.merge(
+                        self.read_rows(blocks[split_index:]),
+                        rows,
+                        key=timestamp_getter,
+                    ),
+                )
+                segment.flush()
+                os.fsync(segment.fileno())
+
+            self._swap_segment(segment_filename)
+
+        self.blocks_index = None
+        self.file_entries = None
+        self.new_entries = []
+
+    def write_blocks(self, output: Any, rows: Iterable[Tuple[Any, ...]]) -> None:
+        block_rows = []
+        for row in rows:
+            block_rows.append(row)
+            if len(block_rows) == self.block_entries:
+                output.write(self.encode_block(block_rows))
+                block_rows = []
+        if block_rows:
+            output.write(self.encode_block(block_rows))
+
+    def write_rows(self, output: Any, rows: Iterable[Tuple[Any, ...]]) -> None:
+        self.write_blocks(output, rows)
+
+    def read_rows(self, blocks: List[BlockHeader]) -> Iterable[Tuple[Any, ...]]:
+        for block in blocks:
+            self.file.seek(block.offset, os.SEEK_SET)
+            payload = self.file.read(block.end - block.offset)
+            yield from self.decode_block(payload, block._replace(offset=0))
+
+    def summary(self) -> FileSummary:
+        self.blocks_index = None
+        self.file_entries = None
+        blocks = self.blocks()
+        if not blocks:
+            return FileSummary(entries=0, min_timestamp=None, max_timestamp=None)
+
+        return FileSummary(
+            entries=len(self),
+            min_timestamp=blocks[0].min_timestamp,
+            max_timestamp=blocks[-1].max_timestamp,
+        )
+
+    def records(
+        self,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+    ) -> Iterable[Tuple[Any, ...]]:
+        """Decodes the blocks which overlap the given time range. Blocks are skipped
+        based on their headers alone."""
+        blocks = self.blocks()
+        if not blocks:
+            self.file.close()
+            return
+
+        start_timestamp = start_time.timestamp() if start_time is not None else None
+        end_timestamp = end_time.timestamp() if end_time is not None else None
+
+        with self.map() as buffer:
+            for block in blocks:
+                if start_timestamp is not None and block.max_timestamp < start_timestamp:
+                    continue
+                if end_timestamp is not None and block.min_timestamp > end_timestamp:
+                    break
+
+                for row in self.decode_block(buffer, block):
+                    if start_timestamp is not None and row[0] < start_timestamp:
+                        continue
+                    if end_timestamp is not None and row[0] > end_timestamp:
+                        break
+                    yield row
+
+        self.file.close()
+
+    def entries(
+        self,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+    ) -> Iterable[bytes]:
+        for row in self.records(start_time, end_time):
+            yield self.struct.pack(*row)
+
+    def array(
+        self,
+        dtype: "np.dtype",
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+    ) -> "np.ndarray":
+        import numpy as np
+
+        return np.array(list(self.records(start_time, end_time)), dtype=dtype)
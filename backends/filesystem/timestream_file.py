@@ -1,23 +1,74 @@
+import fcntl
+import heapq
+import mmap
 import os
 import struct
 from dataclasses import dataclass
 from datetime import datetime
-from typing import BinaryIO, ClassVar, Dict, Iterable, List, NamedTuple, Optional
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    BinaryIO,
+    ClassVar,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
 
 from .merge_file import mergeInPlace
 from .cache import Cache
 
+if TYPE_CHECKING:
+    import numpy as np
+
+# merges the new entries into the file by swapping records in-place (mergeInPlace)
+COMMIT_STRATEGY_IN_PLACE = "inplace"
+# copies the file into a temporary segment, merging the new entries into its
+# suffix, and renames the segment over the file
+COMMIT_STRATEGY_REWRITE = "rewrite"
+COMMIT_STRATEGY_DEFAULT = COMMIT_STRATEGY_REWRITE
+
+# how many entries are read at once while streaming the file
+READ_CHUNK_ENTRIES = 4096
+
+
+class FileSummary(NamedTuple):
+    entries: int
+    min_timestamp: Optional[int]
+    max_timestamp: Optional[int]
+
 
 class TimeStreamFile:
-    def __init__(self, file: str, fmt: str):
-        self.file = self._open_file(file)
+    def __init__(
+        self,
+        file: str,
+        fmt: str,
+        commit_strategy: str = COMMIT_STRATEGY_DEFAULT,
+        read_only: bool = False,
+    ):
+        if commit_strategy not in (COMMIT_STRATEGY_IN_PLACE, COMMIT_STRATEGY_REWRITE):
+            raise ValueError(f"Unknown commit strategy: {commit_strategy}")
+
+        self.filename = os.fspath(file)
+        self.commit_strategy = commit_strategy
+        self.read_only = read_only
+        self.file = self._open_file(self.filename)
         self.fmt = fmt
-        self.sizeof_struct = struct.calcsize(fmt)
+        self.struct = struct.Struct(fmt)
+        self.sizeof_struct = self.struct.size
         # how many entries are there in the file.
         # we can use it to our advantage when merging the sorted and unsorted part.
         self.file_entries: Optional[int] = None
         self.new_entries: List[bytes] = []
         self.cache = Cache(self.file, self.sizeof_struct)
+        # read-only mapping of the file, see snapshot()
+        self.mapping: Optional[mmap.mmap] = None
+        # the reads ignore whatever was appended past this many bytes, i.e. since
+        # the query started
+        self.size_limit: Optional[int] = None
 
     def __getitem__(self, index: int) -> int:
         return self.timestamp(self.cache[index])
@@ -28,29 +79,50 @@ class TimeStreamFile:
     def __len__(self) -> int:
         if self.file_entries is None:
             self.file.seek(0, os.SEEK_END)
-            self.file_entries = self.file.tell() // self.sizeof_struct
+            eof = self.file.tell()
+            if self.size_limit is not None:
+                eof = min(eof, self.size_limit)
+            self.file_entries = eof // self.sizeof_struct
         return self.file_entries
 
     ## helper method
     def _open_file(self, filename: str) -> BinaryIO:
-        open_mode = "r+b"
+        if self.read_only:
+            # the readers never create the file, it may have been compacted away
+            return open(filename, "rb")
+
+        while True:
+            open_mode = "r+b"
 
-        if not os.path.exists(filename):
-            open_mode = "w+b"
+            if not os.path.exists(filename):
+                open_mode = "w+b"
 
-            _dirname = os.path.dirname(filename)
-            if not os.path.exists(_dirname):
-                os.makedirs(_dirname)
+                _dirname = os.path.dirname(filename)
+                if not os.path.exists(_dirname):
+                    os.makedirs(_dirname)
 
-        return open(filename, open_mode)
+            file = open(filename, open_mode)
+            # the compaction (in any process) leaves alone the files which are
+            # locked by a writer, see Compactor.compact
+            fcntl.flock(file, fcntl.LOCK_SH)
+            try:
+                if os.stat(filename).st_ino == os.fstat(file.fileno()).st_ino:
+                    return file
+            except FileNotFoundError:
+                pass
+            # the file was compacted (and removed) while it was being opened
+            file.close()
 
     def timestamp(self, data: bytes) -> int:
         # timestamp is always the first value
-        return struct.unpack(self.fmt, data)[0]
+        return self.struct.unpack_from(data)[0]
 
     def append(self, data: bytes) -> None:
         self.new_entries.append(data)
 
+    def extend(self, entries: List[bytes]) -> None:
+        self.new_entries.extend(entries)
+
     def sort(self):
         new_entries = len(self.new_entries)
 
@@ -59,32 +131,173 @@ class TimeStreamFile:
             num_new_items=new_entries,
             num_all_items=len(self) + new_entries,
             swap=self.cache.swap,
-            progress=self.cache.sync,
+            # the modified pages are written back when they're evicted from the
+            # cache or on the final sync, not after every step of the merge
+            progress=lambda index: None,
         )
 
-    def commit(self):
+    def commit(self) -> FileSummary:
         print("commit")
-        existing_items_count = len(self)
         # sort new items by timestamp
         self.new_entries.sort(key=self.timestamp)
+        if self.commit_strategy == COMMIT_STRATEGY_IN_PLACE:
+            self.commit_in_place()
+        else:
+            self.commit_rewrite()
+        summary = self.summary()
+        self.file.close()
+        print("commit end")
+        return summary
+
+    def summary(self) -> FileSummary:
+        """Returns the number of entries and the time range of the file. As the file
+        is sorted, it's enough to look at the first and the last entry."""
+        self.file_entries = None
+        entries = len(self)
+        if entries == 0:
+            return FileSummary(entries=0, min_timestamp=None, max_timestamp=None)
+
+        self.file.seek(0, os.SEEK_SET)
+        min_timestamp = self.timestamp(self.file.read(self.sizeof_struct))
+        self.file.seek((entries - 1) * self.sizeof_struct, os.SEEK_SET)
+        max_timestamp = self.timestamp(self.file.read(self.sizeof_struct))
+
+        return FileSummary(
+            entries=entries, min_timestamp=min_timestamp, max_timestamp=max_timestamp
+        )
+
+    def commit_in_place(self):
+        existing_items_count = len(self)
+        # write all new items to the file
+        self.file.seek(0, os.SEEK_END)
+        self.file.write(b"".join(self.new_entries))
         if existing_items_count > 0:
             # the file is going to be sorted therefore let's populate
-            # the cache with new items.
+            # the cache with new items. This has to happen after they're written,
+            # as the cache may write the pages back (past the end of the file)
+            # upon eviction.
             offset = existing_items_count
             for index, data in enumerate(self.new_entries):
                 self.cache[offset + index] = data
-        # write all new items to the file
-        self.file.seek(0, os.SEEK_END)
-        self.file.write(b"".join(self.new_entries))
         # sort the file (if needed) and close the underlying BinaryIO handle
-        if existing_items_count > 0:
+        if existing_items_count > 0 and self.new_entries:
             self.sort()
         # persist unwritten changes
         self.cache.sync(existing_items_count + len(self.new_entries))
+        print(f"cache: {self.cache.stats()}")
         print("dump file")
         self.dump()
+
+    def commit_rewrite(self):
+        """Merges the new entries into the file with a single sequential pass.
+
+        Everything up to the first existing entry that is newer than the oldest
+        new entry is already in place, so it is copied over as-is. The remaining
+        suffix of the file is streamed through a two-way merge with the (sorted)
+        new entries into a temporary segment, which then atomically replaces the
+        file. If the new entries are all newer than the file, they are simply
+        appended.
+
+        Note that the whole partition is written for every backfill, not only
+        the suffix. Truncating the file at the split and appending the merged
+        tail would be cheaper, but the queries keep the file memory-mapped (see
+        snapshot()), so they'd crash reading past the truncation, and a crash
+        in the middle of the commit would lose the old suffix. The prefix is
+        copied by copy_file_range, which stays in the kernel (and only shares
+        the blocks on filesystems with reflinks, i.e. btrfs or xfs), so the
+        extra cost is mostly the I/O of the prefix."""
+        if not self.new_entries:
+            return
+
+        existing_items_count = len(self)
+        split_index = self.bisect(self.timestamp(self.new_entries[0]), right=True)
+
+        if split_index == existing_items_count:
+            self.file.seek(0, os.SEEK_END)
+            self.file.write(b"".join(self.new_entries))
+            self.file_entries = existing_items_count + len(self.new_entries)
+            self.new_entries = []
+            return
+
+        print(f"rewriting {existing_items_count - split_index} entries")
+        segment_filename = self.filename + ".merge"
+        with open(segment_filename, "wb") as segment:
+            self._copy_prefix(segment, split_index * self.sizeof_struct)
+
+            merged = heapq.merge(
+                self._read_entries(split_index), self.new_entries, key=self.timestamp
+            )
+            chunk: List[bytes] = []
+            for data in merged:
+                chunk.append(data)
+                if len(chunk) == READ_CHUNK_ENTRIES:
+                    segment.write(b"".join(chunk))
+                    chunk = []
+            segment.write(b"".join(chunk))
+
+            segment.flush()
+            os.fsync(segment.fileno())
+
+        self._swap_segment(segment_filename)
+
+    def write_rows(self, output: BinaryIO, rows: Iterable[Tuple[Any, ...]]) -> None:
+        """Writes the (sorted) unpacked rows to the output in the file's format"""
+        chunk: List[bytes] = []
+        for row in rows:
+            chunk.append(self.struct.pack(*row))
+            if len(chunk) == READ_CHUNK_ENTRIES:
+                output.write(b"".join(chunk))
+                chunk = []
+        output.write(b"".join(chunk))
+
+    def _swap_segment(self, segment_filename: str) -> None:
+        """Atomically replaces the file with the merged segment and reopens it"""
+        os.replace(segment_filename, self.filename)
         self.file.close()
-        print("commit end")
+        self.file = self._open_file(self.filename)
+        self.file_entries = None
+        self.cache = Cache(self.file, self.sizeof_struct)
+        self.new_entries = []
+
+    def _copy_prefix(self, segment: BinaryIO, length: int) -> None:
+        # copy_file_range lets the kernel copy (or even share) the blocks without
+        # passing them through userspace
+        self.file.flush()
+        offset = 0
+        if hasattr(os, "copy_file_range"):
+            try:
+                while offset < length:
+                    copied = os.copy_file_range(
+                        self.file.fileno(),
+                        segment.fileno(),
+                        length - offset,
+                        offset,
+                        offset,
+                    )
+                    if copied == 0:
+                        break
+                    offset += copied
+            except OSError:
+                pass
+
+        self.file.seek(offset, os.SEEK_SET)
+        segment.seek(offset, os.SEEK_SET)
+        while offset < length:
+            data = self.file.read(min(length - offset, 1024 * 1024))
+            if not data:
+                break
+            segment.write(data)
+            offset += len(data)
+
+    def _read_entries(self, index: int) -> Iterable[bytes]:
+        """Sequentially reads the entries starting from the index, in chunks"""
+        self.file.seek(index * self.sizeof_struct, os.SEEK_SET)
+        while True:
+            chunk = self.file.read(READ_CHUNK_ENTRIES * self.sizeof_struct)
+            if not chunk:
+                break
+            for offset in range(0, len(chunk), self.sizeof_struct):
+                yield chunk[offset : offset + self.sizeof_struct]
 
     def dump(self):
         self.file_entries = None
@@ -92,10 +305,47 @@ class TimeStreamFile:
             ts = datetime.fromtimestamp(self[i])
             print(f"timestamp[{i}] => {ts}")
 
-    def entries(self, end_time: Optional[datetime] = None) -> Iterable[bytes]:
+    def bisect(
+        self,
+        timestamp: float,
+        right: bool = False,
+        buffer: Optional[memoryview] = None,
+    ) -> int:
+        """Returns the index of the first entry whose timestamp is not lower than
+        the given one (or greater than the given one if right is set). commit()
+        keeps the file sorted and every entry has the same width, therefore we can
+        binary-search the file instead of scanning it.
+
+        If the buffer is passed, the timestamps are read from it instead of the file."""
+        low = 0
+        high = len(self)
+
+        while low < high:
+            middle = (low + high) // 2
+            if buffer is not None:
+                entry_timestamp = self.struct.unpack_from(
+                    buffer, middle * self.sizeof_struct
+                )[0]
+            else:
+                self.file.seek(middle * self.sizeof_struct, os.SEEK_SET)
+                entry_timestamp = self.timestamp(self.file.read(self.sizeof_struct))
+
+            if entry_timestamp < timestamp or (right and entry_timestamp == timestamp):
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    def entries(
+        self,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+    ) -> Iterable[bytes]:
         offset = 0
-        self.file.seek(0, os.SEEK_END)
-        eof = self.file.tell()
+        if start_time is not None:
+            offset = self.bisect(start_time.timestamp()) * self.sizeof_struct
+        eof = len(self) * self.sizeof_struct
 
         while offset < eof:
             self.file.seek(offset, os.SEEK_SET)
@@ -109,3 +359,90 @@ class TimeStreamFile:
             offset += self.sizeof_struct
 
         self.file.close()
+
+    def snapshot(self) -> None:
+        """Maps the file right away, so that records() and array() return the entries
+        as they are at this very moment, even if the file is appended to or replaced
+        by a commit before they're read."""
+        if self.mapping is None and len(self) > 0:
+            self.mapping = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def map(self) -> mmap.mmap:
+        """Returns the snapshot mapping (if there is one) or maps the file now"""
+        self.snapshot()
+        mapping = self.mapping
+        self.mapping = None
+        return mapping
+
+    def close(self) -> None:
+        """Releases the snapshot (if it was not consumed) and the file handle"""
+        if self.mapping is not None:
+            self.mapping.close()
+            self.mapping = None
+        self.file.close()
+
+    def records(
+        self,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+    ) -> Iterable[Tuple[Any, ...]]:
+        """Works just like entries(), except that the file is memory-mapped and the
+        entries are unpacked in one go with iter_unpack. Each entry is therefore
+        unpacked exactly once and no intermediate bytes object is allocated per entry.
+        """
+        if len(self) == 0:
+            self.file.close()
+            return
+
+        with self.map() as buffer:
+            view = memoryview(buffer)
+            first = 0
+            last = len(self)
+            if start_time is not None:
+                first = self.bisect(start_time.timestamp(), buffer=view)
+            if end_time is not None:
+                last = self.bisect(end_time.timestamp(), right=True, buffer=view)
+
+            window = view[first * self.sizeof_struct : last * self.sizeof_struct]
+            iterator = self.struct.iter_unpack(window)
+            try:
+                yield from iterator
+            finally:
+                # the exported buffers have to be released before the mmap is closed
+                del iterator
+                window.release()
+                view.release()
+
+        self.file.close()
+
+    def array(
+        self,
+        dtype: "np.dtype",
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+    ) -> "np.ndarray":
+        """Loads the entries as a numpy structured array. The file is memory-mapped
+        and the time window is found with a vectorized searchsorted on the timestamp
+        column, so only the matching entries are copied out of the mapping."""
+        import numpy as np
+
+        if len(self) == 0:
+            self.file.close()
+            return np.empty(0, dtype=dtype)
+
+        with self.map() as buffer:
+            entries = np.frombuffer(buffer, dtype=dtype, count=len(self))
+            timestamps = entries[dtype.names[0]]
+            first = 0
+            last = len(self)
+            if start_time is not None:
+                first = np.searchsorted(timestamps, start_time.timestamp(), side="left")
+            if end_time is not None:
+                last = np.searchsorted(timestamps, end_time.timestamp(), side="right")
+
+            array = np.array(entries[first:last])
+            # the mapping can only be closed once numpy lets go of it
+            del entries, timestamps
+
+        self.file.close()
+        return array
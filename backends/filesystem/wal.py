@@ -0,0 +1,332 @@
+import fcntl
+import json
+import os
+import struct
+import threading
+import uuid
+import zlib
+from typing import BinaryIO, Dict, Iterable, List, NamedTuple, Optional
+
+# record type, payload length, crc32 of the payload
+RECORD_HEADER = struct.Struct("<cII")
+# defines the partition the following data records refer to
+RECORD_PARTITION = b"P"
+# the encoded point, prefixed by the id of the partition
+RECORD_DATA = b"D"
+PARTITION_ID = struct.Struct("<I")
+
+SEGMENT_SUFFIX = ".wal"
+# partitions of the sealed segment which are being folded, see FoldLog
+FOLD_LOG_FILENAME = "folded"
+# locked by the backend which writes the segments of the directory, see LogDirectory
+OWNER_LOCK_FILENAME = "owner.lock"
+# the directory is locked before it gets its final name
+NEW_DIRECTORY_SUFFIX = ".new"
+
+
+class LogEntry(NamedTuple):
+    # partition definition, as passed to append()
+    partition: Dict
+    data: bytes
+
+
+class WriteAheadLog:
+    """Append-only log of the points which were not yet folded into the partition
+    files.
+
+    The log is split into segments. The appended records are buffered in memory
+    and a background thread writes them to the current segment and fsyncs it
+    (group commit): either once group_commit_size bytes are buffered, or after
+    group_commit_interval seconds, or whenever somebody waits for the data to be
+    durable. This way a single fsync covers all the points appended in the
+    meantime.
+
+    Each segment is self-contained: the first time a partition is referenced
+    within the segment, its definition (path, table, struct fmt, dimensions) is
+    written, and the data records only refer to it by id."""
+
+    def __init__(
+        self,
+        directory: str,
+        group_commit_interval: float,
+        group_commit_size: int,
+    ):
+        self.directory = directory
+        self.group_commit_interval = group_commit_interval
+        self.group_commit_size = group_commit_size
+        os.makedirs(directory, exist_ok=True)
+
+        self.condition = threading.Condition()
+        # serializes the writes to the segment file
+        self.io_lock = threading.Lock()
+        self.buffer = bytearray()
+        # log sequence numbers of the last appended and the last durable record
+        self.appended_lsn = 0
+        self.durable_lsn = 0
+        self.partition_ids: Dict[str, int] = {}
+        self.closed = False
+
+        segments = self.segments()
+        self.segment_number = (
+            int(os.path.basename(segments[-1])[: -len(SEGMENT_SUFFIX)]) + 1
+            if segments
+            else 0
+        )
+        self.segment = open(self.segment_filename(self.segment_number), "ab")
+
+        self.flusher = threading.Thread(target=self.run_flusher, daemon=True)
+        self.flusher.start()
+
+    def segment_filename(self, number: int) -> str:
+        return os.path.join(self.directory, f"{number:08d}{SEGMENT_SUFFIX}")
+
+    def segments(self) -> List[str]:
+        """Returns the filenames of all segments, oldest first"""
+        return sorted(
+            os.path.join(self.directory, filename)
+            for filename in os.listdir(self.directory)
+            if filename.endswith(SEGMENT_SUFFIX)
+        )
+
+    def _record(self, record_type: bytes, payload: bytes) -> None:
+        self.buffer += RECORD_HEADER.pack(record_type, len(payload), zlib.crc32(payload))
+        self.buffer += payload
+
+    def append(self, partition: Dict, data: bytes) -> int:
+        """Appends the encoded point to the log and returns its sequence number,
+        which can be passed to sync() in order to wait until it's durable"""
+        with self.condition:
+            partition_id = self.partition_ids.get(partition["path"])
+            if partition_id is None:
+                partition_id = len(self.partition_ids)
+                self.partition_ids[partition["path"]] = partition_id
+                self._record(
+                    RECORD_PARTITION,
+                    json.dumps(dict(partition, id=partition_id)).encode("utf-8"),
+                )
+            self._record(RECORD_DATA, PARTITION_ID.pack(partition_id) + data)
+
+            self.appended_lsn += 1
+            if len(self.buffer) >= self.group_commit_size:
+                self.condition.notify_all()
+            return self.appended_lsn
+
+    def sync(self, lsn: Optional[int] = None) -> None:
+        """Waits until the record with the given sequence number (by default, all
+        the records appended so far) is written to the disk"""
+        with self.condition:
+            if lsn is None:
+                lsn = self.appended_lsn
+            while self.durable_lsn < lsn:
+                self.condition.notify_all()
+                self.condition.wait()
+
+    def flush(self) -> None:
+        """Writes the buffered records to the current segment and fsyncs it"""
+        with self.io_lock:
+            with self.condition:
+                buffer = self.buffer
+                lsn = self.appended_lsn
+                self.buffer = bytearray()
+
+            if buffer:
+                self.segment.write(buffer)
+                self.segment.flush()
+                os.fsync(self.segment.fileno())
+
+            with self.condition:
+                self.durable_lsn = max(self.durable_lsn, lsn)
+                self.condition.notify_all()
+
+    def run_flusher(self) -> None:
+        while True:
+            with self.condition:
+                if self.closed:
+                    return
+                if len(self.buffer) < self.group_commit_size:
+                    self.condition.wait(self.group_commit_interval)
+                if self.closed:
+                    return
+            self.flush()
+
+    def rotate(self) -> str:
+        """Seals the current segment and starts a new one. Returns the filename of
+        the sealed segment"""
+        with self.io_lock:
+            with self.condition:
+                buffer = self.buffer
+                lsn = self.appended_lsn
+                self.buffer = bytearray()
+                self.partition_ids = {}
+
+                sealed_segment = self.segment
+                self.segment_number += 1
+                self.segment = open(self.segment_filename(self.segment_number), "ab")
+
+            sealed_segment.write(buffer)
+            sealed_segment.flush()
+            os.fsync(sealed_segment.fileno())
+            sealed_segment.close()
+
+            with self.condition:
+                self.durable_lsn = max(self.durable_lsn, lsn)
+                self.condition.notify_all()
+
+        return sealed_segment.name
+
+    def close(self) -> None:
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.flusher.join()
+        self.flush()
+        self.segment.close()
+
+    @staticmethod
+    def replay(filename: str) -> Iterable[LogEntry]:
+        """Reads the points back from the segment. A torn record at the end of the
+        segment (i.e. after a crash) is ignored."""
+        partitions: Dict[int, Dict] = {}
+
+        with open(filename, "rb") as segment:
+            content = segment.read()
+
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(content):
+            record_type, length, checksum = RECORD_HEADER.unpack_from(content, offset)
+            offset += RECORD_HEADER.size
+            payload = content[offset : offset + length]
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                break
+            offset += length
+
+            if record_type == RECORD_PARTITION:
+                partition = json.loads(payload.decode("utf-8"))
+                partitions[partition.pop("id")] = partition
+            elif record_type == RECORD_DATA:
+                partition_id = PARTITION_ID.unpack_from(payload)[0]
+                yield LogEntry(
+                    partition=partitions[partition_id],
+                    data=payload[PARTITION_ID.size :],
+                )
+
+
+class FoldLog:
+    """Remembers which partitions of a sealed segment are folded into the partition
+    files, along with the number of entries the file has once the fold is done.
+
+    A crash after some partitions were folded, but before the segment was removed,
+    makes the recovery replay the segment. The partitions which already have the
+    entries are skipped then, so their points are not appended twice."""
+
+    def __init__(self, directory: str):
+        self.filename = os.path.join(directory, FOLD_LOG_FILENAME)
+
+    def folded(self, segment: str) -> Dict[str, int]:
+        """Returns the expected number of entries by the partition path"""
+        folded: Dict[str, int] = {}
+        if not os.path.exists(self.filename):
+            return folded
+
+        with open(self.filename, "r") as fold_log:
+            for line in fold_log:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # torn by the crash
+                    break
+                if record["segment"] == segment:
+                    folded[record["path"]] = record["entries"]
+        return folded
+
+    def mark(self, segment: str, path: str, entries: int) -> None:
+        with open(self.filename, "a") as fold_log:
+            fold_log.write(
+                json.dumps({"segment": segment, "path": path, "entries": entries})
+                + "\n"
+            )
+            fold_log.flush()
+            os.fsync(fold_log.fileno())
+
+    def reset(self) -> None:
+        """The segment is gone, so are the records of its partitions"""
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+class LogDirectory:
+    """Directory with the log segments (and the fold log) of a single backend.
+
+    Several backends can share the root, therefore each of them logs into its own
+    directory under .wal and keeps it locked (flock) until it's committed. The
+    recovery only picks the directories which are not locked, i.e. whose backend
+    is gone."""
+
+    def __init__(self, path: str, lock_file: BinaryIO):
+        self.path = path
+        self.lock_file = lock_file
+
+    @classmethod
+    def create(cls, wal_directory: str) -> "LogDirectory":
+        path = os.path.join(wal_directory, uuid.uuid4().hex)
+        # the directory must not look like an orphan before it's locked
+        new_path = path + NEW_DIRECTORY_SUFFIX
+        os.makedirs(new_path)
+        lock_file = open(os.path.join(new_path, OWNER_LOCK_FILENAME), "wb")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        os.rename(new_path, path)
+        return cls(path, lock_file)
+
+    @classmethod
+    def orphans(cls, wal_directory: str) -> Iterable["LogDirectory"]:
+        """Yields the directories left behind by the backends which are gone,
+        locked by the caller"""
+        if not os.path.exists(wal_directory):
+            return
+
+        for name in sorted(os.listdir(wal_directory)):
+            path = os.path.join(wal_directory, name)
+            if name.endswith(NEW_DIRECTORY_SUFFIX) or not os.path.isdir(path):
+                continue
+            lock_filename = os.path.join(path, OWNER_LOCK_FILENAME)
+            try:
+                lock_file = open(lock_filename, "rb")
+            except FileNotFoundError:
+                # the owner crashed while removing the (already folded) directory
+                try:
+                    os.rmdir(path)
+                except OSError:
+                    pass
+                continue
+
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                continue
+            if not os.path.exists(lock_filename):
+                # recovered by another backend meanwhile
+                lock_file.close()
+                continue
+            yield cls(path, lock_file)
+
+    def segments(self) -> List[str]:
+        """Returns the filenames of the segments, oldest first"""
+        return sorted(
+            os.path.join(self.path, filename)
+            for filename in os.listdir(self.path)
+            if filename.endswith(SEGMENT_SUFFIX)
+        )
+
+    def release(self) -> None:
+        """Removes the directory, once all of its segments are folded, and unlocks
+        it"""
+        # the fold log goes last, as it tells which of the segments were folded
+        for segment in self.segments():
+            os.remove(segment)
+        for filename in (FOLD_LOG_FILENAME, OWNER_LOCK_FILENAME):
+            filename = os.path.join(self.path, filename)
+            if os.path.exists(filename):
+                os.remove(filename)
+        os.rmdir(self.path)
+        self.lock_file.close()
@@ -1,10 +1,24 @@
-from datetime import datetime
-from typing import TYPE_CHECKING, Any, Dict, Optional, Type
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Type
 
 if TYPE_CHECKING:
     from schemas import TimeSeries
 
-from .backend import Backend
+from .backend import Backend, dimension_filter
+
+
+def where_dimensions(
+    cls: Type["TimeSeries"], dimensions: Dict[str, Any]
+) -> List[str]:
+    whereClause = []
+    for dimension, values in dimension_filter(cls, dimensions).items():
+        if values is None:
+            continue
+        if len(values) == 1:
+            whereClause.append(f"{dimension} = {next(iter(values))}")
+        else:
+            whereClause.append(f"{dimension} IN ({', '.join(sorted(values))})")
+    return whereClause
 
 
 class PrintBackend(Backend):
@@ -20,12 +34,41 @@ class PrintBackend(Backend):
         dimensions: Dict[str, Any],
         start_time: datetime,
         end_time: Optional[datetime] = None,
+        fields: Optional[List[str]] = None,
     ):
-        whereClause = []
-        for dimension, value in dimensions.items():
-            whereClause.append(f"{dimension} = {value}")
+        whereClause = where_dimensions(cls, dimensions)
         whereClause.append(f"timestamp >= {start_time}")
         if end_time:
             whereClause.append(f"timestamp <= {end_time}")
-        print(f"SELECT * FROM {cls.Meta.table} WHERE ({' AND '.join(whereClause)})")
+        columns = "*"
+        if fields is not None:
+            columns = ", ".join(["timestamp"] + fields)
+        print(
+            f"SELECT {columns} FROM {cls.Meta.table} WHERE ({' AND '.join(whereClause)})"
+        )
+        return []
+
+    def aggregate(
+        self,
+        cls: Type["TimeSeries"],
+        dimensions: Dict[str, Any],
+        start_time: datetime,
+        end_time: Optional[datetime],
+        bucket: timedelta,
+        funcs: List[str],
+        fields: List[str],
+    ) -> Iterable[Dict[str, Any]]:
+        whereClause = where_dimensions(cls, dimensions)
+        whereClause.append(f"timestamp >= {start_time}")
+        if end_time:
+            whereClause.append(f"timestamp <= {end_time}")
+        columns = [
+            f"time_bucket(INTERVAL '{int(bucket.total_seconds())} seconds', timestamp) AS bucket"
+        ]
+        for field in fields:
+            for func in funcs:
+                columns.append(f"{func.upper()}({field}) AS {field}_{func}")
+        print(
+            f"SELECT {', '.join(columns)} FROM {cls.Meta.table} WHERE ({' AND '.join(whereClause)}) GROUP BY bucket ORDER BY bucket"
+        )
         return []
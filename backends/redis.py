@@ -3,82 +3,945 @@
 # docker run -p 6379:6379 redis/redis-stack-server:latest
 # I think that the docker image limits the number of data you can
 # put in but for testing purposes it's more then enough.
+import asyncio
+import heapq
+import os
+import threading
+import time
 from collections import defaultdict
-from datetime import datetime
-from operator import itemgetter
-from typing import TYPE_CHECKING, Any, Dict, Iterable, Optional, Type
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from enum import Enum
+from itertools import takewhile
+from operator import add, itemgetter
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+    Union,
+)
 
-from redis import Redis
+from redis import ConnectionPool, Redis
+from redis.asyncio import Redis as AsyncRedis
+from redis.exceptions import ResponseError
 
 if TYPE_CHECKING:
     from schemas import TimeSeries
 
-from .backend import Backend
+from .aggregation import numeric_fields
+from .async_backend import AsyncBackend
+from .backend import Backend, dimension_filter
+
+
+REDIS_URL_DEFAULT = "redis://localhost:6379"
+# how many samples (points x attributes) are buffered before they're sent
+BUFFER_SIZE_DEFAULT = 10_000
+# how long a sample can stay in the buffer, in milliseconds
+BUFFER_AGE_MS_DEFAULT = 1000
+# samples per TS.MADD command
+MADD_CHUNK_SIZE = 1000
+
+# how the buckets of several series are combined, see RedisBackend.aggregate
+COMBINE_FUNCS = {"sum": add, "count": add, "min": min, "max": max}
+# samples per series fetched by a single TS.MRANGE
+QUERY_PAGE_SIZE_DEFAULT = 10_000
+
+# options of the created series. A retention of 0 keeps the samples forever
+RETENTION_MS_DEFAULT = 0
+CHUNK_SIZE_DEFAULT = 4096
+DUPLICATE_POLICY_DEFAULT = "LAST"
+# downsampled series which are maintained by redis, as func:bucket in seconds
+RULES_DEFAULT = "avg:60,min:60,max:60,avg:3600,min:3600,max:3600"
+# a query for the numeric fields is answered from the downsampled series if it
+# spans at least this many of their buckets; 0 (the default) turns it off
+ROUTE_BUCKETS_DEFAULT = 0
+
+# connection pools by the url, shared by all the backend instances
+connection_pools: Dict[str, ConnectionPool] = {}
+
+
+def redis_url() -> str:
+    return os.environ.get("TIME_SERIES_REDIS_URL", REDIS_URL_DEFAULT)
+
+
+def connection_pool(url: str) -> ConnectionPool:
+    if url not in connection_pools:
+        connection_pools[url] = ConnectionPool.from_url(url)
+    return connection_pools[url]
+
+
+@dataclass
+class CompactionRule:
+    func: str
+    bucket_ms: int
+
+
+@dataclass
+class SeriesOptions:
+    retention_ms: int
+    chunk_size: int
+    duplicate_policy: str
+    rules: List[CompactionRule]
+    rules_retention_ms: int
+    route_buckets: int
+
+    @classmethod
+    def from_env(cls) -> "SeriesOptions":
+        rules = []
+        for rule in os.environ.get("TIME_SERIES_REDIS_RULES", RULES_DEFAULT).split(","):
+            if not rule.strip():
+                continue
+            func, _, bucket = rule.strip().partition(":")
+            rules.append(CompactionRule(func=func, bucket_ms=int(float(bucket) * 1000)))
+
+        return cls(
+            retention_ms=int(
+                os.environ.get("TIME_SERIES_REDIS_RETENTION_MS", RETENTION_MS_DEFAULT)
+            ),
+            chunk_size=int(
+                os.environ.get("TIME_SERIES_REDIS_CHUNK_SIZE", CHUNK_SIZE_DEFAULT)
+            ),
+            duplicate_policy=os.environ.get(
+                "TIME_SERIES_REDIS_DUPLICATE_POLICY", DUPLICATE_POLICY_DEFAULT
+            ),
+            rules=rules,
+            rules_retention_ms=int(
+                os.environ.get(
+                    "TIME_SERIES_REDIS_RULES_RETENTION_MS", RETENTION_MS_DEFAULT
+                )
+            ),
+            route_buckets=int(
+                os.environ.get("TIME_SERIES_REDIS_ROUTE_BUCKETS", ROUTE_BUCKETS_DEFAULT)
+            ),
+        )
+
+    def route(
+        self, start_time: datetime, end_time: Optional[datetime]
+    ) -> Optional[int]:
+        """Returns the bucket of the downsampled series the query should be
+        answered from, if the range is long enough"""
+        if self.route_buckets <= 0:
+            return None
+        if end_time is None:
+            end_time = datetime.now(timezone.utc)
+        range_ms = (end_time - start_time).total_seconds() * 1000
+        buckets = [
+            rule.bucket_ms
+            for rule in self.rules
+            if rule.func == "avg" and range_ms / rule.bucket_ms >= self.route_buckets
+        ]
+        return max(buckets) if buckets else None
+
+
+def series_value(value: Any) -> float:
+    """Redis time series only hold floats"""
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+def series_key(table: str, dimensions: Dict[str, Any], attribute: str) -> str:
+    return ":".join(
+        [table, attribute]
+        + [f"{name}-{value}" for name, value in dimensions.items()]
+    )
+
+
+def series_labels(
+    table: str, dimensions: Dict[str, Any], attribute: str
+) -> Dict[str, str]:
+    labels = {name: str(value) for name, value in dimensions.items()}
+    labels["table"] = table
+    labels["attribute"] = attribute
+    return labels
+
+
+def rule_key(key: str, rule: CompactionRule) -> str:
+    return f"{key}:{rule.func}:{rule.bucket_ms}"
+
+
+def rule_labels(labels: Dict[str, str], rule: CompactionRule) -> Dict[str, str]:
+    return dict(labels, aggregation=rule.func, bucket=str(rule.bucket_ms))
+
+
+def queue_create(
+    pipeline: Any,
+    new_keys: Dict[str, Dict[str, str]],
+    options: SeriesOptions,
+    downsampled: Set[str],
+) -> List[Tuple[str, Optional[str], Dict[str, str], int]]:
+    """Queues the creation of the series, including the downsampled ones (of the
+    downsampled attributes) and the rules which feed them. Returns what was
+    queued, as (command, key, labels, retention), so that the results can be told
+    apart."""
+
+    def create(key: str, labels: Dict[str, str], retention_ms: int) -> None:
+        arguments = [
+            "TS.CREATE",
+            key,
+            "RETENTION",
+            retention_ms,
+            "ENCODING",
+            "COMPRESSED",
+            "CHUNK_SIZE",
+            options.chunk_size,
+            "DUPLICATE_POLICY",
+            options.duplicate_policy,
+            "LABELS",
+        ]
+        for name, value in labels.items():
+            arguments.extend([name, value])
+        pipeline.execute_command(*arguments)
+        queued.append(("create", key, labels, retention_ms))
+
+    queued: List[Tuple[str, Optional[str], Dict[str, str], int]] = []
+    for key, labels in new_keys.items():
+        create(key, labels, options.retention_ms)
+        if labels["attribute"] not in downsampled:
+            continue
+        for rule in options.rules:
+            create(
+                rule_key(key, rule),
+                rule_labels(labels, rule),
+                options.rules_retention_ms,
+            )
+            pipeline.ts().createrule(
+                key, rule_key(key, rule), rule.func, rule.bucket_ms
+            )
+            queued.append(("createrule", None, {}, 0))
+    return queued
+
+
+def queue_alter(
+    pipeline: Any,
+    queued: List[Tuple[str, Optional[str], Dict[str, str], int]],
+    results: List[Any],
+    options: SeriesOptions,
+) -> int:
+    """Series which existed already are altered to the current options instead.
+    Returns the number of the queued commands."""
+    altered = 0
+    for (command, key, labels, retention_ms), result in zip(queued, results):
+        if not isinstance(result, ResponseError):
+            continue
+        if command == "create" and "already exists" in str(result):
+            pipeline.ts().alter(
+                key,
+                retention_msecs=retention_ms,
+                labels=labels,
+                chunk_size=options.chunk_size,
+                duplicate_policy=options.duplicate_policy,
+            )
+            altered += 1
+        elif command == "createrule" and "already" in str(result):
+            # the rule was created by someone else before
+            continue
+        else:
+            print(f"redis error: {result}")
+    return altered
+
+
+def report_errors(results: List[Any]) -> None:
+    for result in results:
+        # TS.MADD reports the errors per sample
+        for item in result if isinstance(result, list) else [result]:
+            if isinstance(item, ResponseError):
+                print(f"redis error: {item}")
+
+
+def dimension_filters(cls: Type["TimeSeries"], dimensions: Dict[str, Any]) -> List[str]:
+    """Translates the dimension predicates into the TS.MRANGE filters. A list of
+    values becomes label=(a,b) and ALL becomes label!= (i.e. the label exists)"""
+    filters = [f"table={cls.Meta.table}"]
+    for dimension_name, allowed in dimension_filter(cls, dimensions).items():
+        if allowed is None:
+            filters.append(f"{dimension_name}!=")
+        elif len(allowed) == 1:
+            filters.append(f"{dimension_name}={next(iter(allowed))}")
+        else:
+            filters.append(f"{dimension_name}=({','.join(sorted(allowed))})")
+    return filters
+
+
+def query_filters(
+    cls: Type["TimeSeries"],
+    dimensions: Dict[str, Any],
+    attributes: Optional[List[str]],
+    bucket_ms: Optional[int],
+) -> List[str]:
+    filters = dimension_filters(cls, dimensions)
+    if attributes:
+        filters.append(f"attribute=({','.join(attributes)})")
+    if bucket_ms is None:
+        # the raw series do not have the aggregation label
+        filters.append("aggregation=")
+    else:
+        filters.extend(["aggregation=avg", f"bucket={bucket_ms}"])
+    return filters
+
+
+def attributes_of(cls: Type["TimeSeries"]) -> List[str]:
+    return [
+        name
+        for name in cls.__fields__
+        if name != "timestamp" and name not in cls.Meta.dimensions
+    ]
+
+
+def field_value(cls: Type["TimeSeries"], field: str, value: Any) -> Any:
+    """Converts the float back to the type of the field"""
+    if value is None or field not in cls.__fields__:
+        return value
+    field_type = cls.__fields__[field].type_
+    if isinstance(field_type, type):
+        if issubclass(field_type, Enum):
+            return field_type(int(value))
+        if issubclass(field_type, Decimal):
+            return Decimal(str(value))
+        if issubclass(field_type, int):
+            return int(value)
+    return value
+
+
+def decode_row(
+    cls: Type["TimeSeries"],
+    row: Dict[str, Any],
+    fields: Optional[List[str]],
+    downsampled: bool,
+) -> Union["TimeSeries", Dict[str, Any]]:
+    """Turns the merged samples of a timestamp into the point (or a dict, if the
+    fields are given). The downsampled rows are always dicts of the averages, as
+    these can't be converted back into the points"""
+    timestamp = datetime.fromtimestamp(row.pop("timestamp") / 1000, timezone.utc)
+    if downsampled:
+        return {"timestamp": timestamp, **row}
+    values = {name: field_value(cls, name, value) for name, value in row.items()}
+    if fields is not None:
+        return {
+            "timestamp": timestamp,
+            **{field: values.get(field) for field in fields},
+        }
+    return cls(timestamp=timestamp, **values)
+
+
+class SeriesPage(NamedTuple):
+    # dimension values of the series, as (name, value) pairs
+    series: Tuple[Tuple[str, Optional[str]], ...]
+    attribute: str
+    points: List[Tuple[int, float]]
+
+
+def read_page(
+    cls: Type["TimeSeries"], result: List[Dict[str, Any]]
+) -> List[SeriesPage]:
+    pages = []
+    for item in result:
+        # _ is the key name which we don't need.
+        for _, values in item.items():
+            labels, points = values
+            series = tuple(
+                (dimension_name, labels.get(dimension_name))
+                for dimension_name in cls.Meta.dimensions
+            )
+            pages.append(SeriesPage(series, labels["attribute"], points))
+    return pages
+
+
+def page_horizon(pages: List[SeriesPage], count: int) -> Optional[int]:
+    """Returns the last timestamp up to which the page is complete, or None if all
+    the series were read to the end of the range.
+
+    Each series returns up to count samples, so the series which returned less
+    are exhausted, while the ones which returned count samples may continue right
+    after their last sample. Everything up to the lowest of these is complete."""
+    truncated = [page.points[-1][0] for page in pages if len(page.points) >= count]
+    return min(truncated) if truncated else None
+
+
+def merge_page(
+    pages: List[SeriesPage], horizon: Optional[int]
+) -> Iterable[Dict[str, Any]]:
+    """Merges the samples of the per-attribute series into rows by the timestamp
+    and the series (the dimension values), as a stream ordered by the timestamp"""
+
+    def samples(page: SeriesPage) -> Iterable[Tuple[int, Tuple, str, float]]:
+        points: Iterable[Tuple[int, float]] = page.points
+        if horizon is not None:
+            points = takewhile(lambda point: point[0] <= horizon, points)
+        for timestamp, value in points:
+            yield timestamp, page.series, page.attribute, value
+
+    row: Optional[Dict[str, Any]] = None
+    row_key = None
+    for timestamp, series, attribute, value in heapq.merge(
+        *(samples(page) for page in pages), key=itemgetter(0, 1)
+    ):
+        if (timestamp, series) != row_key:
+            if row is not None:
+                yield row
+            row_key = (timestamp, series)
+            row = dict(series, timestamp=timestamp)
+        row[attribute] = value
+    if row is not None:
+        yield row
+
+
+def mrange_window(
+    start_time: datetime, end_time: Optional[datetime]
+) -> Tuple[int, Union[int, str]]:
+    return (
+        max(int(start_time.timestamp() * 1000), 0),
+        int(end_time.timestamp() * 1000) if end_time is not None else "+",
+    )
 
 
 class RedisBackend(Backend):
+    """Stores each attribute of the point in a separate time series, labeled with
+    the table, the dimensions and the attribute name.
+
+    Each series is created once, on its first write, with the configured
+    retention, chunk size and duplicate policy, along with the downsampled series
+    (TIME_SERIES_REDIS_RULES) which redis maintains by itself. Queries for the
+    numeric fields spanning a long range can be answered from the downsampled
+    series (TIME_SERIES_REDIS_ROUTE_BUCKETS).
+
+    The samples are buffered and sent in pipelined TS.MADD batches, either once
+    TIME_SERIES_REDIS_BUFFER_SIZE samples are buffered, or when the oldest one is
+    older than TIME_SERIES_REDIS_BUFFER_AGE_MS (checked by a timer, so that an idle
+    writer does not hold the samples), or on flush() / commit()."""
+
+    def __init__(self, connection: Optional[Redis] = None):
+        if connection is None:
+            connection = Redis(connection_pool=connection_pool(redis_url()))
+        self.connection = connection
+        self.options = SeriesOptions.from_env()
+        self.page_size = int(
+            os.environ.get("TIME_SERIES_REDIS_QUERY_PAGE_SIZE", QUERY_PAGE_SIZE_DEFAULT)
+        )
+        self.buffer_size = int(
+            os.environ.get("TIME_SERIES_REDIS_BUFFER_SIZE", BUFFER_SIZE_DEFAULT)
+        )
+        self.buffer_age = (
+            int(
+                os.environ.get("TIME_SERIES_REDIS_BUFFER_AGE_MS", BUFFER_AGE_MS_DEFAULT)
+            )
+            / 1000
+        )
+        # attribute names of the prepared types
+        self.attributes: Dict[Type["TimeSeries"], List[str]] = {}
+        # attributes which get the downsampled series
+        self.downsampled: Set[str] = set()
+        # key, timestamp and value of the buffered samples
+        self.buffer: List[Tuple[str, int, float]] = []
+        # labels of the series which have to be created before the samples are sent
+        self.new_keys: Dict[str, Dict[str, str]] = {}
+        self.known_keys: Set[str] = set()
+        # when the oldest buffered sample was added
+        self.buffered_at: Optional[float] = None
+        # flushes the buffer once the oldest sample is too old, see flush_expired()
+        self.flush_timer: Optional[threading.Timer] = None
+        self.flush_error: Optional[Exception] = None
+        # the lock guards the buffer against the timer
+        self.lock = threading.RLock()
+
+    def prepare_type(self, data_type: Type["TimeSeries"]) -> None:
+        self.attributes[data_type] = attributes_of(data_type)
+        self.downsampled.update(numeric_fields(data_type))
+
     def persist(self, point: "TimeSeries") -> None:
-        connection = Redis()
-        data = point.data
-        timestamp_ms = int(data.timestamp.timestamp() * 1000)
-
-        # let's create a key suffix per dimension
-        for dimension_name, dimension_value in data.dimensions.items():
-            labels = {}
-            labels[dimension_name] = dimension_value
-            # now let's create a key per attribute
-            for attribute_name, attribute_value in data.attributes.items():
-                labels["attribute"] = attribute_name
-                key_name = f"{point.Meta.table}:{attribute_name}:{dimension_name}-{dimension_value}"
-
-                connection.ts().add(
-                    key=key_name,
-                    timestamp=timestamp_ms,
-                    labels=labels,
-                    value=attribute_value,
+        self.persist_many([point])
+
+    def persist_many(self, points: List["TimeSeries"]) -> None:
+        with self.lock:
+            self.raise_flush_error()
+            self.buffer_points(points)
+
+    def buffer_points(self, points: List["TimeSeries"]) -> None:
+        table = points[0].Meta.table
+        dimension_names = points[0].Meta.dimensions
+        attributes = self.attributes[type(points[0])]
+        # keys of the attributes, per series
+        series_keys: Dict[Tuple[Any, ...], List[Tuple[str, str]]] = {}
+
+        for point in points:
+            series = tuple(
+                getattr(point, dimension_name) for dimension_name in dimension_names
+            )
+            keys = series_keys.get(series)
+            if keys is None:
+                keys = series_keys[series] = self.attribute_keys(
+                    table, dict(zip(dimension_names, series)), attributes
+                )
+
+            timestamp_ms = int(point.timestamp.timestamp() * 1000)
+            for attribute_name, key_name in keys:
+                self.buffer.append(
+                    (
+                        key_name,
+                        timestamp_ms,
+                        series_value(getattr(point, attribute_name)),
+                    )
                 )
 
+        if self.buffered_at is None:
+            self.buffered_at = time.monotonic()
+        if (
+            len(self.buffer) >= self.buffer_size
+            or time.monotonic() - self.buffered_at >= self.buffer_age
+        ):
+            self.flush()
+        elif self.flush_timer is None:
+            self.start_timer(self.buffer_age)
+
+    def start_timer(self, delay: float) -> None:
+        self.flush_timer = threading.Timer(delay, self.flush_expired)
+        self.flush_timer.daemon = True
+        self.flush_timer.start()
+
+    def flush_expired(self) -> None:
+        """Runs on the timer, flushes the buffer if the oldest sample is old enough.
+        Errors are raised from the next persist() or commit()"""
+        with self.lock:
+            self.flush_timer = None
+            if self.buffered_at is None:
+                return
+            remaining = self.buffered_at + self.buffer_age - time.monotonic()
+            if remaining > 0:
+                # the buffer was flushed and filled again since the timer started
+                self.start_timer(remaining)
+                return
+            try:
+                self.flush()
+            except Exception as error:
+                self.flush_error = error
+
+    def raise_flush_error(self) -> None:
+        if self.flush_error is not None:
+            error = self.flush_error
+            self.flush_error = None
+            raise error
+
+    def attribute_keys(
+        self, table: str, dimensions: Dict[str, Any], attributes: List[str]
+    ) -> List[Tuple[str, str]]:
+        """Returns the key of each attribute of the series and queues the creation
+        of the keys that were not seen yet"""
+        keys = []
+        for attribute_name in attributes:
+            key_name = series_key(table, dimensions, attribute_name)
+            if key_name not in self.known_keys:
+                self.known_keys.add(key_name)
+                self.new_keys[key_name] = series_labels(
+                    table, dimensions, attribute_name
+                )
+            keys.append((attribute_name, key_name))
+        return keys
+
+    def create_keys(self) -> None:
+        if not self.new_keys:
+            return
+
+        pipeline = self.connection.pipeline(transaction=False)
+        queued = queue_create(
+            pipeline, self.new_keys, self.options, self.downsampled
+        )
+        results = pipeline.execute(raise_on_error=False)
+        if queue_alter(pipeline, queued, results, self.options):
+            report_errors(pipeline.execute(raise_on_error=False))
+        self.new_keys = {}
+
+    def flush(self) -> None:
+        """Sends the buffered samples in a single pipeline. The buffer is kept if
+        the pipeline fails (i.e. the connection drops), so that the next flush()
+        sends it again"""
+        with self.lock:
+            if not self.buffer:
+                return
+
+            self.create_keys()
+            pipeline = self.connection.pipeline(transaction=False)
+            for offset in range(0, len(self.buffer), MADD_CHUNK_SIZE):
+                pipeline.ts().madd(self.buffer[offset : offset + MADD_CHUNK_SIZE])
+            results = pipeline.execute(raise_on_error=False)
+
+            # the samples reached redis, the ones it rejected would be rejected again
+            self.buffer = []
+            self.buffered_at = None
+            report_errors(results)
+
+    def commit(self) -> None:
+        with self.lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            self.raise_flush_error()
+            self.flush()
+
     def query(
         self,
         cls: Type["TimeSeries"],
         dimensions: Dict[str, Any],
         start_time: datetime,
         end_time: Optional[datetime] = None,
-    ) -> Iterable:
-        connection = Redis()
-        filters = []
+        fields: Optional[List[str]] = None,
+    ) -> Iterable[Union["TimeSeries", Dict[str, Any]]]:
+        """Yields the points of the matching series. If only the numeric fields are
+        requested and routing is on, a long enough range is answered from the
+        downsampled series, i.e. the dicts hold the averages of the buckets."""
+        attributes, bucket_ms = self.route(cls, start_time, end_time, fields)
+        yield from self.read_range(
+            cls, dimensions, start_time, end_time, fields, attributes, bucket_ms
+        )
+
+    def query_raw(
+        self,
+        cls: Type["TimeSeries"],
+        dimensions: Dict[str, Any],
+        start_time: datetime,
+        end_time: Optional[datetime] = None,
+        fields: Optional[List[str]] = None,
+    ) -> Iterable[Union["TimeSeries", Dict[str, Any]]]:
+        attributes, _ = self.route(cls, start_time, end_time, fields, raw=True)
+        yield from self.read_range(
+            cls, dimensions, start_time, end_time, fields, attributes, None
+        )
 
-        # note: we can make this way more efficient if we ask for just a single
-        # property, because then we don't need to reconstruct the objects, we
-        # can simply return the data as it comes from redis.
+    def downsamples(
+        self,
+        cls: Type["TimeSeries"],
+        start_time: datetime,
+        end_time: Optional[datetime],
+        fields: Optional[List[str]] = None,
+    ) -> bool:
+        return self.route(cls, start_time, end_time, fields)[1] is not None
 
-        output_values = defaultdict(dict)
-        output = []
+    def route(
+        self,
+        cls: Type["TimeSeries"],
+        start_time: datetime,
+        end_time: Optional[datetime],
+        fields: Optional[List[str]],
+        raw: bool = False,
+    ) -> Tuple[Optional[List[str]], Optional[int]]:
+        """Returns the attributes to fetch (None for all of them) and the bucket of
+        the downsampled series the range is answered from, if any"""
+        # if we're asked for some of the properties only, there's no need to fetch
+        # the series of the other attributes at all.
+        attributes = None
+        if fields is not None:
+            attributes = [
+                field for field in fields if field not in cls.Meta.dimensions
+            ]
 
-        for dimension_name, dimension_value in dimensions.items():
-            filters.append(f"{dimension_name}={dimension_value}")
+        bucket_ms = None
+        if not raw and attributes:
+            bucket_ms = self.options.route(start_time, end_time)
+        # only the numeric fields are downsampled, the averages can't stand in
+        # for the others
+        if bucket_ms is not None and not set(attributes) <= set(numeric_fields(cls)):
+            bucket_ms = None
+        return attributes, bucket_ms
 
-            for item in connection.ts().mrange(
-                from_time=(max(int(start_time.timestamp() * 1000), 0) or "-"),
-                to_time=(
-                    int(end_time.timestamp() * 1000) if end_time is not None else "+"
+    def read_range(
+        self,
+        cls: Type["TimeSeries"],
+        dimensions: Dict[str, Any],
+        start_time: datetime,
+        end_time: Optional[datetime],
+        fields: Optional[List[str]],
+        attributes: Optional[List[str]],
+        bucket_ms: Optional[int],
+    ) -> Iterable[Union["TimeSeries", Dict[str, Any]]]:
+        filters = query_filters(cls, dimensions, attributes, bucket_ms)
+        from_ms, to_ms = mrange_window(start_time, end_time)
+        tails: List[SeriesPage] = []
+        if bucket_ms is not None:
+            tails = [
+                page._replace(
+                    points=[point for point in page.points if point[0] >= from_ms]
+                )
+                for page in self.open_buckets(
+                    cls, dimensions, attributes, bucket_ms, from_ms, to_ms, "avg"
+                )
+            ]
+        # the range is read in pages of up to page_size samples per series, so the
+        # first points are available right away and the memory use stays flat
+        while True:
+            pages = read_page(
+                cls,
+                self.connection.ts().mrange(
+                    from_time=from_ms,
+                    to_time=to_ms,
+                    filters=filters,
+                    with_labels=True,
+                    count=self.page_size,
                 ),
+            )
+            horizon = page_horizon(pages, self.page_size)
+            for row in merge_page(pages + tails, horizon):
+                yield decode_row(cls, row, fields, bucket_ms is not None)
+            if horizon is None:
+                break
+            tails = [
+                page._replace(
+                    points=[point for point in page.points if point[0] > horizon]
+                )
+                for page in tails
+            ]
+            from_ms = horizon + 1
+
+    def open_buckets(
+        self,
+        cls: Type["TimeSeries"],
+        dimensions: Dict[str, Any],
+        attributes: Optional[List[str]],
+        rule_bucket_ms: int,
+        from_ms: int,
+        to_ms: Union[int, str],
+        func: str,
+        bucket_ms: Optional[int] = None,
+    ) -> List[SeriesPage]:
+        """Reads the last bucket of each raw series from the raw samples, as redis
+        adds it to the downsampled series only once a sample of the next bucket
+        arrives. The samples are aggregated by the func into buckets of bucket_ms
+        (the rule's bucket by default)."""
+        pipeline = self.connection.pipeline(transaction=False)
+        queued = []
+        for item in self.connection.ts().mget(
+            query_filters(cls, dimensions, attributes, None), with_labels=True
+        ):
+            for key, (labels, timestamp, _) in item.items():
+                if timestamp is None:
+                    continue
+                tail_ms = max(timestamp - timestamp % rule_bucket_ms, from_ms)
+                if to_ms != "+" and tail_ms > to_ms:
+                    continue
+                pipeline.ts().range(
+                    key,
+                    tail_ms,
+                    to_ms,
+                    aggregation_type=func,
+                    bucket_size_msec=bucket_ms or rule_bucket_ms,
+                )
+                queued.append(labels)
+
+        pages = []
+        for labels, points in zip(queued, pipeline.execute()):
+            series = tuple(
+                (dimension_name, labels.get(dimension_name))
+                for dimension_name in cls.Meta.dimensions
+            )
+            pages.append(SeriesPage(series, labels["attribute"], points))
+        return pages
+
+    def aggregate(
+        self,
+        cls: Type["TimeSeries"],
+        dimensions: Dict[str, Any],
+        start_time: datetime,
+        end_time: Optional[datetime],
+        bucket: timedelta,
+        funcs: List[str],
+        fields: List[str],
+    ) -> Iterable[Dict[str, Any]]:
+        # redis can aggregate the series by itself, we just need to ask for
+        # each of the functions separately. It does so series by series though,
+        # therefore the buckets of the matching series are combined here, which
+        # is why avg is computed from the sums and counts
+        connection = self.connection
+        bucket_ms = int(bucket.total_seconds() * 1000)
+        from_ms, to_ms = mrange_window(start_time, end_time)
+
+        redis_funcs: Set[str] = set()
+        for func in funcs:
+            redis_funcs.update(("sum", "count") if func == "avg" else (func,))
+
+        # values by the timestamp, the attribute and the function
+        combined: Dict[int, Dict[Tuple[str, str], float]] = defaultdict(dict)
+
+        for func in sorted(redis_funcs):
+            # min / max of the downsampled series are exact, so the coarsest of
+            # those which fit into the bucket can be used instead of the raw one
+            source_filters = ["aggregation="]
+            rules = [
+                rule
+                for rule in self.options.rules
+                if rule.func == func
+                and func in ("min", "max")
+                and bucket_ms % rule.bucket_ms == 0
+            ]
+            series_points = []
+            if rules:
+                rule = max(rules, key=lambda rule: rule.bucket_ms)
+                source_filters = [f"aggregation={func}", f"bucket={rule.bucket_ms}"]
+                # min / max of an overlapping range do not change the result
+                series_points.extend(
+                    (page.attribute, page.points)
+                    for page in self.open_buckets(
+                        cls,
+                        dimensions,
+                        fields,
+                        rule.bucket_ms,
+                        from_ms,
+                        to_ms,
+                        func,
+                        bucket_ms,
+                    )
+                )
+
+            for item in connection.ts().mrange(
+                from_time=from_ms or "-",
+                to_time=to_ms,
+                filters=dimension_filters(cls, dimensions)
+                + [f"attribute=({','.join(fields)})"]
+                + source_filters,
                 with_labels=True,
-                filters=filters,
+                aggregation_type=func,
+                bucket_size_msec=bucket_ms,
             ):
                 # _ is the key name which we don't need.
                 for _, values in item.items():
                     labels, points = values
-                    for point in points:
-                        timestamp, attrib_value = point
+                    series_points.append((labels["attribute"], points))
+
+            for attribute, points in series_points:
+                key = (attribute, func)
+                for timestamp, value in points:
+                    bucket_values = combined[timestamp]
+                    if key in bucket_values:
+                        value = COMBINE_FUNCS[func](bucket_values[key], value)
+                    bucket_values[key] = value
 
-                        output_values[timestamp][labels["attribute"]] = attrib_value
-                        output_values[timestamp][dimension_name] = dimension_value
+        for timestamp in sorted(combined):
+            bucket_values = combined[timestamp]
+            row: Dict[str, Any] = {
+                "timestamp": datetime.fromtimestamp(timestamp / 1000, timezone.utc)
+            }
+            for field in fields:
+                for func in funcs:
+                    if func == "avg":
+                        count = bucket_values.get((field, "count"))
+                        if count:
+                            row[f"{field}_avg"] = bucket_values[(field, "sum")] / count
+                    elif (field, func) in bucket_values:
+                        value = bucket_values[(field, func)]
+                        if func == "count":
+                            value = int(value)
+                        row[f"{field}_{func}"] = value
+            yield row
 
-            for timestamp, values in output_values.items():
-                values["timestamp"] = timestamp
-                output.append(values)
 
-            output.sort(key=itemgetter("timestamp"))
+class AsyncRedisBackend(AsyncBackend):
+    """RedisBackend on top of the redis.asyncio client. The keys and labels are the
+    same, so both can be used on the same data. Each point is written with a single
+    TS.MADD, as the writes are concurrent anyway."""
+
+    def __init__(self, connection: Optional[AsyncRedis] = None):
+        if connection is None:
+            connection = AsyncRedis.from_url(redis_url())
+        self.connection = connection
+        self.options = SeriesOptions.from_env()
+        self.page_size = int(
+            os.environ.get("TIME_SERIES_REDIS_QUERY_PAGE_SIZE", QUERY_PAGE_SIZE_DEFAULT)
+        )
+        self.attributes: Dict[Type["TimeSeries"], List[str]] = {}
+        # attributes which get the downsampled series
+        self.downsampled: Set[str] = set()
+        self.known_keys: Set[str] = set()
+        # the keys are created one batch at a time, so that no task writes to a key
+        # which another task is still creating
+        self.create_lock = asyncio.Lock()
+
+    async def prepare_type(self, data_type: Type["TimeSeries"]) -> None:
+        self.attributes[data_type] = attributes_of(data_type)
+        self.downsampled.update(numeric_fields(data_type))
+
+    async def persist(self, point: "TimeSeries") -> None:
+        table = point.Meta.table
+        timestamp_ms = int(point.timestamp.timestamp() * 1000)
+        dimensions = {
+            dimension_name: getattr(point, dimension_name)
+            for dimension_name in point.Meta.dimensions
+        }
+
+        new_keys = {}
+        samples = []
+        for attribute_name in self.attributes[type(point)]:
+            key_name = series_key(table, dimensions, attribute_name)
+            if key_name not in self.known_keys:
+                new_keys[key_name] = series_labels(table, dimensions, attribute_name)
+            samples.append(
+                (key_name, timestamp_ms, series_value(getattr(point, attribute_name)))
+            )
+
+        if new_keys:
+            await self.create_keys(new_keys)
+
+        report_errors([await self.connection.ts().madd(samples)])
+
+    async def create_keys(self, new_keys: Dict[str, Dict[str, str]]) -> None:
+        """Creates the series, the keys are known only once they exist"""
+        async with self.create_lock:
+            # another task may have created some of them in the meantime
+            new_keys = {
+                key_name: labels
+                for key_name, labels in new_keys.items()
+                if key_name not in self.known_keys
+            }
+            if not new_keys:
+                return
+
+            pipeline = self.connection.pipeline(transaction=False)
+            queued = queue_create(pipeline, new_keys, self.options, self.downsampled)
+            results = await pipeline.execute(raise_on_error=False)
+            if queue_alter(pipeline, queued, results, self.options):
+                report_errors(await pipeline.execute(raise_on_error=False))
+            self.known_keys.update(new_keys)
+
+    async def query(
+        self,
+        cls: Type["TimeSeries"],
+        dimensions: Dict[str, Any],
+        start_time: datetime,
+        end_time: Optional[datetime] = None,
+        fields: Optional[List[str]] = None,
+    ) -> AsyncIterator[Union["TimeSeries", Dict[str, Any]]]:
+        attributes = None
+        if fields is not None:
+            attributes = [
+                field for field in fields if field not in cls.Meta.dimensions
+            ]
+
+        filters = query_filters(cls, dimensions, attributes, None)
+        from_ms, to_ms = mrange_window(start_time, end_time)
+        while True:
+            pages = read_page(
+                cls,
+                await self.connection.ts().mrange(
+                    from_time=from_ms,
+                    to_time=to_ms,
+                    filters=filters,
+                    with_labels=True,
+                    count=self.page_size,
+                ),
+            )
+            horizon = page_horizon(pages, self.page_size)
+            for row in merge_page(pages, horizon):
+                yield decode_row(cls, row, fields, False)
+            if horizon is None:
+                break
+            from_ms = horizon + 1
 
-            return output
+    async def commit(self) -> None:
+        await self.connection.close()
@@ -0,0 +1,186 @@
+"""In-memory stand-ins for the redis and timestream services, so that the benchmarks
+can run offline. They measure the work done on the client side (encoding, batching,
+paging and decoding), not the one of the real services."""
+import re
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from backends.aws_timestream import TimeStreamBackend
+from backends.redis import RedisBackend
+
+# rows per page returned by the fake timestream query
+TIMESTREAM_PAGE_SIZE = 1000
+
+
+def late_samples_sorted() -> bool:
+    """Tells whether fakeredis keeps a series sorted when a late sample arrives, as
+    redis does. Checked with the public TS commands on a throwaway server."""
+    import fakeredis
+
+    connection = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+    connection.ts().create("probe")
+    connection.ts().madd([("probe", 2, 2.0), ("probe", 1, 1.0)])
+    samples = connection.ts().range("probe", "-", "+")
+    return [timestamp for timestamp, _ in samples] == [1, 2]
+
+
+def keep_samples_sorted() -> None:
+    """Up to fakeredis 2.39 (pinned in requirements.txt), the late samples are
+    appended to the end of the series, which breaks the range queries (i.e. TS.MRANGE
+    COUNT pages in the insertion order), so the series are re-sorted after such a
+    sample. There's no public hook for that, therefore the fix is only applied when
+    the public commands show it's needed."""
+    if late_samples_sorted():
+        return
+
+    try:
+        from fakeredis.model._timeseries_model import TimeSeries
+    except ImportError as error:
+        raise ImportError(
+            f"fakeredis does not keep the late samples sorted: {error}"
+        ) from error
+
+    add = TimeSeries.add
+    if getattr(add, "keeps_sorted", False):
+        return
+
+    def sorted_add(self, timestamp, value, duplicate_policy=None):
+        late = timestamp < self.max_timestamp and timestamp not in self.ts_ind_map
+        result = add(self, timestamp, value, duplicate_policy)
+        if late:
+            self.sorted_list.sort()
+            self.ts_ind_map = {
+                sample[0]: index for index, sample in enumerate(self.sorted_list)
+            }
+        return result
+
+    sorted_add.keeps_sorted = True
+    TimeSeries.add = sorted_add
+
+
+class FakeRedisBackend(RedisBackend):
+    """The redis backend connected to a fakeredis server, shared by all the
+    instances so that the data outlives the storage session"""
+
+    server: Any = None
+
+    def __init__(self):
+        import fakeredis
+
+        if FakeRedisBackend.server is None:
+            keep_samples_sorted()
+            FakeRedisBackend.server = fakeredis.FakeServer()
+        super().__init__(connection=fakeredis.FakeRedis(server=self.server))
+
+
+class FakeTimeStream:
+    """Keeps the written records and answers the queries the backend sends, i.e.
+    SELECT time, city, ... FROM "db"."table" WHERE ... ORDER BY time"""
+
+    def __init__(self):
+        # records by the table, along with the dimensions of their batch
+        self.tables: Dict[str, List[Tuple[Dict[str, str], Dict[str, Any]]]] = {}
+        # the result of the last query, which is being paged through
+        self.last_query: Optional[str] = None
+        self.last_rows: List[Tuple[int, Dict[str, str], Dict[str, Any]]] = []
+
+    def write_records(self, **kwargs: Any) -> Dict[str, Any]:
+        dimensions = {
+            dimension["Name"]: dimension["Value"]
+            for dimension in kwargs["CommonAttributes"]["Dimensions"]
+        }
+        records = self.tables.setdefault(kwargs["TableName"], [])
+        for record in kwargs["Records"]:
+            records.append((dimensions, record))
+        total = len(kwargs["Records"])
+        return {
+            "RecordsIngested": {
+                "Total": total,
+                "MemoryStore": total,
+                "MagneticStore": 0,
+            }
+        }
+
+    def query(self, QueryString: str, NextToken: Optional[str] = None) -> Dict:
+        columns = [
+            column.strip()
+            for column in re.search(r"SELECT (.*?) FROM", QueryString)
+            .group(1)
+            .split(",")
+        ]
+        if NextToken is None or QueryString != self.last_query:
+            self.last_query = QueryString
+            self.last_rows = self.select(QueryString)
+        rows = self.last_rows
+        offset = int(NextToken or 0)
+        page = rows[offset : offset + TIMESTREAM_PAGE_SIZE]
+
+        types: Dict[str, str] = {"time": "TIMESTAMP"}
+        result_rows = []
+        for timestamp, dimensions, record in page:
+            values: Dict[str, Any] = dict(dimensions)
+            values["time"] = datetime.fromtimestamp(
+                timestamp / 1000, timezone.utc
+            ).strftime("%Y-%m-%d %H:%M:%S.%f000")
+            for measure in record["MeasureValues"]:
+                values[measure["Name"]] = measure["Value"]
+                types[measure["Name"]] = measure["Type"]
+            result_rows.append(
+                {
+                    "Data": [
+                        {"NullValue": True}
+                        if values.get(column) is None
+                        else {"ScalarValue": values[column]}
+                        for column in columns
+                    ]
+                }
+            )
+
+        response = {
+            "QueryId": "benchmark",
+            "Rows": result_rows,
+            "ColumnInfo": [
+                {"Name": column, "Type": {"ScalarType": types.get(column, "VARCHAR")}}
+                for column in columns
+            ],
+        }
+        if offset + TIMESTREAM_PAGE_SIZE < len(rows):
+            response["NextToken"] = str(offset + TIMESTREAM_PAGE_SIZE)
+        return response
+
+    def select(
+        self, QueryString: str
+    ) -> List[Tuple[int, Dict[str, str], Dict[str, Any]]]:
+        table = re.search(r'FROM "[^"]*"\."([^"]*)"', QueryString).group(1)
+        start = re.search(r"time >= from_milliseconds\((\d+)\)", QueryString)
+        end = re.search(r"time <= from_milliseconds\((\d+)\)", QueryString)
+        predicates = {
+            name: set(re.findall(r"'((?:[^']|'')*)'", values))
+            for name, values in re.findall(
+                r"(\w+) (?:=|IN) (\('.*?'\)|'.*?')", QueryString
+            )
+            if name != "measure_name"
+        }
+
+        return sorted(
+            (
+                (int(record["Time"]), dimensions, record)
+                for dimensions, record in self.tables.get(table, [])
+                if (start is None or int(record["Time"]) >= int(start.group(1)))
+                and (end is None or int(record["Time"]) <= int(end.group(1)))
+                and all(
+                    dimensions.get(name) in allowed
+                    for name, allowed in predicates.items()
+                )
+            ),
+            key=lambda row: row[0],
+        )
+
+
+class FakeTimeStreamBackend(TimeStreamBackend):
+    service: Optional[FakeTimeStream] = None
+
+    def __init__(self):
+        if FakeTimeStreamBackend.service is None:
+            FakeTimeStreamBackend.service = FakeTimeStream()
+        super().__init__(writer=self.service, querier=self.service)
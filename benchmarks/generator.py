@@ -0,0 +1,49 @@
+"""Synthetic weather points for the benchmarks"""
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from random import Random
+from typing import List
+
+from schemas.weather import Description, Weather
+
+START_DEFAULT = datetime(2023, 1, 1, tzinfo=timezone.utc)
+
+
+def series_name(series: int) -> str:
+    return f"city-{series:04d}"
+
+
+def generate_points(
+    series: int,
+    points_per_series: int,
+    out_of_order: float = 0.0,
+    span: timedelta = timedelta(days=7),
+    start: datetime = START_DEFAULT,
+    seed: int = 0,
+) -> List[Weather]:
+    """Returns the points of all the series, spread evenly over the span and
+    interleaved by the time, as a collector would write them. The out_of_order
+    ratio of the points arrive late, at a random later position of the stream."""
+    random = Random(seed)
+    step = span / points_per_series
+    points = [
+        Weather(
+            timestamp=start + step * index,
+            city=series_name(series_index),
+            temperature=Decimal(random.randrange(-300, 500)) / 10,
+            rainfall=random.randrange(0, 200),
+            description=random.choice(list(Description)),
+        )
+        for index in range(points_per_series)
+        for series_index in range(series)
+    ]
+
+    # the late points are moved by sorting on their arrival position
+    arrivals = [
+        position + random.random() * (len(points) - position)
+        if random.random() < out_of_order
+        else position
+        for position in range(len(points))
+    ]
+    order = sorted(range(len(points)), key=arrivals.__getitem__)
+    return [points[position] for position in order]
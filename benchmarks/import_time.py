@@ -0,0 +1,68 @@
+"""Measures how long it takes to import the storage along with the selected backend,
+each run in a fresh interpreter. The "eager" variant imports all the backends, which
+is what storage.py used to do before the backends were loaded on selection.
+
+    python benchmarks/import_time.py [--runs 10]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ALL_BACKENDS = (
+    "import backends.filesystem.backend, backends.redis, backends.print, "
+    "backends.aws_timestream"
+)
+
+LAZY = """
+import time
+start = time.perf_counter()
+import storage
+storage.load_backend({name!r}, storage.BACKENDS, storage.BACKENDS_ENTRY_POINTS)
+print(time.perf_counter() - start)
+"""
+
+EAGER = f"""
+import time
+start = time.perf_counter()
+import storage
+{ALL_BACKENDS}
+print(time.perf_counter() - start)
+"""
+
+
+def measure(code: str, runs: int) -> float:
+    """Returns the median time of the runs, in milliseconds"""
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=ROOT,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        timings.append(float(output.strip().splitlines()[-1]) * 1000)
+    return statistics.median(timings)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    sys.path.insert(0, ROOT)
+    from storage import BACKENDS
+
+    results = {"eager_ms": measure(EAGER, args.runs)}
+    for name in BACKENDS:
+        results[f"{name}_ms"] = measure(LAZY.format(name=name), args.runs)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
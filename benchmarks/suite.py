@@ -0,0 +1,213 @@
+"""Measures the ingest, commit and query performance of the backends on synthetic
+weather data and prints the results as json, i.e.
+
+    python benchmarks/suite.py --backends fs,redis --series 10 --points 10000
+
+The redis and timestream backends run against in-memory stand-ins (see fakes.py),
+so everything works offline.
+"""
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import timedelta
+from random import Random
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.generator import START_DEFAULT, generate_points, series_name  # noqa
+from storage import BACKENDS, Storage  # noqa
+
+BACKENDS_DEFAULT = "fs,print,redis,timestream"
+
+# the stand-ins are registered under the names of the backends they replace
+FAKE_BACKENDS = {
+    "redis": "benchmarks.fakes:FakeRedisBackend",
+    "timestream": "benchmarks.fakes:FakeTimeStreamBackend",
+}
+
+
+def percentiles(timings: List[float]) -> Dict[str, float]:
+    timings = sorted(timings)
+
+    def percentile(ratio: float) -> float:
+        return timings[min(len(timings) - 1, int(ratio * len(timings)))]
+
+    return {
+        "p50": percentile(0.5),
+        "p90": percentile(0.9),
+        "p99": percentile(0.99),
+        "max": timings[-1],
+    }
+
+
+def elapsed_ms(function: Callable[[], Any]) -> float:
+    start = time.perf_counter()
+    function()
+    return (time.perf_counter() - start) * 1000
+
+
+def ingest(storage: Storage, points: List[Any], bulk: bool) -> None:
+    if bulk:
+        storage.add_many(points)
+    else:
+        for point in points:
+            storage.add(point)
+
+
+def timed_query(storage: Storage, *args: Any) -> Tuple[float, int]:
+    """Runs the query to the end, returns its latency and the number of points"""
+    start = time.perf_counter()
+    count = sum(1 for _ in storage.query(*args))
+    return (time.perf_counter() - start) * 1000, count
+
+
+def directory_size(path: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(root, file))
+        for root, _, files in os.walk(path)
+        for file in files
+    )
+
+
+@contextlib.contextmanager
+def backend_environment(backend: str, args: argparse.Namespace) -> Iterator[Dict]:
+    """Selects the backend (or its stand-in) for the storage created within"""
+    saved_environ = dict(os.environ)
+    saved_backend = BACKENDS.get(backend)
+    context: Dict[str, Any] = {"root": None}
+    os.environ["TIME_SERIES_BACKEND"] = backend
+    if backend in FAKE_BACKENDS:
+        BACKENDS[backend] = FAKE_BACKENDS[backend]
+    if backend == "fs":
+        context["root"] = tempfile.mkdtemp(prefix="pensieve-benchmark-")
+        os.environ["TIME_SERIES_FS_ROOT"] = context["root"]
+        os.environ["TIME_SERIES_FS_COMMIT_STRATEGY"] = args.commit_strategy
+    try:
+        yield context
+    finally:
+        os.environ.clear()
+        os.environ.update(saved_environ)
+        if saved_backend is not None:
+            BACKENDS[backend] = saved_backend
+        if context["root"] is not None:
+            shutil.rmtree(context["root"])
+
+
+def run_backend(backend: str, args: argparse.Namespace) -> Dict[str, Any]:
+    span = timedelta(days=args.span_days)
+    points = generate_points(
+        args.series, args.points, args.out_of_order, span, seed=args.seed
+    )
+    # the backfill goes into the already committed range, which makes the
+    # filesystem backend merge the new points into the existing files
+    backfill = generate_points(
+        args.series,
+        max(1, int(args.points * args.backfill)),
+        out_of_order=0.0,
+        span=span,
+        start=START_DEFAULT + span / (2 * args.points),
+        seed=args.seed + 1,
+    )
+    results: Dict[str, Any] = {"points": len(points), "backfill_points": len(backfill)}
+    random = Random(args.seed)
+
+    with backend_environment(backend, args) as context, open(
+        os.devnull, "w"
+    ) as devnull, contextlib.redirect_stdout(devnull):
+        with Storage() as storage:
+            add_ms = elapsed_ms(lambda: ingest(storage, points, args.bulk))
+            results["add_points_per_sec"] = len(points) / (add_ms / 1000)
+            results["commit_ms"] = elapsed_ms(storage.flush)
+
+        with Storage() as storage:
+            ingest(storage, backfill, args.bulk)
+            results["backfill_commit_ms"] = elapsed_ms(storage.flush)
+
+        cls = type(points[0])
+        with Storage() as storage:
+            narrow, wide = [], []
+            narrow_points = wide_points = 0
+            for _ in range(args.queries):
+                start_time = START_DEFAULT + span * random.random()
+                city = series_name(random.randrange(args.series))
+                latency, count = timed_query(
+                    storage,
+                    cls,
+                    {"city": city},
+                    start_time,
+                    start_time + timedelta(hours=1),
+                )
+                narrow.append(latency)
+                narrow_points += count
+            for _ in range(max(1, args.queries // 10)):
+                latency, wide_points = timed_query(
+                    storage, cls, {}, START_DEFAULT, START_DEFAULT + span
+                )
+                wide.append(latency)
+            results["query_narrow_ms"] = percentiles(narrow)
+            results["query_narrow_points"] = narrow_points / len(narrow)
+            results["query_wide_ms"] = percentiles(wide)
+            results["query_wide_points"] = wide_points
+
+        results["bytes_per_point"] = None
+        if context["root"] is not None:
+            results["bytes_per_point"] = directory_size(context["root"]) / (
+                len(points) + len(backfill)
+            )
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backends", default=BACKENDS_DEFAULT)
+    parser.add_argument("--series", type=int, default=10)
+    parser.add_argument("--points", type=int, default=1000, help="points per series")
+    parser.add_argument(
+        "--out-of-order", type=float, default=0.05, help="ratio of the late points"
+    )
+    parser.add_argument("--span-days", type=float, default=7)
+    parser.add_argument(
+        "--backfill",
+        type=float,
+        default=0.1,
+        help="points written into the committed range, relative to --points",
+    )
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument(
+        "--commit-strategy", default="inplace", choices=("inplace", "rewrite")
+    )
+    parser.add_argument("--bulk", action="store_true", help="use add_many()")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the json to the file as well")
+    args = parser.parse_args(argv)
+
+    report: Dict[str, Any] = {
+        "config": {
+            key: value for key, value in vars(args).items() if key != "output"
+        },
+        "python": sys.version.split()[0],
+        "backends": {},
+    }
+    for backend in args.backends.split(","):
+        try:
+            report["backends"][backend] = run_backend(backend, args)
+        except ImportError as error:
+            # i.e. fakeredis is not installed
+            report["backends"][backend] = {"skipped": str(error)}
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
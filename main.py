@@ -27,6 +27,9 @@ with Storage() as storage:
                 )
             )
 
+    if "-compact" in sys.argv:
+        storage.compact(Weather)
+
     for measurement in storage.query(
         Weather,
         dimensions={"city": CITY},
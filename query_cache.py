@@ -0,0 +1,245 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+    Union,
+)
+
+from backends.backend import dimension_filter, matches_dimensions
+
+if TYPE_CHECKING:
+    from schema import TimeSeries
+
+# the buckets are aligned to the days (in UTC), just like the partitions of the
+# filesystem backend
+BUCKET = timedelta(days=1)
+# how long the bucket of the current day is cached, in seconds
+OPEN_BUCKET_TTL_DEFAULT = 5.0
+
+DimensionsKey = Tuple[Tuple[str, Optional[FrozenSet[str]]], ...]
+CacheKey = Tuple[Type["TimeSeries"], DimensionsKey, Optional[Tuple[str, ...]], datetime]
+
+
+@dataclass
+class CacheEntry:
+    points: List[Any]
+    size: int
+    # monotonic time the entry expires at, None for the sealed buckets
+    expires_at: Optional[float] = None
+
+
+def bucket_start(timestamp: datetime) -> datetime:
+    timestamp = timestamp.astimezone(timezone.utc)
+    return datetime(timestamp.year, timestamp.month, timestamp.day, tzinfo=timezone.utc)
+
+
+def buckets(start_time: datetime, end_time: datetime) -> Iterable[datetime]:
+    bucket = bucket_start(start_time)
+    while bucket <= end_time:
+        yield bucket
+        bucket += BUCKET
+
+
+def dimensions_key(
+    cls: Type["TimeSeries"], dimensions: Dict[str, Any]
+) -> DimensionsKey:
+    return tuple(
+        (dimension_name, None if values is None else frozenset(values))
+        for dimension_name, values in dimension_filter(cls, dimensions).items()
+    )
+
+
+def point_timestamp(point: Union["TimeSeries", Dict[str, Any]]) -> datetime:
+    if isinstance(point, dict):
+        return point["timestamp"]
+    return point.timestamp
+
+
+def point_size(point: Union["TimeSeries", Dict[str, Any]]) -> int:
+    """Rough estimate of the memory held by the point"""
+    values = point if isinstance(point, dict) else point.__dict__
+    return (
+        sys.getsizeof(point)
+        + sys.getsizeof(values)
+        + sum(sys.getsizeof(value) for value in values.values())
+    )
+
+
+class QueryCache:
+    """Caches the query results per series predicate and day. The past days
+    (sealed buckets) are kept until they're evicted by the LRU policy, the current
+    day only for a short while, as the points keep coming.
+
+    Writes invalidate the buckets of the series they touch. As the backends do not
+    have to show the points before the commit, the touched buckets are not cached
+    again until committed() is called. A result read from the backend is only
+    stored if no write (or commit) changed its bucket in the meantime."""
+
+    def __init__(
+        self, max_bytes: int, open_bucket_ttl: float = OPEN_BUCKET_TTL_DEFAULT
+    ):
+        self.max_bytes = max_bytes
+        self.open_bucket_ttl = open_bucket_ttl
+        self.entries: "OrderedDict[CacheKey, CacheEntry]" = OrderedDict()
+        # keys of the cached entries, by the type and the bucket
+        self.bucket_keys: Dict[Tuple[Type["TimeSeries"], datetime], Set[CacheKey]] = {}
+        # bumped on every invalidation of the bucket
+        self.versions: Dict[Tuple[Type["TimeSeries"], datetime], int] = {}
+        # buckets with the points which were not committed yet
+        self.pending: Set[Tuple[Type["TimeSeries"], datetime]] = set()
+        # estimated size of a point, per type (and fields)
+        self.point_sizes: Dict[Tuple[Type["TimeSeries"], Any], int] = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def query(
+        self,
+        read: Any,
+        cls: Type["TimeSeries"],
+        dimensions: Dict[str, Any],
+        start_time: datetime,
+        end_time: datetime,
+        fields: Optional[List[str]] = None,
+    ) -> Iterable[Union["TimeSeries", Dict[str, Any]]]:
+        """Yields the points of the range, bucket by bucket. The missing buckets are
+        read as a whole with read(cls, dimensions, start, end, fields)"""
+        predicates = dimensions_key(cls, dimensions)
+        fields_key = tuple(fields) if fields is not None else None
+
+        for bucket in buckets(start_time, end_time):
+            key = (cls, predicates, fields_key, bucket)
+            points = self.get(key)
+            if points is None:
+                version = self.version(cls, bucket)
+                points = list(
+                    read(
+                        cls,
+                        dimensions,
+                        bucket,
+                        bucket + BUCKET - timedelta(microseconds=1),
+                        fields,
+                    )
+                )
+                self.put(key, points, version)
+
+            if bucket < start_time or bucket + BUCKET > end_time:
+                # the edges of the range only cover a part of the bucket
+                for point in points:
+                    if start_time <= point_timestamp(point) <= end_time:
+                        yield point
+            else:
+                yield from points
+
+    def get(self, key: CacheKey) -> Optional[List[Any]]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (
+                entry.expires_at is None or entry.expires_at > time.monotonic()
+            ):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry.points
+            if entry is not None:
+                self.remove(key)
+            self.misses += 1
+            return None
+
+    def put(self, key: CacheKey, points: List[Any], version: int) -> None:
+        cls, _, fields_key, bucket = key
+        with self.lock:
+            if (
+                self.versions.get((cls, bucket), 0) != version
+                or (cls, bucket) in self.pending
+            ):
+                # a write got in while the bucket was being read
+                return
+
+            if points and (cls, fields_key) not in self.point_sizes:
+                self.point_sizes[(cls, fields_key)] = point_size(points[0])
+            size = sys.getsizeof(points) + len(points) * self.point_sizes.get(
+                (cls, fields_key), 0
+            )
+            if size > self.max_bytes:
+                return
+
+            expires_at = None
+            if bucket + BUCKET > datetime.now(timezone.utc):
+                expires_at = time.monotonic() + self.open_bucket_ttl
+
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = CacheEntry(points, size, expires_at)
+            self.bucket_keys.setdefault((cls, bucket), set()).add(key)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+
+    def version(self, cls: Type["TimeSeries"], bucket: datetime) -> int:
+        with self.lock:
+            return self.versions.get((cls, bucket), 0)
+
+    def invalidate(self, points: Iterable["TimeSeries"]) -> None:
+        """Drops the cached buckets which the points fall into"""
+        touched: Dict[Tuple[Type["TimeSeries"], datetime], Set[Tuple[str, ...]]] = {}
+        for point in points:
+            touched.setdefault((type(point), bucket_start(point.timestamp)), set()).add(
+                tuple(
+                    str(getattr(point, dimension_name))
+                    for dimension_name in point.Meta.dimensions
+                )
+            )
+
+        with self.lock:
+            for (cls, bucket), series in touched.items():
+                self.versions[(cls, bucket)] = self.versions.get((cls, bucket), 0) + 1
+                self.pending.add((cls, bucket))
+                for key in list(self.bucket_keys.get((cls, bucket), ())):
+                    predicates = dict(key[1])
+                    if any(
+                        matches_dimensions(
+                            dict(zip(cls.Meta.dimensions, values)), predicates
+                        )
+                        for values in series
+                    ):
+                        self.remove(key)
+
+    def committed(self) -> None:
+        """The written points are visible in the backend, so their buckets can be
+        cached again"""
+        with self.lock:
+            for bucket in self.pending:
+                self.versions[bucket] = self.versions.get(bucket, 0) + 1
+            self.pending = set()
+
+    def remove(self, key: CacheKey) -> None:
+        entry = self.entries.pop(key)
+        self.size -= entry.size
+        cls, _, _, bucket = key
+        keys = self.bucket_keys[(cls, bucket)]
+        keys.discard(key)
+        if not keys:
+            del self.bucket_keys[(cls, bucket)]
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "bytes": self.size,
+            }
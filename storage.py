@@ -1,23 +1,109 @@
-from datetime import datetime
+import asyncio
+import threading
+import time
+from datetime import datetime, timedelta
+from importlib import import_module
+from itertools import islice
 from os import environ
-from typing import TYPE_CHECKING, Any, Dict, Iterable, Optional, Type
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Type,
+    Union,
+)
 
-from backends.aws_timestream import TimeStreamBackend
-from backends.backend import Backend
-from backends.filesystem.backend import FileSystemBackend
-from backends.print import PrintBackend
-from backends.redis import RedisBackend
+from backends.aggregation import AGGREGATION_FUNCS, numeric_fields, validate_funcs
+from backends.async_backend import AsyncBackend, ExecutorBackend
+from backends.backend import ALL, Backend
+from query_cache import OPEN_BUCKET_TTL_DEFAULT, QueryCache
 
 if TYPE_CHECKING:
+    from importlib.metadata import EntryPoint
+
     from .schema import TimeSeries
 
-BACKENDS = {
-    "fs": FileSystemBackend,
-    "redis": RedisBackend,
-    "print": PrintBackend,
-    "timestream": TimeStreamBackend,
+# the backends are given as "module:Class" and imported only once selected, so
+# that i.e. the filesystem backend does not have to wait for boto3 to load
+BACKENDS: Dict[str, Union[str, Type["Backend"]]] = {
+    "fs": "backends.filesystem.backend:FileSystemBackend",
+    "redis": "backends.redis:RedisBackend",
+    "print": "backends.print:PrintBackend",
+    "timestream": "backends.aws_timestream:TimeStreamBackend",
+}
+
+# backends with a native asyncio client, the others are run in threads
+ASYNC_BACKENDS: Dict[str, Union[str, Type["AsyncBackend"]]] = {
+    "redis": "backends.redis:AsyncRedisBackend",
 }
 
+# other packages can provide backends via these entry point groups, i.e.
+# [project.entry-points."pensieve.backends"] influx = "pensieve_influx:Backend"
+BACKENDS_ENTRY_POINTS = "pensieve.backends"
+ASYNC_BACKENDS_ENTRY_POINTS = "pensieve.async_backends"
+
+# how many points are handed to the backend at once by add_many()
+ADD_MANY_CHUNK_SIZE = 10000
+
+# how long the buffered points may wait for the flush, in seconds
+BUFFER_MAX_AGE_DEFAULT = 1.0
+
+# how many writes can be in flight at once
+ASYNC_MAX_IN_FLIGHT_DEFAULT = 100
+
+
+def find_entry_point(group: str, name: str) -> Optional["EntryPoint"]:
+    # importing the metadata takes a while, it's only needed for the unknown names
+    from importlib.metadata import entry_points
+
+    found = entry_points()
+    if hasattr(found, "select"):
+        candidates = found.select(group=group, name=name)
+    else:
+        # python < 3.10 returns a dict of the groups
+        candidates = [
+            entry_point
+            for entry_point in found.get(group, [])
+            if entry_point.name == name
+        ]
+    return next(iter(candidates), None)
+
+
+def load_backend(
+    name: str, registry: Dict[str, Union[str, Type[Any]]], group: str
+) -> Optional[Type[Any]]:
+    """Returns the class of the backend, importing it on the first use. Backends
+    which are not in the registry are looked up in the entry points"""
+    backend = registry.get(name)
+    if backend is None:
+        entry_point = find_entry_point(group, name)
+        if entry_point is None:
+            return None
+        backend = entry_point.load()
+    elif isinstance(backend, str):
+        module_name, _, class_name = backend.partition(":")
+        backend = getattr(import_module(module_name), class_name)
+    registry[name] = backend
+    return backend
+
+
+def selected_backend_name() -> str:
+    selected_backend = environ.get("TIME_SERIES_BACKEND")
+    if selected_backend is None:
+        raise ValueError("No backend selected; Specify TIME_SERIES_BACKEND variable.")
+    if (
+        selected_backend not in BACKENDS
+        and find_entry_point(BACKENDS_ENTRY_POINTS, selected_backend) is None
+    ):
+        raise ValueError("Invalid backend selected")
+    return selected_backend
+
 
 class Storage:
     backend: "Backend"
@@ -28,23 +114,167 @@ class Storage:
     #     pass
 
     def __enter__(self) -> "Storage":
-        selected_backend = environ.get("TIME_SERIES_BACKEND")
-        if selected_backend is None:
-            raise ValueError(
-                "No backend selected; Specify TIME_SERIES_BACKEND variable."
-            )
-        if selected_backend not in BACKENDS:
-            raise ValueError("Invalid backend selected")
-        self.backend = BACKENDS[selected_backend]()
+        self.backend = load_backend(
+            selected_backend_name(), BACKENDS, BACKENDS_ENTRY_POINTS
+        )()
         self.prepared = {}
+        # the compactor lists the prepared types while add() may be adding one
+        self.prepare_lock = threading.Lock()
+
+        self.query_cache: Optional[QueryCache] = None
+        query_cache_mb = environ.get("TIME_SERIES_QUERY_CACHE_MB")
+        if query_cache_mb is not None:
+            self.query_cache = QueryCache(
+                int(float(query_cache_mb) * 1024 * 1024),
+                open_bucket_ttl=float(
+                    environ.get(
+                        "TIME_SERIES_QUERY_CACHE_TTL", OPEN_BUCKET_TTL_DEFAULT
+                    )
+                ),
+            )
+
+        # in the buffered mode the points are written (and committed) by the flusher
+        self.flusher: Optional[threading.Thread] = None
+        buffer_max_points = environ.get("TIME_SERIES_BUFFER_MAX_POINTS")
+        if buffer_max_points is not None:
+            self.buffer_max_points = int(buffer_max_points)
+            self.buffer_max_age = float(
+                environ.get("TIME_SERIES_BUFFER_MAX_AGE", BUFFER_MAX_AGE_DEFAULT)
+            )
+            self.buffer: List["TimeSeries"] = []
+            self.buffered_at: Optional[float] = None
+            self.buffer_condition = threading.Condition()
+            # the flusher and flush() must not write to the backend at once
+            self.flush_lock = threading.Lock()
+            self.flush_error: Optional[BaseException] = None
+            self.flusher_stopped = False
+            self.flusher = threading.Thread(target=self.run_flusher, daemon=True)
+            self.flusher.start()
+
+        # compacts the series that were used so far in the background
+        self.compactor: Optional[threading.Thread] = None
+        compaction_interval = environ.get("TIME_SERIES_COMPACTION_INTERVAL")
+        if compaction_interval is not None:
+            self.compaction_interval = float(compaction_interval)
+            self.compactor_stopped = threading.Event()
+            self.compactor = threading.Thread(target=self.run_compactor, daemon=True)
+            self.compactor.start()
         return self
 
     def add(self, data: "TimeSeries") -> None:
-        data_type = type(data)
-        if data_type not in self.prepared:
-            self.backend.prepare_type(data_type)
-            self.prepared[data_type] = True
+        if self.flusher is not None:
+            self.enqueue([data])
+            return
+        self.prepare(type(data))
         self.backend.persist(data)
+        if self.query_cache is not None:
+            self.query_cache.invalidate([data])
+
+    def add_many(self, points: Iterable["TimeSeries"]) -> None:
+        """Persists the points in batches. The points are grouped by the type, so
+        that the backend can write each series in one go, which is a lot cheaper
+        than calling add() for every point"""
+        iterator = iter(points)
+        while True:
+            chunk = list(islice(iterator, ADD_MANY_CHUNK_SIZE))
+            if not chunk:
+                break
+            if self.flusher is not None:
+                self.enqueue(chunk)
+            else:
+                self.write(chunk)
+                if self.query_cache is not None:
+                    self.query_cache.invalidate(chunk)
+
+    def write(self, points: List["TimeSeries"]) -> None:
+        by_type: Dict[Type["TimeSeries"], List["TimeSeries"]] = {}
+        for point in points:
+            by_type.setdefault(type(point), []).append(point)
+
+        for data_type, type_points in by_type.items():
+            self.prepare(data_type)
+            self.backend.persist_many(type_points)
+
+    def prepare(self, data_type: Type["TimeSeries"]) -> None:
+        if data_type not in self.prepared:
+            with self.prepare_lock:
+                if data_type not in self.prepared:
+                    self.backend.prepare_type(data_type)
+                    self.prepared[data_type] = True
+
+    def enqueue(self, points: List["TimeSeries"]) -> None:
+        """Adds the points to the buffer. Once the buffer is full, the caller is
+        blocked until the flusher takes it over"""
+        with self.buffer_condition:
+            position = 0
+            while position < len(points):
+                while len(self.buffer) >= self.buffer_max_points:
+                    self.raise_flush_error()
+                    self.buffer_condition.wait()
+                self.raise_flush_error()
+
+                room = self.buffer_max_points - len(self.buffer)
+                # the flusher has to know when the buffer starts ageing or gets full
+                if not self.buffer:
+                    self.buffered_at = time.monotonic()
+                    self.buffer_condition.notify_all()
+                self.buffer.extend(points[position : position + room])
+                position += room
+                if len(self.buffer) >= self.buffer_max_points:
+                    self.buffer_condition.notify_all()
+
+    def raise_flush_error(self) -> None:
+        if self.flush_error is not None:
+            error, self.flush_error = self.flush_error, None
+            raise error
+
+    def flush(self) -> None:
+        """Writes and commits the buffered points right away"""
+        if self.flusher is None:
+            self.backend.commit()
+            if self.query_cache is not None:
+                self.query_cache.committed()
+            return
+        with self.flush_lock:
+            with self.buffer_condition:
+                points, self.buffer = self.buffer, []
+                self.buffered_at = None
+                self.buffer_condition.notify_all()
+            self.write(points)
+            if self.query_cache is not None:
+                self.query_cache.invalidate(points)
+            self.backend.commit()
+            if self.query_cache is not None:
+                self.query_cache.committed()
+
+    def run_flusher(self) -> None:
+        """Flushes the buffer once it holds TIME_SERIES_BUFFER_MAX_POINTS points or
+        its oldest point is TIME_SERIES_BUFFER_MAX_AGE seconds old. The buffer is
+        swapped for an empty one, so add() can go on while the points are written;
+        at most twice the max points are held in memory."""
+        while True:
+            with self.buffer_condition:
+                while not self.flusher_stopped:
+                    if self.buffer:
+                        age = time.monotonic() - self.buffered_at
+                        if (
+                            len(self.buffer) >= self.buffer_max_points
+                            or age >= self.buffer_max_age
+                        ):
+                            break
+                        self.buffer_condition.wait(self.buffer_max_age - age)
+                    else:
+                        self.buffer_condition.wait()
+                if self.flusher_stopped:
+                    return
+
+            try:
+                self.flush()
+            except Exception as error:
+                print(f"flushing the buffer failed: {error}")
+                with self.buffer_condition:
+                    self.flush_error = error
+                    self.buffer_condition.notify_all()
 
     def query(
         self,
@@ -52,10 +282,187 @@ class Storage:
         dimensions: Dict[str, Any],
         start_time: datetime,
         end_time: Optional[datetime] = None,
-    ) -> Iterable["TimeSeries"]:
+        fields: Optional[List[str]] = None,
+    ) -> Iterable[Union["TimeSeries", Dict[str, Any]]]:
+        """Yields the points of the series, ordered by the timestamp. Each dimension
+        can be given a single value, a list of values or ALL (which is the same as
+        leaving the dimension out), in which case the points of all the matching
+        series are merged. If the fields are specified, only these are fetched and
+        the points are yielded as dicts of the timestamp and the requested fields."""
         if cls not in self.prepared:
             self.backend.prepare_type(cls)
-        yield from self.backend.query(cls, dimensions, start_time, end_time)
+        if (
+            self.query_cache is not None
+            and end_time is not None
+            and not self.backend.downsamples(cls, start_time, end_time, fields)
+        ):
+            yield from self.query_cache.query(
+                self.backend.query_raw, cls, dimensions, start_time, end_time, fields
+            )
+            return
+        yield from self.backend.query(cls, dimensions, start_time, end_time, fields)
+
+    def query_array(
+        self,
+        cls: Type["TimeSeries"],
+        dimensions: Dict[str, Any],
+        start_time: datetime,
+        end_time: Optional[datetime] = None,
+    ) -> Dict[str, Any]:
+        """Same as query(), however instead of yielding the points one by one, the
+        result is returned as a dict of numpy arrays (one per field)."""
+        if cls not in self.prepared:
+            self.backend.prepare_type(cls)
+        return self.backend.query_array(cls, dimensions, start_time, end_time)
+
+    def aggregate(
+        self,
+        cls: Type["TimeSeries"],
+        dimensions: Dict[str, Any],
+        start_time: datetime,
+        end_time: Optional[datetime] = None,
+        bucket: timedelta = timedelta(hours=1),
+        funcs: Optional[List[str]] = None,
+        fields: Optional[List[str]] = None,
+    ) -> Iterable[Dict[str, Any]]:
+        """Downsamples the series into time buckets (aligned to the epoch). Yields a
+        dict per bucket, i.e. {"timestamp": ..., "temperature_avg": ...}. By default
+        all of the aggregation functions are applied to all the numeric fields."""
+        if funcs is None:
+            funcs = list(AGGREGATION_FUNCS)
+        validate_funcs(funcs)
+        if fields is None:
+            fields = numeric_fields(cls)
+        if cls not in self.prepared:
+            self.backend.prepare_type(cls)
+        yield from self.backend.aggregate(
+            cls, dimensions, start_time, end_time, bucket, funcs, fields
+        )
+
+    def compact(self, cls: Optional[Type["TimeSeries"]] = None) -> None:
+        """Merges the small partitions of the series (by default, of all the series
+        used so far) into larger ones, if the backend needs that"""
+        if cls is not None:
+            data_types = [cls]
+        else:
+            with self.prepare_lock:
+                data_types = list(self.prepared)
+        for data_type in data_types:
+            self.prepare(data_type)
+            self.backend.compact(data_type)
+
+    def run_compactor(self) -> None:
+        """Compacts every TIME_SERIES_COMPACTION_INTERVAL seconds. A failed pass is
+        only logged, the next one is tried anyway"""
+        while not self.compactor_stopped.wait(self.compaction_interval):
+            try:
+                self.compact()
+            except Exception as error:
+                print(f"compaction failed: {error}")
 
     def __exit__(self, *args, **kwargs):
-        self.backend.commit()
+        if self.compactor is not None:
+            self.compactor_stopped.set()
+            self.compactor.join()
+        if self.flusher is not None:
+            with self.buffer_condition:
+                self.flusher_stopped = True
+                self.buffer_condition.notify_all()
+            self.flusher.join()
+            self.flush()
+            self.raise_flush_error()
+        else:
+            self.backend.commit()
+
+
+class AsyncStorage:
+    """Storage for the asyncio code:
+
+        async with AsyncStorage() as storage:
+            await storage.add(point)
+            async for point in storage.query(Weather, {"city": "Sao Paulo"}, start):
+                ...
+
+    At most TIME_SERIES_ASYNC_MAX_IN_FLIGHT writes are in flight at once, the
+    rest waits for a free slot."""
+
+    backend: "AsyncBackend"
+
+    async def __aenter__(self) -> "AsyncStorage":
+        selected_backend = selected_backend_name()
+        # the backend is imported in a thread, as it may take a while
+        async_backend = await asyncio.to_thread(
+            load_backend, selected_backend, ASYNC_BACKENDS, ASYNC_BACKENDS_ENTRY_POINTS
+        )
+        if async_backend is not None:
+            self.backend = async_backend()
+        else:
+            backend = await asyncio.to_thread(
+                load_backend, selected_backend, BACKENDS, BACKENDS_ENTRY_POINTS
+            )
+            # the backend is constructed in a thread as well, as it may do I/O
+            self.backend = ExecutorBackend(await asyncio.to_thread(backend))
+        self.prepared: Set[Type["TimeSeries"]] = set()
+        self.in_flight = asyncio.Semaphore(
+            int(
+                environ.get(
+                    "TIME_SERIES_ASYNC_MAX_IN_FLIGHT", ASYNC_MAX_IN_FLIGHT_DEFAULT
+                )
+            )
+        )
+        return self
+
+    async def prepare(self, data_type: Type["TimeSeries"]) -> None:
+        if data_type not in self.prepared:
+            await self.backend.prepare_type(data_type)
+            self.prepared.add(data_type)
+
+    async def persist(self, point: "TimeSeries") -> None:
+        try:
+            await self.prepare(type(point))
+            await self.backend.persist(point)
+        finally:
+            self.in_flight.release()
+
+    async def add(self, data: "TimeSeries") -> None:
+        await self.in_flight.acquire()
+        await self.persist(data)
+
+    async def add_many(
+        self, points: Union[Iterable["TimeSeries"], AsyncIterable["TimeSeries"]]
+    ) -> None:
+        """Writes the points concurrently (up to the in-flight limit) and waits
+        until all of them are written"""
+        tasks: Set[asyncio.Task] = set()
+
+        async def schedule(point: "TimeSeries") -> None:
+            await self.in_flight.acquire()
+            task = asyncio.create_task(self.persist(point))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if isinstance(points, AsyncIterable):
+            async for point in points:
+                await schedule(point)
+        else:
+            for point in points:
+                await schedule(point)
+
+        await asyncio.gather(*tasks)
+
+    async def query(
+        self,
+        cls: Type["TimeSeries"],
+        dimensions: Dict[str, Any],
+        start_time: datetime,
+        end_time: Optional[datetime] = None,
+        fields: Optional[List[str]] = None,
+    ) -> AsyncIterator[Union["TimeSeries", Dict[str, Any]]]:
+        await self.prepare(cls)
+        async for point in self.backend.query(
+            cls, dimensions, start_time, end_time, fields
+        ):
+            yield point
+
+    async def __aexit__(self, *args, **kwargs):
+        await self.backend.commit()
@@ -0,0 +1,344 @@
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+
+import backends.aws_timestream as aws_timestream
+from backends.aws_timestream import MAX_RECORDS_PER_BATCH, TimeStreamBackend
+from schemas.weather import Description, Weather
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+TOTAL_INGESTED = {"RecordsIngested": {"Total": 1, "MemoryStore": 1, "MagneticStore": 0}}
+
+
+def weather(index: int, city: str = "Prague") -> Weather:
+    return Weather(
+        timestamp=START + timedelta(minutes=index),
+        city=city,
+        temperature=Decimal("21.5"),
+        rainfall=index,
+        description=Description.CLOUDY,
+    )
+
+
+def record(index: int) -> dict:
+    return {
+        "Time": str(int((START + timedelta(minutes=index)).timestamp() * 1000)),
+        "MeasureValues": [
+            {"Name": "temperature", "Value": "21.5", "Type": "DOUBLE"},
+            {"Name": "rainfall", "Value": str(index), "Type": "BIGINT"},
+            {"Name": "description", "Value": "1", "Type": "BIGINT"},
+        ],
+    }
+
+
+def common_attributes(city: str = "Prague") -> dict:
+    return {
+        "Dimensions": [{"Name": "city", "Value": city}],
+        "MeasureName": "measures",
+        "MeasureValueType": "MULTI",
+        "TimeUnit": "MILLISECONDS",
+    }
+
+
+def write_params(records: list, city: str = "Prague") -> dict:
+    return {
+        "DatabaseName": "test-db",
+        "TableName": "weather",
+        "Records": records,
+        "CommonAttributes": common_attributes(city),
+    }
+
+
+@pytest.fixture(autouse=True)
+def environment(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setenv("TIME_SERIES_TIMESTREAM_DATABASE", "test-db")
+    # a single writer sends the batches in order, as the stubbed responses are
+    monkeypatch.setenv("TIME_SERIES_TIMESTREAM_WRITERS", "1")
+    monkeypatch.setattr(aws_timestream, "RETRY_BACKOFF", 0)
+
+
+@pytest.fixture
+def writer():
+    client = boto3.client("timestream-write", region_name="us-east-1")
+    with Stubber(client) as stubber:
+        yield client, stubber
+
+
+def test_full_batch_is_submitted_right_away(writer):
+    client, stubber = writer
+    backend = TimeStreamBackend(writer=client)
+    stubber.add_response(
+        "write_records",
+        TOTAL_INGESTED,
+        write_params([record(index) for index in range(MAX_RECORDS_PER_BATCH)]),
+    )
+
+    backend.persist_many([weather(index) for index in range(MAX_RECORDS_PER_BATCH)])
+
+    # the batch went out without waiting for the commit
+    assert backend.buffer == {}
+    backend.in_flight[0].result()
+    backend.commit()
+    stubber.assert_no_pending_responses()
+
+
+def test_series_are_batched_with_common_attributes(writer):
+    client, stubber = writer
+    backend = TimeStreamBackend(writer=client)
+    stubber.add_response(
+        "write_records", TOTAL_INGESTED, write_params([record(0), record(2)], "Prague")
+    )
+    stubber.add_response(
+        "write_records", TOTAL_INGESTED, write_params([record(1)], "Brno")
+    )
+
+    backend.persist_many(
+        [weather(0, "Prague"), weather(1, "Brno"), weather(2, "Prague")]
+    )
+    backend.commit()
+    stubber.assert_no_pending_responses()
+
+
+def test_rejected_records_are_retried(writer):
+    client, stubber = writer
+    backend = TimeStreamBackend(writer=client)
+    records = [record(index) for index in range(4)]
+    stubber.add_client_error(
+        "write_records",
+        service_error_code="RejectedRecordsException",
+        service_message="One or more records have been rejected.",
+        http_status_code=419,
+        expected_params=write_params(records),
+        modeled_fields={
+            "RejectedRecords": [
+                {"RecordIndex": 1, "Reason": "throttled"},
+                {"RecordIndex": 3, "Reason": "throttled"},
+                # a newer version exists, retrying won't help
+                {"RecordIndex": 2, "Reason": "version", "ExistingVersion": 2},
+            ]
+        },
+    )
+    # only the rejected ones are sent again
+    stubber.add_response(
+        "write_records", TOTAL_INGESTED, write_params([record(1), record(3)])
+    )
+
+    backend.persist_many([weather(index) for index in range(4)])
+    backend.commit()
+    stubber.assert_no_pending_responses()
+
+
+def test_failed_batch_is_raised_by_commit(writer):
+    client, stubber = writer
+    backend = TimeStreamBackend(writer=client)
+    stubber.add_client_error(
+        "write_records",
+        service_error_code="ValidationException",
+        service_message="The record timestamp is outside the time range.",
+        http_status_code=400,
+        expected_params=write_params([record(0)]),
+    )
+
+    backend.persist_many([weather(0)])
+    with pytest.raises(ClientError, match="ValidationException"):
+        backend.commit()
+    stubber.assert_no_pending_responses()
+
+    # the error is only raised once
+    backend.commit()
+
+
+def test_records_rejected_by_every_attempt_fail_the_batch(writer):
+    client, stubber = writer
+    backend = TimeStreamBackend(writer=client)
+    for records in ([record(0), record(1)], [record(1)], [record(1)]):
+        stubber.add_client_error(
+            "write_records",
+            service_error_code="RejectedRecordsException",
+            service_message="One or more records have been rejected.",
+            http_status_code=419,
+            expected_params=write_params(records),
+            modeled_fields={
+                "RejectedRecords": [
+                    {"RecordIndex": len(records) - 1, "Reason": "throttled"}
+                ]
+            },
+        )
+
+    backend.persist_many([weather(0), weather(1)])
+    with pytest.raises(client.exceptions.RejectedRecordsException):
+        backend.commit()
+    stubber.assert_no_pending_responses()
+
+
+def test_pending_records_are_limited_across_series(writer, monkeypatch):
+    monkeypatch.setenv("TIME_SERIES_TIMESTREAM_MAX_PENDING_RECORDS", "4")
+    client, stubber = writer
+    backend = TimeStreamBackend(writer=client)
+    # the largest buffer goes first, until half of the limit is left
+    stubber.add_response(
+        "write_records",
+        TOTAL_INGESTED,
+        write_params([record(0), record(1), record(2)], "Prague"),
+    )
+    stubber.add_response(
+        "write_records", TOTAL_INGESTED, write_params([record(3)], "Brno")
+    )
+    stubber.add_response(
+        "write_records", TOTAL_INGESTED, write_params([record(4)], "Ostrava")
+    )
+
+    backend.persist_many(
+        [
+            weather(0, "Prague"),
+            weather(1, "Prague"),
+            weather(2, "Prague"),
+            weather(3, "Brno"),
+            weather(4, "Ostrava"),
+        ]
+    )
+
+    assert list(backend.buffer) == [
+        ("weather", (("city", "Brno"),)),
+        ("weather", (("city", "Ostrava"),)),
+    ]
+    assert backend.pending_records == 2
+    backend.commit()
+    assert backend.pending_records == 0
+    stubber.assert_no_pending_responses()
+
+
+def column(name: str, scalar_type: str) -> dict:
+    return {"Name": name, "Type": {"ScalarType": scalar_type}}
+
+
+def row(*values) -> dict:
+    return {
+        "Data": [
+            {"NullValue": True} if value is None else {"ScalarValue": value}
+            for value in values
+        ]
+    }
+
+
+WEATHER_COLUMNS = [
+    column("time", "TIMESTAMP"),
+    column("city", "VARCHAR"),
+    column("temperature", "DOUBLE"),
+    column("rainfall", "BIGINT"),
+    column("description", "BIGINT"),
+]
+WHERE = (
+    "WHERE measure_name = 'measures' AND city = 'Prague' "
+    "AND time >= from_milliseconds(1704067200000) "
+    "AND time <= from_milliseconds(1704070800000)"
+)
+
+
+@pytest.fixture
+def querier():
+    client = boto3.client("timestream-query", region_name="us-east-1")
+    with Stubber(client) as stubber:
+        yield client, stubber
+
+
+def test_query_follows_the_next_token(querier):
+    client, stubber = querier
+    backend = TimeStreamBackend(writer=object(), querier=client)
+    query_string = (
+        "SELECT time, city, temperature, rainfall, description "
+        f'FROM "test-db"."weather" {WHERE} ORDER BY time'
+    )
+    stubber.add_response(
+        "query",
+        {
+            "QueryId": "query",
+            "NextToken": "page-2",
+            "Rows": [row("2024-01-01 00:00:00.000000000", "Prague", "21.5", "0", "1")],
+            "ColumnInfo": WEATHER_COLUMNS,
+        },
+        {"QueryString": query_string},
+    )
+    stubber.add_response(
+        "query",
+        {
+            "QueryId": "query",
+            "Rows": [row("2024-01-01 00:01:00.000000000", "Prague", "19.25", "3", "2")],
+            "ColumnInfo": WEATHER_COLUMNS,
+        },
+        {"QueryString": query_string, "NextToken": "page-2"},
+    )
+
+    points = list(
+        backend.query(Weather, {"city": "Prague"}, START, START + timedelta(hours=1))
+    )
+
+    assert points == [
+        weather(0),
+        Weather(
+            timestamp=START + timedelta(minutes=1),
+            city="Prague",
+            temperature=Decimal("19.25"),
+            rainfall=3,
+            description=Description.SNOWY,
+        ),
+    ]
+    stubber.assert_no_pending_responses()
+
+
+def test_aggregate_decodes_the_bins(querier):
+    client, stubber = querier
+    backend = TimeStreamBackend(writer=object(), querier=client)
+    stubber.add_response(
+        "query",
+        {
+            "QueryId": "query",
+            "Rows": [
+                row("2024-01-01 00:00:00.000000000", "22.5", "12"),
+                # no rainfall was reported in the second bin
+                row("2024-01-01 00:30:00.000000000", "18.5", None),
+            ],
+            "ColumnInfo": [
+                column("binned_time", "TIMESTAMP"),
+                column("temperature_max", "DOUBLE"),
+                column("rainfall_max", "BIGINT"),
+            ],
+        },
+        {
+            "QueryString": (
+                "SELECT bin(time, 1800s) AS binned_time, "
+                "MAX(temperature) AS temperature_max, MAX(rainfall) AS rainfall_max "
+                f'FROM "test-db"."weather" {WHERE} '
+                "GROUP BY bin(time, 1800s) ORDER BY binned_time"
+            )
+        },
+    )
+
+    buckets = list(
+        backend.aggregate(
+            Weather,
+            {"city": "Prague"},
+            START,
+            START + timedelta(hours=1),
+            timedelta(minutes=30),
+            ["max"],
+            ["temperature", "rainfall"],
+        )
+    )
+
+    assert buckets == [
+        {"timestamp": START, "temperature_max": 22.5, "rainfall_max": 12},
+        {
+            "timestamp": START + timedelta(minutes=30),
+            "temperature_max": 18.5,
+            "rainfall_max": None,
+        },
+    ]
+    stubber.assert_no_pending_responses()
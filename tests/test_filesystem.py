@@ -0,0 +1,139 @@
+import os
+import resource
+import time
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+import pytest
+
+from backends.filesystem.catalog import Catalog
+from schemas.weather import Description, Weather
+from storage import ALL, Storage
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def weather(index: int, city: str = "Prague") -> Weather:
+    return Weather(
+        timestamp=START + timedelta(hours=index),
+        city=city,
+        temperature=Decimal("21.5"),
+        rainfall=index,
+        description=Description.CLOUDY,
+    )
+
+
+@pytest.fixture
+def root(tmp_path, monkeypatch):
+    monkeypatch.setenv("TIME_SERIES_BACKEND", "fs")
+    monkeypatch.setenv("TIME_SERIES_FS_ROOT", str(tmp_path))
+    return tmp_path
+
+
+def test_wal_is_not_shared_between_backends(root, monkeypatch):
+    monkeypatch.setenv("TIME_SERIES_FS_WAL", "1")
+
+    with Storage() as first:
+        for index in range(5):
+            first.add(weather(index))
+        first.backend.wal.sync()
+
+        # the second backend must not recover (nor remove) the log of the first one
+        with Storage() as second:
+            for index in range(5, 10):
+                second.add(weather(index))
+
+    with Storage() as storage:
+        points = list(
+            storage.query(Weather, {"city": "Prague"}, START, START + timedelta(days=1))
+        )
+
+    assert [point.rainfall for point in points] == list(range(10))
+    assert os.listdir(root / ".wal") == []
+
+
+@pytest.fixture
+def file_limit():
+    """Lowers the limit of the open files for the duration of the test"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+
+    def lower(limit: int) -> None:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+
+    yield lower
+    resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+
+def test_query_over_many_partitions_keeps_few_files_open(root, file_limit):
+    cities = [f"city-{index}" for index in range(10)]
+    # a file per city and day
+    points = [
+        weather(day * 24 + hour, city)
+        for city in cities
+        for day in range(60)
+        for hour in (6, 18)
+    ]
+    with Storage() as storage:
+        storage.add_many(points)
+
+    file_limit(64)
+    with Storage() as storage:
+        result = list(
+            storage.query(Weather, {"city": cities}, START, START + timedelta(days=60))
+        )
+        array = storage.query_array(
+            Weather, {"city": cities}, START, START + timedelta(days=60)
+        )
+
+    assert len(result) == len(points)
+    assert [point.timestamp for point in result] == sorted(
+        point.timestamp for point in points
+    )
+    assert len(array["timestamp"]) == len(points)
+
+
+def test_catalog_is_split_by_series(root):
+    with Storage() as storage:
+        storage.add_many([weather(0, "Prague"), weather(0, "Brno")])
+    catalog_directory = root / ".catalog" / "weather"
+    brno_mtime = os.stat(catalog_directory / "city=Brno.json").st_mtime_ns
+
+    # the commit only rewrites the catalog of the series it wrote to
+    with Storage() as storage:
+        storage.add_many([weather(hours, "Prague") for hours in (24, 48, 72)])
+    assert os.stat(catalog_directory / "city=Brno.json").st_mtime_ns == brno_mtime
+
+    catalog = Catalog(str(root), "weather")
+    start = (START + timedelta(days=1)).timestamp()
+    end = (START + timedelta(days=2)).timestamp()
+    assert [
+        partition.date for partition in catalog.lookup({"city": {"Prague"}}, start, end)
+    ] == ["2024-01-02", "2024-01-03"]
+    assert [
+        partition.dimensions["city"]
+        for partition in catalog.lookup({"city": None}, START.timestamp())
+    ] == ["Brno", "Prague", "Prague", "Prague", "Prague"]
+
+    with Storage() as storage:
+        points = list(storage.query(Weather, {"city": ALL}, START))
+    assert len(points) == 5
+
+
+def test_compactor_keeps_running_after_a_failed_pass(root, monkeypatch):
+    monkeypatch.setenv("TIME_SERIES_COMPACTION_INTERVAL", "0.01")
+    passes = []
+
+    def compact(data_type):
+        passes.append(data_type)
+        if len(passes) == 1:
+            raise OSError("disk full")
+
+    with Storage() as storage:
+        monkeypatch.setattr(storage.backend, "compact", compact)
+        storage.add(weather(0))
+        deadline = time.monotonic() + 5
+        while len(passes) < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert storage.compactor.is_alive()
+
+    assert passes[:3] == [Weather, Weather, Weather]
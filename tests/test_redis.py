@@ -0,0 +1,83 @@
+import time
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+import fakeredis
+import pytest
+from redis.client import Pipeline
+from redis.exceptions import ConnectionError
+
+from backends.redis import RedisBackend
+from schemas.weather import Description, Weather
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+# temperature, rainfall and description
+ATTRIBUTES = 3
+
+
+def weather(index: int) -> Weather:
+    return Weather(
+        timestamp=START + timedelta(minutes=index),
+        city="Prague",
+        temperature=Decimal("21.5"),
+        rainfall=index,
+        description=Description.CLOUDY,
+    )
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    monkeypatch.setenv("TIME_SERIES_REDIS_BUFFER_SIZE", str(2 * ATTRIBUTES))
+    monkeypatch.setenv("TIME_SERIES_REDIS_BUFFER_AGE_MS", "60000")
+    backend = RedisBackend(connection=fakeredis.FakeRedis())
+    backend.prepare_type(Weather)
+    yield backend
+    if backend.flush_timer is not None:
+        backend.flush_timer.cancel()
+
+
+def stored(backend: RedisBackend) -> list:
+    return [
+        point.rainfall
+        for point in backend.query(Weather, {"city": "Prague"}, START, None)
+    ]
+
+
+def test_samples_are_sent_once_the_buffer_is_full(backend):
+    backend.persist(weather(0))
+    assert stored(backend) == []
+
+    backend.persist(weather(1))
+    assert backend.buffer == []
+    assert stored(backend) == [0, 1]
+
+
+def test_idle_buffer_is_flushed_by_the_timer(backend):
+    backend.buffer_age = 0.05
+    backend.persist(weather(0))
+    assert stored(backend) == []
+
+    deadline = time.monotonic() + 5
+    while backend.buffer and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert stored(backend) == [0]
+
+
+def test_buffer_is_kept_when_the_pipeline_fails(backend, monkeypatch):
+    backend.persist(weather(0))
+    backend.commit()
+
+    execute = Pipeline.execute
+
+    def failing_execute(self, raise_on_error=True):
+        raise ConnectionError("connection lost")
+
+    monkeypatch.setattr(Pipeline, "execute", failing_execute)
+    with pytest.raises(ConnectionError):
+        backend.persist_many([weather(1), weather(2)])
+    assert len(backend.buffer) == 2 * ATTRIBUTES
+
+    monkeypatch.setattr(Pipeline, "execute", execute)
+    backend.commit()
+    assert backend.buffer == []
+    assert stored(backend) == [0, 1, 2]